@@ -1,527 +1,1545 @@
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import sqlite3
-from datetime import datetime
-from tkcalendar import DateEntry
-import openpyxl
-import logging
-
-# Basic logging configuration
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-class PatientManagementApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("سامانه مدیریت بیماران")
-        self.root.geometry("1400x800")
-        self.root.minsize(1350, 700)
-        self.root.config(bg="#f0f0f0")
-        
-        # Style configuration
-        style = ttk.Style(self.root)
-        style.configure("TLabel", font=('Tahoma', 10), background="#f0f0f0", anchor="e")
-        style.configure("TButton", font=('Tahoma', 10, 'bold'))
-        style.configure("TEntry", font=('Tahoma', 10))
-        style.configure("TCombobox", font=('Tahoma', 10))
-        style.configure("Treeview.Heading", font=('Tahoma', 11, 'bold'))
-        style.configure("Treeview", rowheight=25, font=('Tahoma', 10))
-        style.configure("TLabelframe.Label", font=('Tahoma', 11, 'bold'))
-
-        self.db_name = 'hospital_patients.db'
-        self.conn = None
-        self.cursor = None
-        self.connect_db()
-
-        self.create_widgets()
-        self.display_patients()
-
-        self.selected_patient_db_id = None
-
-    def connect_db(self):
-        try:
-            self.conn = sqlite3.connect(self.db_name)
-            self.cursor = self.conn.cursor()
-            logging.info("Database connection successful.")
-            self.create_table()
-            self.create_specialists_table()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در اتصال به پایگاه داده: {e}")
-            self.root.destroy()
-
-    def create_table(self):
-        try:
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS patients (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    patient_name TEXT NOT NULL,
-                    last_name TEXT NOT NULL,
-                    age INTEGER NOT NULL,
-                    ward TEXT NOT NULL,
-                    patient_code TEXT NOT NULL,
-                    specialist TEXT NOT NULL,
-                    submission_date TEXT NOT NULL,
-                    submission_time TEXT NOT NULL
-                )
-            ''')
-            self.conn.commit()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای ساخت جدول", f"خطا در ایجاد جدول پایگاه داده: {e}")
-
-    def create_specialists_table(self):
-        try:
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS specialists (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    specialist_name TEXT NOT NULL,
-                    is_active INTEGER NOT NULL DEFAULT 1
-                )
-            ''')
-            self.conn.commit()
-            # Insert initial specialists if table is empty
-            self.cursor.execute("SELECT COUNT(*) FROM specialists")
-            if self.cursor.fetchone()[0] == 0:
-                initial_specialists = [
-                    "قلب و عروق - دکتر کریمی", "داخلی - دکتر رضایی", "اطفال - دکتر محمدی",
-                    "پوست - دکتر قاسمی", "چشم - دکتر احمدی", "ارتوپدی - دکتر حسینی",
-                    "گوش و حلق و بینی - دکتر نوری", "مغز و اعصاب - دکتر مرادی",
-                    "جراحی - دکتر یوسفی", "اورولوژی - دکتر بهرامی", "زنان و زایمان - دکتر علوی",
-                    "ریه - دکتر پارسا", "غدد - دکتر اکبری", "گوارش - دکتر شجاعی",
-                    "روانپزشکی - دکتر جمشیدی"
-                ]
-                for spec in initial_specialists:
-                    self.cursor.execute("INSERT INTO specialists (specialist_name, is_active) VALUES (?, 1)", (spec,))
-                self.conn.commit()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای ساخت جدول", f"خطا در ایجاد جدول متخصصین: {e}")
-
-    def get_active_specialists(self):
-        try:
-            self.cursor.execute("SELECT specialist_name FROM specialists WHERE is_active=1")
-            return [row[0] for row in self.cursor.fetchall()]
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در دریافت متخصصین: {e}")
-            return []
-
-    def get_all_specialists(self):
-        try:
-            self.cursor.execute("SELECT specialist_name FROM specialists")
-            return [row[0] for row in self.cursor.fetchall()]
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در دریافت همه متخصصین: {e}")
-            return []
-
-    def create_widgets(self):
-        main_frame = ttk.Frame(self.root, padding="10")
-        main_frame.pack(fill="both", expand=True)
-
-        # --- Input Frame ---
-        input_frame = ttk.LabelFrame(main_frame, text="ثبت و ویرایش اطلاعات بیمار", padding="10", labelanchor="ne")
-        input_frame.pack(fill="x", pady=5)
-        for i in range(6): input_frame.grid_columnconfigure(i, weight=1)
-
-        labels_texts = [":نام بیمار", ":نام خانوادگی", ":سن", ":بخش", ":کد بیمار", ":پزشک متخصص"]
-        self.entries = {}
-        
-        ttk.Label(input_frame, text=labels_texts[0], anchor="e").grid(row=0, column=5, sticky="e", padx=5, pady=5)
-        self.entries["نام بیمار"] = tk.StringVar()
-        ttk.Entry(input_frame, textvariable=self.entries["نام بیمار"], justify='right').grid(row=0, column=4, sticky="ew", padx=5, pady=5)
-        
-        ttk.Label(input_frame, text=labels_texts[1], anchor="e").grid(row=0, column=3, sticky="e", padx=5, pady=5)
-        self.entries["نام خانوادگی"] = tk.StringVar()
-        ttk.Entry(input_frame, textvariable=self.entries["نام خانوادگی"], justify='right').grid(row=0, column=2, sticky="ew", padx=5, pady=5)
-        
-        ttk.Label(input_frame, text=labels_texts[2], anchor="e").grid(row=0, column=1, sticky="e", padx=5, pady=5)
-        self.entries["سن"] = tk.StringVar()
-        ttk.Entry(input_frame, textvariable=self.entries["سن"], justify='right', width=10).grid(row=0, column=0, sticky="ew", padx=5, pady=5)
-
-        ttk.Label(input_frame, text=labels_texts[3], anchor="e").grid(row=1, column=5, sticky="e", padx=5, pady=5)
-        self.entries["بخش"] = tk.StringVar()
-        ttk.Entry(input_frame, textvariable=self.entries["بخش"], justify='right').grid(row=1, column=4, sticky="ew", padx=5, pady=5)
-
-        ttk.Label(input_frame, text=labels_texts[4], anchor="e").grid(row=1, column=3, sticky="e", padx=5, pady=5)
-        self.entries["کد بیمار"] = tk.StringVar()
-        ttk.Entry(input_frame, textvariable=self.entries["کد بیمار"], justify='right').grid(row=1, column=2, sticky="ew", padx=5, pady=5)
-
-        ttk.Label(input_frame, text=labels_texts[5], anchor="e").grid(row=2, column=5, sticky="e", padx=5, pady=5)
-        self.specialists = self.get_active_specialists()
-        self.specialist_var = tk.StringVar()
-        self.specialist_combo = ttk.Combobox(input_frame, textvariable=self.specialist_var, values=self.specialists,
-                                            state="readonly", justify='right', height=len(self.specialists))
-        self.specialist_combo.grid(row=2, column=2, columnspan=3, sticky="ew", padx=5, pady=5)
-        if self.specialists:
-            self.specialist_var.set(self.specialists[0])
-        
-        self.submit_button = ttk.Button(input_frame, text="ثبت اطلاعات", command=self.add_patient)
-        self.submit_button.grid(row=2, column=0, columnspan=2, sticky="ew", padx=5, pady=10)
-
-        # --- Specialist Management Frame ---
-        specialist_frame = ttk.LabelFrame(main_frame, text="مدیریت پزشکان ویزیت‌کننده", padding="10", labelanchor="ne")
-        specialist_frame.pack(fill="x", pady=5)
-        for i in range(6): specialist_frame.grid_columnconfigure(i, weight=1)
-
-        ttk.Label(specialist_frame, text=":نام پزشک", anchor="e").grid(row=0, column=5, sticky="e", padx=5, pady=5)
-        self.new_specialist_var = tk.StringVar()
-        ttk.Entry(specialist_frame, textvariable=self.new_specialist_var, justify='right').grid(row=0, column=4, sticky="ew", padx=5, pady=5)
-
-        ttk.Button(specialist_frame, text="اضافه کردن پزشک", command=self.add_specialist).grid(row=0, column=2, columnspan=2, sticky="ew", padx=5, pady=5)
-        ttk.Button(specialist_frame, text="حذف پزشک", command=self.delete_specialist).grid(row=0, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
-
-        # --- Filter Frame ---
-        filter_frame = ttk.LabelFrame(main_frame, text="جستجو و فیلتر", padding="10", labelanchor="ne")
-        filter_frame.pack(fill="x", pady=10)
-        for i in range(8): filter_frame.grid_columnconfigure(i, weight=1)
-
-        ttk.Label(filter_frame, text=":فیلتر تخصص", font=('Tahoma', 10), anchor="e").grid(row=0, column=7, sticky="e", padx=5)
-        self.filter_specialist_var = tk.StringVar(value="همه متخصصین")
-        self.filter_specialist_combo = ttk.Combobox(filter_frame, textvariable=self.filter_specialist_var,
-                                                  values=["همه متخصصین"] + self.get_all_specialists(), state="readonly", justify='right',
-                                                  height=len(self.get_all_specialists()) + 1)
-        self.filter_specialist_combo.grid(row=0, column=6, sticky="ew", padx=5)
-        self.filter_specialist_combo.bind("<<ComboboxSelected>>", self.filter_patients_by_specialist)
-
-        ttk.Label(filter_frame, text=":از تاریخ", font=('Tahoma', 10), anchor="e").grid(row=0, column=5, sticky="e", padx=5)
-        self.date1_entry = DateEntry(filter_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
-        self.date1_entry.grid(row=0, column=4, sticky="ew", padx=5)
-        
-        ttk.Label(filter_frame, text=":تا تاریخ", font=('Tahoma', 10), anchor="e").grid(row=0, column=3, sticky="e", padx=5)
-        self.date2_entry = DateEntry(filter_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
-        self.date2_entry.grid(row=0, column=2, sticky="ew", padx=5)
-
-        ttk.Button(filter_frame, text="اعمال فیلتر تاریخ", command=self.filter_patients_by_date_range).grid(row=0, column=0, columnspan=2, sticky="ew", padx=5)
-
-        ttk.Label(filter_frame, text=":جستجوی کد بیمار", font=('Tahoma', 10), anchor="e").grid(row=1, column=7, sticky="e", padx=5, pady=5)
-        self.search_code_var = tk.StringVar()
-        search_entry = ttk.Entry(filter_frame, textvariable=self.search_code_var, justify='right', font=('Tahoma', 10))
-        search_entry.grid(row=1, column=5, columnspan=2, sticky="ew", padx=5, pady=5)
-        
-        ttk.Button(filter_frame, text="جستجو", command=self.search_patient_by_code).grid(row=1, column=4, sticky="ew", padx=5, pady=5)
-
-        ttk.Button(filter_frame, text="نمایش همه و بازنشانی", command=self.reset_filters_and_display_all).grid(row=1, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
-
-        # --- Treeview Frame ---
-        tree_frame = ttk.Frame(main_frame)
-        tree_frame.pack(fill="both", expand=True)
-
-        self.display_columns_order = ("نام بیمار", "نام خانوادگی", "سن", "بخش", "کد بیمار", "پزشک متخصص", "تاریخ ثبت", "زمان ثبت", "id")
-        
-        self.patient_tree = ttk.Treeview(tree_frame, columns=self.display_columns_order, displaycolumns=self.display_columns_order, show="headings")
-        
-        self.patient_tree.heading("نام بیمار", text="نام بیمار", anchor="e")
-        self.patient_tree.column("نام بیمار", width=150, anchor="e", stretch=tk.YES)
-
-        self.patient_tree.heading("نام خانوادگی", text="نام خانوادگی", anchor="e")
-        self.patient_tree.column("نام خانوادگی", width=180, anchor="e", stretch=tk.YES)
-        
-        self.patient_tree.heading("سن", text="سن", anchor="center")
-        self.patient_tree.column("سن", width=60, anchor="center", stretch=tk.NO)
-
-        self.patient_tree.heading("بخش", text="بخش", anchor="e")
-        self.patient_tree.column("بخش", width=120, anchor="e", stretch=tk.YES)
-
-        self.patient_tree.heading("کد بیمار", text="کد بیمار", anchor="e")
-        self.patient_tree.column("کد بیمار", width=120, anchor="e", stretch=tk.NO)
-
-        self.patient_tree.heading("پزشک متخصص", text="پزشک متخصص", anchor="e")
-        self.patient_tree.column("پزشک متخصص", width=250, anchor="e", stretch=tk.YES)
-        
-        self.patient_tree.heading("تاریخ ثبت", text="تاریخ ثبت", anchor="center")
-        self.patient_tree.column("تاریخ ثبت", width=120, anchor="center", stretch=tk.NO)
-        
-        self.patient_tree.heading("زمان ثبت", text="زمان ثبت", anchor="center")
-        self.patient_tree.column("زمان ثبت", width=120, anchor="center", stretch=tk.NO)
-
-        self.patient_tree.heading("id", text="ردیف", anchor="center")
-        self.patient_tree.column("id", width=60, anchor="center", stretch=tk.NO)
-        
-        vsb = ttk.Scrollbar(tree_frame, orient="vertical", command=self.patient_tree.yview)
-        self.patient_tree.configure(yscrollcommand=vsb.set)
-        
-        vsb.pack(side="right", fill="y")
-        self.patient_tree.pack(side="left", fill="both", expand=True)
-
-        action_frame = ttk.Frame(main_frame)
-        action_frame.pack(pady=10, fill="x")
-        for i in range(3): action_frame.grid_columnconfigure(i, weight=1)
-
-        ttk.Button(action_frame, text="ویرایش بیمار منتخب", command=self.edit_patient).grid(row=0, column=2, padx=5, sticky="ew")
-        ttk.Button(action_frame, text="حذف بیمار(ان) منتخب", command=self.delete_selected_patients).grid(row=0, column=1, padx=5, sticky="ew")
-        ttk.Button(action_frame, text="خروجی اکسل", command=self.export_to_excel).grid(row=0, column=0, padx=5, sticky="ew")
-
-    def add_specialist(self):
-        specialist_name = self.new_specialist_var.get().strip()
-        if not specialist_name:
-            messagebox.showwarning("ورودی ناقص", "لطفا نام پزشک را وارد کنید.")
-            return
-        try:
-            self.cursor.execute("SELECT specialist_name FROM specialists WHERE specialist_name=?", (specialist_name,))
-            if self.cursor.fetchone():
-                messagebox.showwarning("تکراری", "این پزشک قبلا ثبت شده است.")
-                return
-            self.cursor.execute("INSERT INTO specialists (specialist_name, is_active) VALUES (?, 1)", (specialist_name,))
-            self.conn.commit()
-            messagebox.showinfo("موفقیت", "پزشک با موفقیت اضافه شد.")
-            self.new_specialist_var.set("")
-            self.specialists = self.get_active_specialists()
-            self.specialist_combo['values'] = self.specialists
-            if self.specialists:
-                self.specialist_var.set(self.specialists[0])
-            self.filter_specialist_combo['values'] = ["همه متخصصین"] + self.get_all_specialists()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در اضافه کردن پزشک: {e}")
-
-    def delete_specialist(self):
-        specialist_name = self.new_specialist_var.get().strip()
-        if not specialist_name:
-            messagebox.showwarning("انتخاب کنید", "لطفا نام پزشک را در کادر وارد کنید.")
-            return
-        try:
-            self.cursor.execute("SELECT COUNT(*) FROM specialists WHERE specialist_name=? AND is_active=1", (specialist_name,))
-            if self.cursor.fetchone()[0] == 0:
-                messagebox.showwarning("خطا", "پزشک مورد نظر یافت نشد یا غیرفعال است.")
-                return
-            self.cursor.execute("SELECT COUNT(*) FROM patients WHERE specialist=?", (specialist_name,))
-            if self.cursor.fetchone()[0] > 0:
-                messagebox.showwarning("خطا", "نمی‌توان پزشک را حذف کرد زیرا در سوابق بیماران استفاده شده است.")
-                return
-            self.cursor.execute("UPDATE specialists SET is_active=0 WHERE specialist_name=?", (specialist_name,))
-            self.conn.commit()
-            messagebox.showinfo("موفقیت", "پزشک با موفقیت غیرفعال شد.")
-            self.new_specialist_var.set("")
-            self.specialists = self.get_active_specialists()
-            self.specialist_combo['values'] = self.specialists
-            if self.specialists:
-                self.specialist_var.set(self.specialists[0])
-            else:
-                self.specialist_var.set("")
-            self.filter_specialist_combo['values'] = ["همه متخصصین"] + self.get_all_specialists()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در غیرفعال کردن پزشک: {e}")
-
-    def add_patient(self):
-        name = self.entries["نام بیمار"].get().strip()
-        last_name = self.entries["نام خانوادگی"].get().strip()
-        age_str = self.entries["سن"].get().strip()
-        ward = self.entries["بخش"].get().strip()
-        code = self.entries["کد بیمار"].get().strip()
-        specialist = self.specialist_var.get()
-
-        if not all([name, last_name, age_str, ward, code, specialist]):
-            messagebox.showwarning("ورودی ناقص", ".لطفا تمام فیلدها را پر کنید")
-            return
-
-        try:
-            age = int(age_str)
-            if not (0 < age < 150): raise ValueError
-        except ValueError:
-            messagebox.showwarning("ورودی نامعتبر", ".سن باید یک عدد صحیح معتبر باشد")
-            return
-
-        if self.selected_patient_db_id:
-            self.update_patient_data(name, last_name, age, ward, code, specialist)
-        else:
-            self.insert_new_patient(name, last_name, age, ward, code, specialist)
-
-    def insert_new_patient(self, name, last_name, age, ward, code, specialist):
-        try:
-            submission_date = datetime.now().strftime("%Y-%m-%d")
-            submission_time = datetime.now().strftime("%H:%M:%S")
-            self.cursor.execute("""
-                INSERT INTO patients (patient_name, last_name, age, ward, patient_code, specialist, submission_date, submission_time)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (name, last_name, age, ward, code, specialist, submission_date, submission_time))
-            self.conn.commit()
-            messagebox.showinfo("موفقیت", ".اطلاعات بیمار با موفقیت ثبت شد")
-            self.clear_entries()
-            self.display_patients()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در ثبت اطلاعات: {e}")
-
-    def update_patient_data(self, name, last_name, age, ward, code, specialist):
-        try:
-            self.cursor.execute("""
-                UPDATE patients
-                SET patient_name=?, last_name=?, age=?, ward=?, patient_code=?, specialist=?
-                WHERE id=?
-            """, (name, last_name, age, ward, code, specialist, self.selected_patient_db_id))
-            self.conn.commit()
-            messagebox.showinfo("موفقیت", ".اطلاعات بیمار با موفقیت به‌روزرسانی شد")
-            self.clear_entries()
-            self.display_patients()
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در به‌روزرسانی اطلاعات: {e}")
-
-    def clear_entries(self):
-        for var in self.entries.values():
-            var.set("")
-        if self.specialists:
-            self.specialist_var.set(self.specialists[0])
-        if self.selected_patient_db_id:
-            self.selected_patient_db_id = None
-            self.submit_button.config(text="ثبت اطلاعات")
-            self.root.title("سامانه مدیریت بیماران")
-
-    def reset_filters_and_display_all(self):
-        self.search_code_var.set("")
-        self.filter_specialist_var.set("همه متخصصین")
-        today = datetime.now()
-        self.date1_entry.set_date(today)
-        self.date2_entry.set_date(today)
-        self.clear_entries()
-        self.display_patients()
-
-    def display_patients(self, data=None):
-        for item in self.patient_tree.get_children():
-            self.patient_tree.delete(item)
-
-        rows = data
-        if data is None:
-            try:
-                self.cursor.execute("SELECT id, patient_name, last_name, age, ward, patient_code, specialist, submission_date, submission_time FROM patients ORDER BY id DESC")
-                rows = self.cursor.fetchall()
-            except sqlite3.Error as e:
-                messagebox.showerror("خطای پایگاه داده", f"خطا در بازیابی اطلاعات: {e}")
-                return
-        
-        row_counter = 1
-        for row in rows:
-            db_id = row[0]
-            display_values = row[1:] + (row_counter,)
-            self.patient_tree.insert("", "end", iid=db_id, values=display_values)
-            row_counter += 1
-
-    def edit_patient(self):
-        selected_items = self.patient_tree.selection()
-        if not selected_items:
-            messagebox.showwarning("انتخاب کنید", ".لطفا یک بیمار را برای ویرایش انتخاب کنید")
-            return
-        if len(selected_items) > 1:
-            messagebox.showwarning("انتخاب چندگانه", ".فقط یک بیمار را می‌توان در هر لحظه ویرایش کرد")
-            return
-
-        item_db_id = selected_items[0]
-        self.selected_patient_db_id = item_db_id
-
-        try:
-            self.cursor.execute("SELECT patient_name, last_name, age, ward, patient_code, specialist FROM patients WHERE id=?", (item_db_id,))
-            db_data = self.cursor.fetchone()
-            if not db_data:
-                messagebox.showerror("خطا", ".بیمار مورد نظر در پایگاه داده یافت نشد")
-                return
-
-            self.entries["نام بیمار"].set(db_data[0])
-            self.entries["نام خانوادگی"].set(db_data[1])
-            self.entries["سن"].set(str(db_data[2]))
-            self.entries["بخش"].set(db_data[3])
-            self.entries["کد بیمار"].set(db_data[4])
-            self.specialist_var.set(db_data[5])
-            
-            self.submit_button.config(text="به‌روزرسانی اطلاعات")
-            self.root.title(f"در حال ویرایش بیمار: {db_data[0]} {db_data[1]}")
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در خواندن اطلاعات برای ویرایش: {e}")
-
-    def delete_selected_patients(self):
-        selected_items = self.patient_tree.selection()
-        if not selected_items:
-            messagebox.showwarning("انتخاب کنید", ".لطفا یک یا چند بیمار را برای حذف انتخاب کنید")
-            return
-
-        confirm = messagebox.askyesno("تایید حذف", f"آیا از حذف {len(selected_items)} بیمار منتخب اطمینان دارید؟ این عمل قابل بازگشت نیست.")
-        if confirm:
-            try:
-                ids_to_delete = [(item_id,) for item_id in selected_items]
-                self.cursor.executemany("DELETE FROM patients WHERE id=?", ids_to_delete)
-                self.conn.commit()
-                messagebox.showinfo("موفقیت", ".بیمار(ان) با موفقیت حذف شدند")
-                self.clear_entries()
-                self.display_patients()
-            except sqlite3.Error as e:
-                messagebox.showerror("خطای پایگاه داده", f"خطا در حذف اطلاعات: {e}")
-
-    def filter_patients_by_specialist(self, event=None):
-        selected_specialist = self.filter_specialist_var.get()
-        query = "SELECT * FROM patients"
-        params = []
-        if selected_specialist != "همه متخصصین":
-            query += " WHERE specialist=?"
-            params.append(selected_specialist)
-        query += " ORDER BY id DESC"
-        
-        try:
-            self.cursor.execute(query, params)
-            self.display_patients(self.cursor.fetchall())
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در فیلتر کردن: {e}")
-
-    def filter_patients_by_date_range(self):
-        try:
-            start_date = self.date1_entry.get_date().strftime('%Y-%m-%d')
-            end_date = self.date2_entry.get_date().strftime('%Y-%m-%d')
-            self.cursor.execute("SELECT * FROM patients WHERE submission_date BETWEEN ? AND ? ORDER BY id DESC", (start_date, end_date))
-            self.display_patients(self.cursor.fetchall())
-        except Exception as e:
-            messagebox.showerror("خطای تاریخ", f"خطا در فیلتر تاریخ: {e}")
-
-    def search_patient_by_code(self, event=None):
-        search_term = self.search_code_var.get().strip()
-        if not search_term:
-            self.filter_patients_by_specialist()
-            return
-        try:
-            query = "SELECT * FROM patients WHERE patient_code LIKE ?"
-            params = [f'%{search_term}%']
-            
-            selected_specialist = self.filter_specialist_var.get()
-            if selected_specialist != "همه متخصصین":
-                query += " AND specialist=?"
-                params.append(selected_specialist)
-
-            query += " ORDER BY id DESC"
-            self.cursor.execute(query, params)
-            self.display_patients(self.cursor.fetchall())
-        except sqlite3.Error as e:
-            messagebox.showerror("خطای پایگاه داده", f"خطا در جستجو: {e}")
-
-    def export_to_excel(self):
-        if not self.patient_tree.get_children():
-            messagebox.showwarning("داده‌ای وجود ندارد", ".جدول خالی است. داده‌ای برای خروجی گرفتن وجود ندارد")
-            return
-
-        file_path = filedialog.asksaveasfilename(
-            defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")],
-            title="ذخیره فایل اکسل"
-        )
-        if not file_path:
-            return
-
-        try:
-            workbook = openpyxl.Workbook()
-            sheet = workbook.active
-            sheet.title = "گزارش بیماران"
-            sheet.sheet_view.rightToLeft = True
-
-            headers = [self.patient_tree.heading(col)["text"] for col in self.display_columns_order]
-            sheet.append(headers)
-
-            items_in_order = self.patient_tree.get_children('')
-            for item_id in items_in_order:
-                row_values = self.patient_tree.item(item_id, 'values')
-                sheet.append(list(row_values))
-
-            workbook.save(file_path)
-            messagebox.showinfo("موفقیت", f"اطلاعات با موفقیت در فایل زیر ذخیره شد:{file_path}")
-        except Exception as e:
-            messagebox.showerror("خطا در خروجی", f"خطا در تولید فایل اکسل: {e}")
-
-    def on_closing(self):
-        if self.conn:
-            self.conn.close()
-            logging.info("Database connection closed.")
-        self.root.destroy()
-
-if __name__ == "__main__":
-    root = tk.Tk()
-    app = PatientManagementApp(root)
-    root.protocol("WM_DELETE_WINDOW", app.on_closing)
+import time
+
+# Startup latency (record_startup) is measured from here, before the toolkit and service imports
+STARTUP_BEGAN = time.perf_counter()
+
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import sqlite3
+from datetime import datetime
+from tkcalendar import DateEntry
+import logging
+import itertools
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+from patient_service import (
+    BACKUP_DIR, CHANGE_BATCH_LIMIT, DB_PROFILE, MAX_AGE, METRICS, SEARCH_MATERIALIZE_LIMIT, SEARCH_SUBSTRING_MIN_CHARS,
+    AsOfSource,
+    CachedResultSource, PartitionedSource, PatientPageSource, PatientRepository, PatientValidationError, ServiceError,
+    TaskCancelled, archive_old_records, archived_years, backup_database, backup_due, build_patient_source,
+    connect_database, STORAGE_CLASSIC, has_search_index, migrate_schema, row_matches_term, run_maintenance, search_rank,
+    storage_mode, term_narrows, validate_patient,
+)
+
+# Basic logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SEARCH_DEBOUNCE_MS = 150
+SEARCH_CACHE_SIZE = 32
+MAINTENANCE_INTERVAL_MS = 15 * 60 * 1000
+CHANGE_POLL_INTERVAL_MS = 2000
+DIAGNOSTICS_REFRESH_MS = 2000
+# When set, the latency metrics are written here on exit (.prom/.txt = Prometheus text, otherwise JSON)
+METRICS_FILE = os.environ.get("PMS_METRICS_FILE")
+
+
+def job_name(func, key=None):
+    # Metric name for a worker job: its key when it has one, else where it was defined
+    if key is not None:
+        return key
+    return getattr(func, "__qualname__", "job").replace(".<locals>", "")
+
+
+class DatabaseWorker:
+    """Runs SQLite work on a dedicated thread that owns its own connection.
+
+    Jobs are callables taking the worker connection. Their results are handed
+    back to Tk by an ``after()`` polling loop, so success/error callbacks always
+    run on the main thread. Jobs submitted under the same ``key`` supersede each
+    other: queued stale jobs are skipped, a running one is interrupted, and
+    stale results are dropped.
+    """
+
+    def __init__(self, root, db_name, on_busy_change=None, poll_interval=25, profile=DB_PROFILE):
+        self.root = root
+        self.db_name = db_name
+        self.profile = profile
+        self.on_busy_change = on_busy_change
+        self.poll_interval = poll_interval
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.notifications = queue.Queue()
+        self.latest_by_key = {}
+        self.job_ids = itertools.count(1)
+        self.pending = 0
+        self.busy = False
+        self.running_job = None
+        self.lock = threading.Lock()
+        self.tasks = {}  # running start_task threads -> their cancel events
+        self.conn = None
+        self.thread = threading.Thread(target=self._run, name="db-worker", daemon=True)
+        self.thread.start()
+        self.poll_id = self.root.after(self.poll_interval, self._poll)
+
+    def submit(self, func, on_success=None, on_error=None, key=None):
+        job_id = next(self.job_ids)
+        if key is not None:
+            self._supersede(key, job_id)
+        self.pending += 1
+        self._set_busy(True)
+        self.jobs.put((job_id, key, func, on_success, on_error))
+        return job_id
+
+    def start_task(self, func, on_success=None, on_error=None, on_progress=None):
+        """Run a long job (export, import) on its own thread and connection.
+
+        ``func(conn, progress, cancel_event)`` must check ``cancel_event``
+        periodically; values passed to ``progress`` reach ``on_progress`` on the
+        Tk thread. Returns the event that cancels the task.
+        """
+        cancel_event = threading.Event()
+        job = (next(self.job_ids), None, func, on_success, on_error)
+
+        def progress(value):
+            if on_progress:
+                self.notifications.put((on_progress, value))
+
+        def run():
+            conn = None
+            try:
+                conn = connect_database(self.db_name, self.profile)
+                with METRICS.timed("job", job_name(func)):
+                    outcome = (True, func(conn, progress, cancel_event))
+            except Exception as e:
+                outcome = (False, e)
+            finally:
+                if conn is not None:
+                    conn.close()
+                with self.lock:
+                    self.tasks.pop(threading.current_thread(), None)
+            self.results.put((job,) + outcome)
+
+        self.pending += 1
+        self._set_busy(True)
+        thread = threading.Thread(target=run, name="db-task", daemon=True)
+        with self.lock:
+            self.tasks[thread] = cancel_event
+        thread.start()
+        return cancel_event
+
+    def cancel(self, key):
+        # Drop whatever is queued or running under `key` without starting anything new
+        self._supersede(key, None)
+
+    def _supersede(self, key, job_id):
+        with self.lock:
+            superseded = self.latest_by_key.get(key)
+            self.latest_by_key[key] = job_id
+            if superseded is not None and self.running_job == superseded and self.conn is not None:
+                self.conn.interrupt()
+
+    def _set_busy(self, busy):
+        if busy != self.busy:
+            self.busy = busy
+            if self.on_busy_change:
+                self.on_busy_change(busy)
+
+    def _is_stale(self, job_id, key):
+        return key is not None and self.latest_by_key.get(key) != job_id
+
+    def _run(self):
+        try:
+            self.conn = connect_database(self.db_name, self.profile)
+        except sqlite3.Error as e:
+            self.conn = None
+            connect_error = e
+        else:
+            connect_error = None
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job_id, key, func = job[:3]
+            with self.lock:
+                if self._is_stale(job_id, key):
+                    self.results.put((job, None, None))
+                    continue
+                self.running_job = job_id
+            started = time.perf_counter()
+            try:
+                if connect_error is not None:
+                    raise connect_error
+                outcome = (True, func(self.conn))
+            except Exception as e:
+                if self.conn is not None and self.conn.in_transaction:
+                    self.conn.rollback()
+                outcome = (False, e)
+            finally:
+                with self.lock:
+                    self.running_job = None
+                METRICS.record("job", job_name(func, key), (time.perf_counter() - started) * 1000)
+            self.results.put((job,) + outcome)
+        if self.conn is not None:
+            try:
+                self.conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logging.warning(f"PRAGMA optimize on close failed: {e}")
+            self.conn.close()
+            logging.info("Database connection closed.")
+
+    def _poll(self):
+        try:
+            while True:
+                try:
+                    callback, value = self.notifications.get_nowait()
+                except queue.Empty:
+                    break
+                self._run_callback(callback, value)
+            while True:
+                try:
+                    job, ok, value = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                self.pending -= 1
+                job_id, key, func, on_success, on_error = job
+                if ok is None or self._is_stale(job_id, key):
+                    continue
+                if ok:
+                    if on_success:
+                        self._run_callback(on_success, value)
+                elif on_error:
+                    self._run_callback(on_error, value)
+                else:
+                    logging.error(f"Background database job failed: {value}")
+            if self.pending == 0:
+                self._set_busy(False)
+        finally:
+            # However a handler fails, later results and change notifications must still be delivered
+            self.poll_id = self.root.after(self.poll_interval, self._poll)
+
+    def _run_callback(self, callback, value):
+        try:
+            callback(value)
+        except Exception:
+            logging.exception(f"Handler {job_name(callback)} failed")
+
+    def close(self):
+        self.root.after_cancel(self.poll_id)
+        self.jobs.put(None)
+        # Cancel running tasks and let them clean up (an import rolls back, a backup removes its partial copy)
+        with self.lock:
+            tasks = list(self.tasks.items())
+        for thread, cancel_event in tasks:
+            cancel_event.set()
+        for thread, _ in tasks:
+            thread.join(timeout=5)
+        self.thread.join(timeout=5)
+
+
+class SearchController:
+    """As-you-type patient search.
+
+    Keystrokes are debounced; when the new term contains the previous one and
+    the previous result set was small enough to be held in memory, it is
+    narrowed in Python instead of querying again. Recent complete result sets
+    are kept in an LRU cache keyed by the term and the other active criteria,
+    and dropped whenever patients are written. Typing a term shorter than
+    SEARCH_SUBSTRING_MIN_CHARS only shows what can be answered from memory;
+    it goes to the database once the user submits it with Enter or a button.
+    """
+
+    def __init__(self, app, debounce_ms=SEARCH_DEBOUNCE_MS, cache_size=SEARCH_CACHE_SIZE,
+                 materialize_limit=SEARCH_MATERIALIZE_LIMIT):
+        self.app = app
+        self.debounce_ms = debounce_ms
+        self.cache_size = cache_size
+        self.materialize_limit = materialize_limit
+        self.cache = OrderedDict()
+        self.last_complete = None  # (term, criteria, rows) of the last result held entirely in memory
+        self.pending_id = None
+
+    def schedule(self, *args):
+        self.cancel_pending()
+        self.pending_id = self.app.root.after(self.debounce_ms, self.search_now, False)
+
+    def cancel_pending(self):
+        if self.pending_id is not None:
+            self.app.root.after_cancel(self.pending_id)
+            self.pending_id = None
+
+    def invalidate(self):
+        self.cache.clear()
+        self.last_complete = None
+
+    def _remember(self, term, criteria, rows):
+        key = (term,) + criteria
+        self.cache[key] = rows
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        self.last_complete = (term, criteria, rows)
+
+    def search_now(self, submitted=True):
+        # submitted: Enter, a button or a reload asked for this search, rather than a keystroke
+        self.pending_id = None
+        term = self.app.search_code_var.get().strip()
+        criteria = self.app.search_criteria()
+        if criteria is None:
+            return
+        if not term:
+            self.app.display_patients(self.app.build_filter_source(criteria))
+            return
+
+        rows = self.cache.get((term,) + criteria)
+        if rows is not None:
+            self.cache.move_to_end((term,) + criteria)
+            self.last_complete = (term, criteria, rows)
+            self.app.show_page_source(CachedResultSource(rows, self.app.build_filter_source(criteria, term), term))
+            return
+
+        if self.last_complete is not None:
+            previous_term, previous_criteria, previous_rows = self.last_complete
+            if previous_criteria == criteria and term_narrows(previous_term, term):
+                rows = [row for row in previous_rows if row_matches_term(row, term)]
+                rows.sort(key=lambda row: (search_rank(row, term), -row[0]))
+                self._remember(term, criteria, rows)
+                self.app.show_page_source(CachedResultSource(rows, self.app.build_filter_source(criteria, term), term))
+                return
+
+        if not submitted and len(term) < SEARCH_SUBSTRING_MIN_CHARS:
+            # One or two typed letters match thousands of patients; wait for more, or for Enter
+            return
+
+        source = self.app.build_filter_source(criteria, term)
+        started = time.perf_counter()
+
+        def on_success(result):
+            METRICS.record("ui", "search", (time.perf_counter() - started) * 1000)
+            rows, opened = result
+            if rows is not None:
+                self._remember(term, criteria, rows)
+                self.app.show_page_source(CachedResultSource(rows, source, term))
+            else:
+                self.last_complete = None
+                source.total, loaded = opened
+                source.store_pages(loaded)
+                self.app.show_page_source(source)
+
+        self.app.db_worker.submit(source.head_or_open_job(self.materialize_limit), on_success,
+                                  lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در جستجو: {e}"),
+                                  key="grid")
+
+
+class DiagnosticsWindow:
+    """Latency percentiles and slow queries from METRICS, refreshed while the window is open."""
+
+    def __init__(self, root):
+        self.window = tk.Toplevel(root)
+        self.window.title("عیب‌یابی کارایی")
+        self.window.geometry("1100x600")
+
+        columns = ("max", "p99", "p95", "p50", "count", "name", "kind")
+        titles = ["بیشینه (ms)", "p99 (ms)", "p95 (ms)", "p50 (ms)", "تعداد", "نام", "نوع"]
+        self.tree = ttk.Treeview(self.window, columns=columns, show="headings", height=15)
+        for column, title in zip(columns, titles):
+            self.tree.heading(column, text=title)
+            self.tree.column(column, width=90 if column not in ("name", "kind") else 60, anchor="center")
+        self.tree.column("name", width=520, anchor="e")
+        self.tree.pack(fill="both", expand=True, padx=5, pady=5)
+
+        ttk.Label(self.window, text=f":کوئری‌های کندتر از {METRICS.slow_query_ms:.0f} میلی‌ثانیه").pack(fill="x", padx=5)
+        self.slow_text = tk.Text(self.window, height=10, wrap="word", font=('Courier', 9))
+        self.slow_text.pack(fill="both", expand=True, padx=5, pady=5)
+
+        button_frame = ttk.Frame(self.window)
+        button_frame.pack(fill="x", padx=5, pady=5)
+        ttk.Button(button_frame, text="ذخیره JSON", command=lambda: self.save(".json")).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="ذخیره Prometheus", command=lambda: self.save(".prom")).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="پاک کردن آمار", command=self.reset).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="به‌روزرسانی", command=self.refresh).pack(side="right", padx=5)
+
+        self.refresh_id = None
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.refresh()
+
+    def refresh(self):
+        if self.refresh_id is not None:
+            self.window.after_cancel(self.refresh_id)
+        snapshot = METRICS.snapshot()
+        self.tree.delete(*self.tree.get_children())
+        for entry in snapshot["series"]:
+            self.tree.insert("", "end", values=(f"{entry['max_ms']:.1f}", f"{entry['p99_ms']:.1f}", f"{entry['p95_ms']:.1f}",
+                                                f"{entry['p50_ms']:.1f}", entry["count"], entry["name"], entry["kind"]))
+        self.slow_text.delete("1.0", "end")
+        for query in reversed(snapshot["slow_queries"]):
+            self.slow_text.insert("end", f"[{query['at']}] {query['ms']:.0f} ms  {query['statement']}\n")
+            for step in query["plan"]:
+                self.slow_text.insert("end", f"    {step}\n")
+        self.refresh_id = self.window.after(DIAGNOSTICS_REFRESH_MS, self.refresh)
+
+    def save(self, extension):
+        file_path = filedialog.asksaveasfilename(parent=self.window, defaultextension=extension,
+                                                 filetypes=[("Metrics", f"*{extension}"), ("All files", "*.*")])
+        if not file_path:
+            return
+        try:
+            METRICS.dump(file_path)
+        except OSError as e:
+            messagebox.showerror("خطا", f"خطا در ذخیره آمار: {e}", parent=self.window)
+
+    def reset(self):
+        METRICS.reset()
+        self.refresh()
+
+    def close(self):
+        if self.refresh_id is not None:
+            self.window.after_cancel(self.refresh_id)
+        self.window.destroy()
+
+
+class StatisticsWindow:
+    """Admissions per period, specialist, ward and age decade over a date range, from the patient_stats summary."""
+
+    def __init__(self, root, db_worker):
+        self.db_worker = db_worker
+        self.window = tk.Toplevel(root)
+        self.window.title("آمار پذیرش بیماران")
+        self.window.geometry("900x600")
+
+        range_frame = ttk.Frame(self.window, padding="5")
+        range_frame.pack(fill="x")
+        ttk.Label(range_frame, text=":از تاریخ", font=('Tahoma', 10)).pack(side="right", padx=5)
+        self.date1_entry = DateEntry(range_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
+        self.date1_entry.set_date(datetime.now().date().replace(month=1, day=1))
+        self.date1_entry.pack(side="right", padx=5)
+        ttk.Label(range_frame, text=":تا تاریخ", font=('Tahoma', 10)).pack(side="right", padx=5)
+        self.date2_entry = DateEntry(range_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
+        self.date2_entry.pack(side="right", padx=5)
+        ttk.Button(range_frame, text="نمایش آمار", command=self.refresh).pack(side="right", padx=5)
+        ttk.Button(range_frame, text="کل دوره", command=lambda: self.refresh(whole_range=True)).pack(side="right", padx=5)
+        self.total_label = ttk.Label(range_frame, text="", font=('Tahoma', 10, 'bold'))
+        self.total_label.pack(side="left", padx=5)
+
+        notebook = ttk.Notebook(self.window)
+        notebook.pack(fill="both", expand=True, padx=5, pady=5)
+        self.trees = {}
+        for key, title, heading in (("by_period", "روند پذیرش", "دوره"), ("by_specialist", "به تفکیک پزشک", "پزشک متخصص"),
+                                    ("by_ward", "به تفکیک بخش", "بخش"), ("by_age", "به تفکیک سن", "گروه سنی")):
+            frame = ttk.Frame(notebook)
+            notebook.add(frame, text=title)
+            tree = ttk.Treeview(frame, columns=("bar", "share", "admissions", "key"), show="headings")
+            for column, text, width in (("bar", "", 360), ("share", "درصد", 70), ("admissions", "تعداد پذیرش", 100),
+                                        ("key", heading, 250)):
+                tree.heading(column, text=text)
+                tree.column(column, width=width, anchor="e" if column in ("bar", "key") else "center")
+            scrollbar = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+            tree.configure(yscrollcommand=scrollbar.set)
+            scrollbar.pack(side="left", fill="y")
+            tree.pack(side="right", fill="both", expand=True)
+            self.trees[key] = tree
+
+        self.whole_range = False
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.refresh()
+
+    def refresh(self, whole_range=None):
+        if whole_range is not None:
+            self.whole_range = whole_range
+        if self.whole_range:
+            date_from = date_to = None
+        else:
+            date_from = self.date1_entry.get_date().strftime('%Y-%m-%d')
+            date_to = self.date2_entry.get_date().strftime('%Y-%m-%d')
+            if date_from > date_to:
+                messagebox.showerror("خطای تاریخ", ".تاریخ شروع بعد از تاریخ پایان است", parent=self.window)
+                return
+        self.db_worker.submit(lambda conn: PatientRepository(conn).admission_stats(date_from, date_to), self.show,
+                              lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در خواندن آمار: {e}",
+                                                             parent=self.window),
+                              key="statistics")
+
+    def show(self, stats):
+        if not self.window.winfo_exists():
+            return
+        total = stats["total"]
+        self.total_label.config(text=f"مجموع پذیرش: {total:,}")
+        for key, tree in self.trees.items():
+            tree.delete(*tree.get_children())
+            rows = stats[key]
+            largest = max((admissions for _, admissions in rows), default=0)
+            for bucket, admissions in rows:
+                label = f"{bucket}-{bucket + 9}" if key == "by_age" else bucket
+                tree.insert("", "end", values=("█" * round(40 * admissions / largest), f"{100 * admissions / total:.1f}",
+                                               f"{admissions:,}", label))
+
+    def close(self):
+        self.db_worker.cancel("statistics")
+        self.window.destroy()
+
+
+class HistoryWindow:
+    """Deleted patients with restore, the audit trail of one patient, and the patient list as of a past day."""
+
+    OPERATIONS = {"I": "ثبت", "U": "ویرایش", "D": "حذف", "R": "بازیابی"}
+
+    def __init__(self, app):
+        self.app = app
+        self.db_worker = app.db_worker
+        self.window = tk.Toplevel(app.root)
+        self.window.title("تاریخچه تغییرات و بازیابی")
+        self.window.geometry("1000x600")
+
+        as_of_frame = ttk.Frame(self.window, padding="5")
+        as_of_frame.pack(fill="x")
+        ttk.Label(as_of_frame, text=":وضعیت بیماران در پایان روز", font=('Tahoma', 10)).pack(side="right", padx=5)
+        self.as_of_entry = DateEntry(as_of_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
+        self.as_of_entry.pack(side="right", padx=5)
+        ttk.Button(as_of_frame, text="نمایش در جدول اصلی", command=self.show_as_of).pack(side="right", padx=5)
+
+        notebook = ttk.Notebook(self.window)
+        notebook.pack(fill="both", expand=True, padx=5, pady=5)
+        deleted_frame = ttk.Frame(notebook)
+        notebook.add(deleted_frame, text="بیماران حذف‌شده")
+        buttons = ttk.Frame(deleted_frame)
+        buttons.pack(side="bottom", fill="x", pady=5)
+        ttk.Button(buttons, text="بازیابی بیمار(ان) منتخب", command=self.restore_selected).pack(side="right", padx=5)
+        ttk.Button(buttons, text="به‌روزرسانی", command=self.refresh_deleted).pack(side="right", padx=5)
+        self.deleted_tree = self.make_tree(deleted_frame, (("by", "کاربر", 170), ("at", "زمان حذف", 150),
+                                                           ("specialist", "پزشک متخصص", 200), ("code", "کد بیمار", 100),
+                                                           ("last_name", "نام خانوادگی", 140), ("name", "نام بیمار", 140)))
+
+        history_frame = ttk.Frame(notebook)
+        notebook.add(history_frame, text="تاریخچه بیمار منتخب")
+        buttons = ttk.Frame(history_frame)
+        buttons.pack(side="bottom", fill="x", pady=5)
+        ttk.Button(buttons, text="نمایش تاریخچه بیمار منتخب جدول اصلی", command=self.refresh_history).pack(side="right", padx=5)
+        self.history_label = ttk.Label(buttons, text="", font=('Tahoma', 10, 'bold'))
+        self.history_label.pack(side="left", padx=5)
+        self.history_tree = self.make_tree(history_frame, (("before", "مقادیر پیش از تغییر", 520), ("by", "کاربر", 170),
+                                                           ("at", "زمان", 150), ("op", "عمل", 80)))
+
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.refresh_deleted()
+
+    def make_tree(self, parent, columns):
+        tree = ttk.Treeview(parent, columns=[column for column, _, _ in columns], show="headings")
+        for column, text, width in columns:
+            tree.heading(column, text=text)
+            tree.column(column, width=width, anchor="e")
+        scrollbar = ttk.Scrollbar(parent, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="left", fill="y")
+        tree.pack(side="right", fill="both", expand=True)
+        return tree
+
+    def show_as_of(self):
+        self.app.show_as_of(self.as_of_entry.get_date().strftime('%Y-%m-%d') + " 23:59:59")
+
+    def refresh_deleted(self):
+        self.db_worker.submit(lambda conn: PatientRepository(conn).deleted_patients(), self.show_deleted,
+                              lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در خواندن تاریخچه: {e}",
+                                                             parent=self.window),
+                              key="history-deleted")
+
+    def show_deleted(self, rows):
+        if not self.window.winfo_exists():
+            return
+        self.deleted_tree.delete(*self.deleted_tree.get_children())
+        for row in rows:
+            self.deleted_tree.insert("", "end", iid=str(row[0]), values=(row[10], row[9], row[6], row[5], row[2], row[1]))
+
+    def restore_selected(self):
+        ids = [int(item) for item in self.deleted_tree.selection()]
+        if not ids:
+            messagebox.showwarning("انتخاب کنید", ".لطفا یک یا چند بیمار حذف‌شده را انتخاب کنید", parent=self.window)
+            return
+
+        def write(conn):
+            return PatientRepository(conn).restore_patients(ids)
+
+        def on_success():
+            messagebox.showinfo("موفقیت", ".بیمار(ان) منتخب بازیابی شدند", parent=self.window)
+            self.refresh_deleted()
+
+        # Passing the ids lets a historical view, which already lists them, keep its count
+        self.app.submit_patient_write(write, ids, on_success, self.app.db_error_handler("خطا در بازیابی بیماران"))
+
+    def refresh_history(self):
+        if len(self.app.selected_ids) != 1:
+            messagebox.showwarning("انتخاب کنید", ".لطفا یک بیمار را در جدول اصلی انتخاب کنید", parent=self.window)
+            return
+        patient_id = next(iter(self.app.selected_ids))
+
+        def on_success(entries):
+            if not self.window.winfo_exists():
+                return
+            self.history_label.config(text=f"شناسه بیمار: {patient_id}")
+            self.history_tree.delete(*self.history_tree.get_children())
+            for _, op, changed_at, changed_by, *before in reversed(entries):
+                text = "" if before[0] is None else f"{before[0]} {before[1]} | سن {before[2]} | {before[3]} | {before[4]} | {before[5]}"
+                self.history_tree.insert("", "end", values=(text, changed_by, changed_at, self.OPERATIONS.get(op, op)))
+
+        self.db_worker.submit(lambda conn: PatientRepository(conn).patient_history(patient_id), on_success,
+                              lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در خواندن تاریخچه: {e}",
+                                                             parent=self.window),
+                              key="history-patient")
+
+    def close(self):
+        self.db_worker.cancel("history-deleted")
+        self.db_worker.cancel("history-patient")
+        self.window.destroy()
+
+
+class PatientManagementApp:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("سامانه مدیریت بیماران")
+        self.root.geometry("1400x800")
+        self.root.minsize(1350, 700)
+        self.root.config(bg="#f0f0f0")
+        
+        # Style configuration
+        style = ttk.Style(self.root)
+        style.configure("TLabel", font=('Tahoma', 10), background="#f0f0f0", anchor="e")
+        style.configure("TButton", font=('Tahoma', 10, 'bold'))
+        style.configure("TEntry", font=('Tahoma', 10))
+        style.configure("TCombobox", font=('Tahoma', 10))
+        style.configure("Treeview.Heading", font=('Tahoma', 11, 'bold'))
+        style.configure("Treeview", rowheight=25, font=('Tahoma', 10))
+        style.configure("TLabelframe.Label", font=('Tahoma', 11, 'bold'))
+
+        self.db_name = 'hospital_patients.db'
+        self.db_worker = None
+
+        # Virtual grid state: only `visible_rows` rows starting at `view_offset` live in the Treeview
+        self.page_source = None
+        self.view_offset = 0
+        self.visible_rows = 20
+        self.selected_ids = set()
+        self.rendered_rows = {}  # iid -> values of the items currently in patient_tree
+        self.selected_patient_db_id = None
+        self.specialists = []
+        self.all_specialists = []
+        self.search_index_available = False
+        self.storage_mode = STORAGE_CLASSIC
+        self.last_change_seq = 0
+        self.search_controller = SearchController(self)
+        self.task_cancel_event = None
+        self.archive_cancel_event = None
+        self.diagnostics_window = None
+        self.statistics_window = None
+        self.history_window = None
+        self.archive_years = []
+        self.first_page_shown = False
+
+        # Nothing below waits for the database: the worker opens it and loads the first page
+        # while Tk maps the window, and the rows are filled in when they arrive
+        self.create_widgets()
+        self.connect_db()
+        self.refresh_specialists()
+        self.refresh_wards()
+        self.display_patients()
+        self.root.after_idle(self.record_startup, "window_shown")
+
+    def record_startup(self, milestone):
+        elapsed_ms = (time.perf_counter() - STARTUP_BEGAN) * 1000
+        METRICS.record("ui", f"startup_{milestone}", elapsed_ms)
+        logging.info(f"Startup: {milestone} after {elapsed_ms:.0f} ms.")
+
+    def connect_db(self):
+        # All SQLite access goes through the worker thread; schema setup is simply its first job
+        self.db_worker = DatabaseWorker(self.root, self.db_name, on_busy_change=self.set_busy_indicator)
+        self.db_worker.submit(self.initialize_schema, self.on_schema_ready, self.on_connect_error)
+        self.root.after(MAINTENANCE_INTERVAL_MS, self.schedule_db_maintenance)
+        self.root.after(MAINTENANCE_INTERVAL_MS, self.schedule_backup)
+
+    def poll_changes(self):
+        # Picks up writes from every terminal sharing the database (this one included)
+        source = self.page_source
+        last_seq = self.last_change_seq
+
+        def job(conn):
+            newest_seq, patient_ids, specialists_changed = PatientRepository(conn).changes_since(last_seq, CHANGE_BATCH_LIMIT)
+            if patient_ids is None:
+                # Too many changes, or older entries were pruned before we saw them: reload the view
+                return newest_seq, True, set(), specialists_changed, None, archived_years(conn)
+            refreshed = source.refresh_job(patient_ids)(conn) if source is not None and patient_ids else None
+            return newest_seq, False, patient_ids, specialists_changed, refreshed, archived_years(conn)
+
+        def on_success(result):
+            newest_seq, reload, patient_ids, specialists_changed, refreshed, archives = result
+            rebuild = archives != self.archive_years
+            if rebuild:
+                # Patients were moved to archive files: date filters and searches have to be built again to read them
+                self.archive_years = archives
+                reload = True
+            if patient_ids and source is not self.page_source:
+                # The view changed while we were reading; re-read the same entries against the new one
+                return
+            self.last_change_seq = newest_seq
+            if specialists_changed:
+                self.refresh_specialists()
+            if reload or patient_ids:
+                self.search_controller.invalidate()
+                if self.statistics_window is not None and self.statistics_window.window.winfo_exists():
+                    self.statistics_window.refresh()
+                if self.history_window is not None and self.history_window.window.winfo_exists():
+                    self.history_window.refresh_deleted()
+            if reload:
+                self.reload_current_view(rebuild)
+            elif refreshed is not None:
+                self.apply_patient_changes(patient_ids, *refreshed)
+
+        def on_error(e):
+            logging.warning(f"Polling for changes failed: {e}")
+
+        self.db_worker.submit(job, on_success, on_error, key="changes")
+        self.root.after(CHANGE_POLL_INTERVAL_MS, self.poll_changes)
+
+    def apply_patient_changes(self, changed_ids, matching, total):
+        source = self.page_source
+        if not source.apply_changes(changed_ids, matching, total):
+            self.reload_current_view()
+            return
+        self.selected_ids -= set(changed_ids) - {row[0] for row in matching}
+        self.render_tree_window()
+
+    def submit_patient_write(self, write, ids, on_success, on_error, scroll_to_top=False):
+        # Writes from this terminal patch the current view in place, keeping its filter,
+        # instead of reloading it; poll_changes later sees the same change_log entries again
+        source = self.page_source
+        job = write if source is None else source.mutation_job(write, ids)
+
+        def on_written(result):
+            self.search_controller.invalidate()
+            if source is None:
+                self.display_patients()
+            elif source is self.page_source:
+                changed_ids, matching, delta = result
+                if scroll_to_top:
+                    self.view_offset = 0
+                self.apply_patient_changes(changed_ids, matching, source.total + delta)
+            on_success()
+
+        self.db_worker.submit(job, on_written, on_error)
+
+    def reload_current_view(self, rebuild=False):
+        # rebuild: the filter fields are turned into a source again instead of reopening the current one
+        source = self.page_source
+        if rebuild and isinstance(source, AsOfSource):
+            self.display_patients(AsOfSource(source.moment, self.archive_years), keep_position=True)
+        elif isinstance(source, CachedResultSource) or (source is not None and source.rank_sql) or (
+                rebuild and source is not None):
+            self.search_controller.search_now()
+        elif source is not None:
+            self.display_patients(source.reopened(), keep_position=True)
+
+    def schedule_db_maintenance(self):
+        self.db_worker.submit(run_maintenance, on_error=lambda e: logging.warning(f"Database maintenance failed: {e}"),
+                              key="maintenance")
+        # Moving old records to the archive files can take minutes, so it gets its own thread and connection
+        # instead of holding up the grid's worker. It leaves the task slot to exports, imports and backups
+        # (closing the app still cancels it) and is skipped while the previous run is going.
+        if self.archive_cancel_event is None:
+            def on_success(moved):
+                # Patients moved show up through poll_changes, which sees the new archived years and rebuilds the view
+                self.archive_cancel_event = None
+
+            def on_error(e):
+                self.archive_cancel_event = None
+                if not isinstance(e, TaskCancelled):
+                    logging.warning(f"Archiving old records failed: {e}")
+
+            self.archive_cancel_event = self.db_worker.start_task(
+                lambda conn, progress, cancel_event: archive_old_records(conn, cancel_event), on_success, on_error)
+        self.root.after(MAINTENANCE_INTERVAL_MS, self.schedule_db_maintenance)
+
+    def schedule_backup(self):
+        # Like an export, the backup gets its own thread and connection, so the grid's worker is never held up.
+        # It shares their one task slot and cancel button; while another task runs, the next interval retries.
+        if BACKUP_DIR and self.task_cancel_event is None and backup_due(BACKUP_DIR, self.db_name):
+            def on_progress(value):
+                copied, total = value
+                self.status_var.set(f"پشتیبان‌گیری خودکار: {copied * 100 // max(total, 1)}٪")
+
+            def finish():
+                self.task_cancel_event = None
+                self.cancel_task_button.config(state="disabled")
+                self.status_var.set("")
+
+            def on_success(path):
+                finish()
+                logging.info(f"Scheduled backup written to {path}.")
+
+            def on_error(e):
+                finish()
+                if isinstance(e, TaskCancelled):
+                    logging.info("Scheduled backup cancelled.")
+                else:
+                    logging.warning(f"Scheduled backup failed: {e}")
+
+            self.task_cancel_event = self.db_worker.start_task(
+                lambda conn, progress, cancel_event: backup_database(conn, BACKUP_DIR, progress=progress,
+                                                                     cancel_event=cancel_event),
+                on_success, on_error, on_progress)
+            self.cancel_task_button.config(state="normal")
+        self.root.after(MAINTENANCE_INTERVAL_MS, self.schedule_backup)
+
+    def on_connect_error(self, e):
+        messagebox.showerror("خطای پایگاه داده", f"خطا در اتصال به پایگاه داده: {e}")
+        self.root.destroy()
+
+    def initialize_schema(self, conn):
+        # Runs on the worker thread, so it only reads; on_schema_ready stores the results on the Tk thread
+        logging.info("Database connection successful.")
+        migrate_schema(conn)
+        conn.execute("PRAGMA foreign_keys=ON")
+        return (has_search_index(conn), storage_mode(conn), PatientRepository(conn).latest_change_seq(),
+                archived_years(conn))
+
+    def on_schema_ready(self, result):
+        self.search_index_available, self.storage_mode, self.last_change_seq, self.archive_years = result
+        # Polling starts from the sequence read here, not from 0 while a long migration is still running
+        self.root.after(CHANGE_POLL_INTERVAL_MS, self.poll_changes)
+
+    def db_error_handler(self, message):
+        # Rule violations from the service layer are warnings; anything else is a database failure
+        def on_error(e):
+            if isinstance(e, ServiceError):
+                messagebox.showwarning(e.title, str(e))
+            else:
+                messagebox.showerror("خطای پایگاه داده", f"{message}: {e}")
+        return on_error
+
+    def refresh_specialists(self):
+        self.db_worker.submit(lambda conn: PatientRepository(conn).get_specialists(), self.show_specialists,
+                              lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در دریافت متخصصین: {e}"),
+                              key="specialists")
+
+    def show_specialists(self, lists):
+        active, all_specialists = lists
+        if (active, all_specialists) == (self.specialists, self.all_specialists):
+            return
+        self.specialists, self.all_specialists = active, all_specialists
+        self.specialist_combo['values'] = self.specialists
+        self.specialist_combo['height'] = max(1, len(self.specialists))
+        if self.specialist_var.get() not in self.specialists:
+            self.specialist_var.set(self.specialists[0] if self.specialists else "")
+        self.filter_specialist_combo['values'] = ["همه متخصصین"] + all_specialists
+        self.filter_specialist_combo['height'] = len(all_specialists) + 1
+
+    def set_busy_indicator(self, busy):
+        if busy:
+            self.status_var.set("در حال بارگذاری...")
+            self.progress_bar.start(10)
+        else:
+            self.status_var.set("")
+            self.progress_bar.stop()
+
+    def create_widgets(self):
+        main_frame = ttk.Frame(self.root, padding="10")
+        main_frame.pack(fill="both", expand=True)
+
+        # --- Input Frame ---
+        input_frame = ttk.LabelFrame(main_frame, text="ثبت و ویرایش اطلاعات بیمار", padding="10", labelanchor="ne")
+        input_frame.pack(fill="x", pady=5)
+        for i in range(6): input_frame.grid_columnconfigure(i, weight=1)
+
+        labels_texts = [":نام بیمار", ":نام خانوادگی", ":سن", ":بخش", ":کد بیمار", ":پزشک متخصص"]
+        self.entries = {}
+        
+        ttk.Label(input_frame, text=labels_texts[0], anchor="e").grid(row=0, column=5, sticky="e", padx=5, pady=5)
+        self.entries["نام بیمار"] = tk.StringVar()
+        ttk.Entry(input_frame, textvariable=self.entries["نام بیمار"], justify='right').grid(row=0, column=4, sticky="ew", padx=5, pady=5)
+        
+        ttk.Label(input_frame, text=labels_texts[1], anchor="e").grid(row=0, column=3, sticky="e", padx=5, pady=5)
+        self.entries["نام خانوادگی"] = tk.StringVar()
+        ttk.Entry(input_frame, textvariable=self.entries["نام خانوادگی"], justify='right').grid(row=0, column=2, sticky="ew", padx=5, pady=5)
+        
+        ttk.Label(input_frame, text=labels_texts[2], anchor="e").grid(row=0, column=1, sticky="e", padx=5, pady=5)
+        self.entries["سن"] = tk.StringVar()
+        ttk.Entry(input_frame, textvariable=self.entries["سن"], justify='right', width=10).grid(row=0, column=0, sticky="ew", padx=5, pady=5)
+
+        ttk.Label(input_frame, text=labels_texts[3], anchor="e").grid(row=1, column=5, sticky="e", padx=5, pady=5)
+        self.entries["بخش"] = tk.StringVar()
+        ttk.Entry(input_frame, textvariable=self.entries["بخش"], justify='right').grid(row=1, column=4, sticky="ew", padx=5, pady=5)
+
+        ttk.Label(input_frame, text=labels_texts[4], anchor="e").grid(row=1, column=3, sticky="e", padx=5, pady=5)
+        self.entries["کد بیمار"] = tk.StringVar()
+        ttk.Entry(input_frame, textvariable=self.entries["کد بیمار"], justify='right').grid(row=1, column=2, sticky="ew", padx=5, pady=5)
+
+        ttk.Label(input_frame, text=labels_texts[5], anchor="e").grid(row=2, column=5, sticky="e", padx=5, pady=5)
+        # Values are filled in by refresh_specialists() once the worker has read them
+        self.specialist_var = tk.StringVar()
+        self.specialist_combo = ttk.Combobox(input_frame, textvariable=self.specialist_var, values=self.specialists,
+                                            state="readonly", justify='right')
+        self.specialist_combo.grid(row=2, column=2, columnspan=3, sticky="ew", padx=5, pady=5)
+        
+        self.submit_button = ttk.Button(input_frame, text="ثبت اطلاعات", command=self.add_patient)
+        self.submit_button.grid(row=2, column=0, columnspan=2, sticky="ew", padx=5, pady=10)
+
+        # --- Specialist Management Frame ---
+        specialist_frame = ttk.LabelFrame(main_frame, text="مدیریت پزشکان ویزیت‌کننده", padding="10", labelanchor="ne")
+        specialist_frame.pack(fill="x", pady=5)
+        for i in range(6): specialist_frame.grid_columnconfigure(i, weight=1)
+
+        ttk.Label(specialist_frame, text=":نام پزشک", anchor="e").grid(row=0, column=5, sticky="e", padx=5, pady=5)
+        self.new_specialist_var = tk.StringVar()
+        ttk.Entry(specialist_frame, textvariable=self.new_specialist_var, justify='right').grid(row=0, column=4, sticky="ew", padx=5, pady=5)
+
+        ttk.Button(specialist_frame, text="اضافه کردن پزشک", command=self.add_specialist).grid(row=0, column=2, columnspan=2, sticky="ew", padx=5, pady=5)
+        ttk.Button(specialist_frame, text="حذف پزشک", command=self.delete_specialist).grid(row=0, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+
+        # --- Filter Frame ---
+        filter_frame = ttk.LabelFrame(main_frame, text="جستجو و فیلتر", padding="10", labelanchor="ne")
+        filter_frame.pack(fill="x", pady=10)
+        for i in range(8): filter_frame.grid_columnconfigure(i, weight=1)
+
+        ttk.Label(filter_frame, text=":فیلتر تخصص", font=('Tahoma', 10), anchor="e").grid(row=0, column=7, sticky="e", padx=5)
+        self.filter_specialist_var = tk.StringVar(value="همه متخصصین")
+        self.filter_specialist_combo = ttk.Combobox(filter_frame, textvariable=self.filter_specialist_var,
+                                                  values=["همه متخصصین"], state="readonly", justify='right')
+        self.filter_specialist_combo.grid(row=0, column=6, sticky="ew", padx=5)
+        self.filter_specialist_combo.bind("<<ComboboxSelected>>", self.filter_patients_by_specialist)
+
+        ttk.Label(filter_frame, text=":از تاریخ", font=('Tahoma', 10), anchor="e").grid(row=0, column=5, sticky="e", padx=5)
+        self.date1_entry = DateEntry(filter_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
+        self.date1_entry.grid(row=0, column=4, sticky="ew", padx=5)
+        
+        ttk.Label(filter_frame, text=":تا تاریخ", font=('Tahoma', 10), anchor="e").grid(row=0, column=3, sticky="e", padx=5)
+        self.date2_entry = DateEntry(filter_frame, date_pattern='yyyy-mm-dd', locale='fa_IR', font=('Tahoma', 9))
+        self.date2_entry.grid(row=0, column=2, sticky="ew", padx=5)
+
+        # The date fields always hold a date, so the range only narrows the list while this is ticked
+        self.date_filter_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(filter_frame, text="فیلتر تاریخ", variable=self.date_filter_var, command=self.apply_filters).grid(row=0, column=1, sticky="e", padx=5)
+        ttk.Button(filter_frame, text="اعمال فیلتر تاریخ", command=self.filter_patients_by_date_range).grid(row=0, column=0, sticky="ew", padx=5)
+
+        ttk.Label(filter_frame, text=":فیلتر بخش", font=('Tahoma', 10), anchor="e").grid(row=1, column=7, sticky="e", padx=5, pady=5)
+        self.filter_ward_var = tk.StringVar(value="همه بخش‌ها")
+        # Any ward can be typed in; the list offers the wards in use, re-read whenever it is opened
+        self.filter_ward_combo = ttk.Combobox(filter_frame, textvariable=self.filter_ward_var, values=["همه بخش‌ها"],
+                                              justify='right', postcommand=self.refresh_wards)
+        self.filter_ward_combo.grid(row=1, column=6, sticky="ew", padx=5, pady=5)
+        self.filter_ward_combo.bind("<<ComboboxSelected>>", self.apply_filters)
+        self.filter_ward_combo.bind("<Return>", self.apply_filters)
+
+        ttk.Label(filter_frame, text=":سن از", font=('Tahoma', 10), anchor="e").grid(row=1, column=5, sticky="e", padx=5, pady=5)
+        self.age_min_var = tk.StringVar()
+        age_min_spin = ttk.Spinbox(filter_frame, textvariable=self.age_min_var, from_=1, to=MAX_AGE, justify='right', width=6)
+        age_min_spin.grid(row=1, column=4, sticky="ew", padx=5, pady=5)
+        ttk.Label(filter_frame, text=":تا سن", font=('Tahoma', 10), anchor="e").grid(row=1, column=3, sticky="e", padx=5, pady=5)
+        self.age_max_var = tk.StringVar()
+        age_max_spin = ttk.Spinbox(filter_frame, textvariable=self.age_max_var, from_=1, to=MAX_AGE, justify='right', width=6)
+        age_max_spin.grid(row=1, column=2, sticky="ew", padx=5, pady=5)
+        for spin in (age_min_spin, age_max_spin):
+            spin.bind("<Return>", self.apply_filters)
+
+        ttk.Button(filter_frame, text="اعمال همه فیلترها", command=self.apply_filters).grid(row=1, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+
+        ttk.Label(filter_frame, text=":جستجوی کد یا نام بیمار", font=('Tahoma', 10), anchor="e").grid(row=2, column=7, sticky="e", padx=5, pady=5)
+        self.search_code_var = tk.StringVar()
+        search_entry = ttk.Entry(filter_frame, textvariable=self.search_code_var, justify='right', font=('Tahoma', 10))
+        search_entry.grid(row=2, column=5, columnspan=2, sticky="ew", padx=5, pady=5)
+        search_entry.bind("<Return>", self.search_patient_by_code)
+        self.search_code_var.trace_add("write", self.search_controller.schedule)
+        
+        ttk.Button(filter_frame, text="جستجو", command=self.search_patient_by_code).grid(row=2, column=4, sticky="ew", padx=5, pady=5)
+
+        ttk.Button(filter_frame, text="نمایش همه و بازنشانی", command=self.reset_filters_and_display_all).grid(row=2, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+
+        # --- Treeview Frame ---
+        tree_frame = ttk.Frame(main_frame)
+        tree_frame.pack(fill="both", expand=True)
+
+        self.display_columns_order = ("نام بیمار", "نام خانوادگی", "سن", "بخش", "کد بیمار", "پزشک متخصص", "تاریخ ثبت", "زمان ثبت", "id")
+        
+        self.patient_tree = ttk.Treeview(tree_frame, columns=self.display_columns_order, displaycolumns=self.display_columns_order, show="headings")
+        
+        self.patient_tree.heading("نام بیمار", text="نام بیمار", anchor="e")
+        self.patient_tree.column("نام بیمار", width=150, anchor="e", stretch=tk.YES)
+
+        self.patient_tree.heading("نام خانوادگی", text="نام خانوادگی", anchor="e")
+        self.patient_tree.column("نام خانوادگی", width=180, anchor="e", stretch=tk.YES)
+        
+        self.patient_tree.heading("سن", text="سن", anchor="center")
+        self.patient_tree.column("سن", width=60, anchor="center", stretch=tk.NO)
+
+        self.patient_tree.heading("بخش", text="بخش", anchor="e")
+        self.patient_tree.column("بخش", width=120, anchor="e", stretch=tk.YES)
+
+        self.patient_tree.heading("کد بیمار", text="کد بیمار", anchor="e")
+        self.patient_tree.column("کد بیمار", width=120, anchor="e", stretch=tk.NO)
+
+        self.patient_tree.heading("پزشک متخصص", text="پزشک متخصص", anchor="e")
+        self.patient_tree.column("پزشک متخصص", width=250, anchor="e", stretch=tk.YES)
+        
+        self.patient_tree.heading("تاریخ ثبت", text="تاریخ ثبت", anchor="center")
+        self.patient_tree.column("تاریخ ثبت", width=120, anchor="center", stretch=tk.NO)
+        
+        self.patient_tree.heading("زمان ثبت", text="زمان ثبت", anchor="center")
+        self.patient_tree.column("زمان ثبت", width=120, anchor="center", stretch=tk.NO)
+
+        self.patient_tree.heading("id", text="ردیف", anchor="center")
+        self.patient_tree.column("id", width=60, anchor="center", stretch=tk.NO)
+        
+        # The scrollbar drives the virtual window over the whole result set, not the Treeview itself
+        self.tree_scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.on_tree_scrollbar)
+        
+        self.tree_scrollbar.pack(side="right", fill="y")
+        self.patient_tree.pack(side="left", fill="both", expand=True)
+
+        self.patient_tree.bind("<Configure>", self.on_tree_resize)
+        self.patient_tree.bind("<MouseWheel>", self.on_tree_mousewheel)
+        self.patient_tree.bind("<Button-4>", self.on_tree_mousewheel)
+        self.patient_tree.bind("<Button-5>", self.on_tree_mousewheel)
+        self.patient_tree.bind("<Up>", self.on_tree_arrow_key)
+        self.patient_tree.bind("<Down>", self.on_tree_arrow_key)
+        self.patient_tree.bind("<Prior>", lambda e: self.scroll_tree_by(-self.visible_rows) or "break")
+        self.patient_tree.bind("<Next>", lambda e: self.scroll_tree_by(self.visible_rows) or "break")
+        self.patient_tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+
+        action_frame = ttk.Frame(main_frame)
+        action_frame.pack(pady=10, fill="x")
+        for i in range(4): action_frame.grid_columnconfigure(i, weight=1)
+
+        ttk.Button(action_frame, text="ویرایش بیمار منتخب", command=self.edit_patient).grid(row=0, column=3, padx=5, sticky="ew")
+        ttk.Button(action_frame, text="حذف بیمار(ان) منتخب", command=self.delete_selected_patients).grid(row=0, column=2, padx=5, sticky="ew")
+        ttk.Button(action_frame, text="ورود گروهی از فایل", command=self.import_from_file).grid(row=0, column=1, padx=5, sticky="ew")
+        ttk.Button(action_frame, text="خروجی اکسل", command=self.export_to_excel).grid(row=0, column=0, padx=5, sticky="ew")
+
+        # --- Status Bar ---
+        status_frame = ttk.Frame(main_frame)
+        status_frame.pack(fill="x")
+        self.status_var = tk.StringVar()
+        self.progress_bar = ttk.Progressbar(status_frame, mode="indeterminate", length=200)
+        self.progress_bar.pack(side="left", padx=5)
+        self.cancel_task_button = ttk.Button(status_frame, text="لغو عملیات", command=self.cancel_task, state="disabled")
+        self.cancel_task_button.pack(side="left", padx=5)
+        ttk.Button(status_frame, text="عیب‌یابی کارایی", command=self.open_diagnostics).pack(side="left", padx=5)
+        ttk.Button(status_frame, text="آمار پذیرش", command=self.open_statistics).pack(side="left", padx=5)
+        ttk.Button(status_frame, text="تاریخچه و بازیابی", command=self.open_history).pack(side="left", padx=5)
+        ttk.Button(status_frame, text="پشتیبان‌گیری", command=self.backup_now).pack(side="left", padx=5)
+        self.view_note_var = tk.StringVar()
+        ttk.Label(status_frame, textvariable=self.view_note_var, foreground="#a00000", anchor="e").pack(side="left", padx=5)
+        ttk.Label(status_frame, textvariable=self.status_var, anchor="e").pack(side="right", padx=5)
+
+    def add_specialist(self):
+        specialist_name = self.new_specialist_var.get().strip()
+
+        def on_success(lists):
+            messagebox.showinfo("موفقیت", "پزشک با موفقیت اضافه شد.")
+            self.new_specialist_var.set("")
+            self.show_specialists(lists)
+
+        self.db_worker.submit(lambda conn: PatientRepository(conn).add_specialist(specialist_name), on_success,
+                              self.db_error_handler("خطا در اضافه کردن پزشک"))
+
+    def delete_specialist(self):
+        specialist_name = self.new_specialist_var.get().strip()
+
+        def on_success(lists):
+            messagebox.showinfo("موفقیت", "پزشک با موفقیت غیرفعال شد.")
+            self.new_specialist_var.set("")
+            self.show_specialists(lists)
+
+        self.db_worker.submit(lambda conn: PatientRepository(conn).deactivate_specialist(specialist_name), on_success,
+                              self.db_error_handler("خطا در غیرفعال کردن پزشک"))
+
+    def add_patient(self):
+        try:
+            name, last_name, age, ward, code, specialist = validate_patient(
+                self.entries["نام بیمار"].get(), self.entries["نام خانوادگی"].get(), self.entries["سن"].get(),
+                self.entries["بخش"].get(), self.entries["کد بیمار"].get(), self.specialist_var.get())
+        except PatientValidationError as e:
+            messagebox.showwarning(e.title, str(e))
+            return
+
+        if self.selected_patient_db_id:
+            self.update_patient_data(name, last_name, age, ward, code, specialist)
+        else:
+            self.insert_new_patient(name, last_name, age, ward, code, specialist)
+
+    def insert_new_patient(self, name, last_name, age, ward, code, specialist):
+        def write(conn):
+            return [PatientRepository(conn).add_patient(name, last_name, age, ward, code, specialist)]
+
+        def on_success():
+            messagebox.showinfo("موفقیت", ".اطلاعات بیمار با موفقیت ثبت شد")
+            self.clear_entries()
+
+        # The newest patient sorts first, so show the top of the list where it lands
+        self.submit_patient_write(write, (), on_success, self.db_error_handler("خطا در ثبت اطلاعات"),
+                                  scroll_to_top=True)
+
+    def update_patient_data(self, name, last_name, age, ward, code, specialist):
+        patient_id = self.selected_patient_db_id
+
+        def write(conn):
+            PatientRepository(conn).update_patient(patient_id, name, last_name, age, ward, code, specialist)
+
+        def on_success():
+            messagebox.showinfo("موفقیت", ".اطلاعات بیمار با موفقیت به‌روزرسانی شد")
+            self.clear_entries()
+
+        self.submit_patient_write(write, (patient_id,), on_success, self.db_error_handler("خطا در به‌روزرسانی اطلاعات"))
+
+    def clear_entries(self):
+        for var in self.entries.values():
+            var.set("")
+        if self.specialists:
+            self.specialist_var.set(self.specialists[0])
+        if self.selected_patient_db_id:
+            self.selected_patient_db_id = None
+            self.submit_button.config(text="ثبت اطلاعات")
+            self.root.title("سامانه مدیریت بیماران")
+
+    def reset_filters_and_display_all(self):
+        self.search_code_var.set("")
+        self.search_controller.cancel_pending()
+        self.filter_specialist_var.set("همه متخصصین")
+        self.filter_ward_var.set("همه بخش‌ها")
+        self.age_min_var.set("")
+        self.age_max_var.set("")
+        self.date_filter_var.set(False)
+        today = datetime.now()
+        self.date1_entry.set_date(today)
+        self.date2_entry.set_date(today)
+        self.clear_entries()
+        self.display_patients()
+
+    def display_patients(self, source=None, keep_position=False):
+        source = source or PatientPageSource()
+        started = time.perf_counter()
+
+        def on_success(result):
+            source.total, loaded = result
+            source.store_pages(loaded)
+            self.show_page_source(source, keep_position)
+            METRICS.record("ui", "display_patients", (time.perf_counter() - started) * 1000)
+
+        # A newer filter supersedes (and interrupts) the one still running
+        self.db_worker.submit(source.open_job(), on_success,
+                              lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در بازیابی اطلاعات: {e}"),
+                              key="grid")
+
+    def show_page_source(self, source, keep_position=False):
+        # Results shown straight from memory must not be overwritten by an older query still in flight
+        self.db_worker.cancel("grid")
+        self.page_source = source
+        if not keep_position:
+            self.view_offset = 0
+            self.selected_ids.clear()
+        # Small search results are held in memory, but were read through the filter's own source
+        read_through = source.source if isinstance(source, CachedResultSource) else source
+        if isinstance(source, AsOfSource):
+            self.view_note_var.set(f"وضعیت بیماران در {source.moment} (فقط خواندنی)")
+        elif isinstance(read_through, PartitionedSource):
+            note = f"شامل بایگانی سال‌های {'، '.join(map(str, read_through.years))} (بیماران بایگانی‌شده فقط خواندنی هستند)"
+            if read_through.skipped_years:
+                note += (f"؛ سال‌های {'، '.join(map(str, read_through.skipped_years))} جستجو نشدند، "
+                         f"برای آن‌ها بازه تاریخ را تعیین کنید")
+            self.view_note_var.set(note)
+        else:
+            self.view_note_var.set("")
+        self.render_tree_window()
+        if not self.first_page_shown:
+            self.first_page_shown = True
+            self.record_startup("first_page")
+
+    def render_tree_window(self):
+        source = self.page_source
+        if source is None:
+            return
+        self.view_offset = max(0, min(self.view_offset, source.total - self.visible_rows))
+
+        missing = source.missing_pages(self.view_offset, self.visible_rows)
+        if missing:
+            # Keep showing the current rows until the pages for the new window arrive
+            def on_success(loaded):
+                if source is self.page_source:
+                    source.store_pages(loaded)
+                    self.render_tree_window()
+
+            self.db_worker.submit(source.load_pages_job(missing), on_success,
+                                  lambda e: messagebox.showerror("خطای پایگاه داده", f"خطا در بازیابی اطلاعات: {e}"),
+                                  key="grid-pages")
+            return
+
+        with METRICS.timed("ui", "render_tree_window"):
+            # Diff against the items already shown: an edit rewrites one item, a delete removes its own
+            shown = {str(row[0]): row[1:] + (self.view_offset + position + 1,)
+                     for position, row in enumerate(source.rows(self.view_offset, self.visible_rows))}
+            stale = [item for item in self.patient_tree.get_children() if item not in shown]
+            if stale:
+                self.patient_tree.delete(*stale)
+            for position, (item, display_values) in enumerate(shown.items()):
+                if item not in self.rendered_rows:
+                    self.patient_tree.insert("", position, iid=item, values=display_values)
+                    continue
+                if self.rendered_rows[item] != display_values:
+                    self.patient_tree.item(item, values=display_values)
+                if self.patient_tree.index(item) != position:
+                    self.patient_tree.move(item, "", position)
+            self.rendered_rows = shown
+            self.patient_tree.selection_set([str(db_id) for db_id in self.selected_ids if str(db_id) in shown])
+
+        total = source.total
+        if total:
+            self.tree_scrollbar.set(self.view_offset / total, min(1.0, (self.view_offset + self.visible_rows) / total))
+        else:
+            self.tree_scrollbar.set(0.0, 1.0)
+        self.prefetch_next_page()
+
+    def prefetch_next_page(self):
+        source = self.page_source
+        next_index = (self.view_offset + self.visible_rows - 1) // source.page_size + 1
+        if next_index * source.page_size >= source.total or source.is_cached(next_index):
+            return
+
+        def on_success(loaded):
+            if source is self.page_source:
+                source.store_pages(loaded)
+
+        self.db_worker.submit(source.load_pages_job([next_index]), on_success,
+                              lambda e: logging.warning(f"Prefetching page {next_index} failed: {e}"),
+                              key="grid-prefetch")
+
+    def scroll_tree_to(self, offset):
+        total = self.page_source.total if self.page_source else 0
+        offset = max(0, min(int(offset), total - self.visible_rows))
+        if offset != self.view_offset:
+            self.view_offset = offset
+            self.render_tree_window()
+
+    def scroll_tree_by(self, delta):
+        self.scroll_tree_to(self.view_offset + delta)
+
+    def on_tree_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            total = self.page_source.total if self.page_source else 0
+            self.scroll_tree_to(float(amount) * total)
+        elif action == "scroll":
+            step = self.visible_rows if unit == "pages" else 1
+            self.scroll_tree_by(int(amount) * step)
+
+    def on_tree_mousewheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll_tree_by(-3)
+        else:
+            self.scroll_tree_by(3)
+        return "break"
+
+    def on_tree_arrow_key(self, event):
+        children = self.patient_tree.get_children()
+        focus = self.patient_tree.focus()
+        if not children or focus not in children:
+            return None
+        if event.keysym == "Up" and focus == children[0] and self.view_offset > 0:
+            self.scroll_tree_by(-1)
+            new_focus = self.patient_tree.get_children()[0]
+        elif event.keysym == "Down" and focus == children[-1]:
+            self.scroll_tree_by(1)
+            new_focus = self.patient_tree.get_children()[-1]
+        else:
+            return None
+        self.patient_tree.focus(new_focus)
+        self.patient_tree.selection_set(new_focus)
+        return "break"
+
+    def on_tree_resize(self, event):
+        first_row = self.patient_tree.get_children()[:1]
+        bbox = self.patient_tree.bbox(first_row[0]) if first_row else None
+        heading_height = bbox[1] if bbox else 30
+        visible_rows = max(1, (event.height - heading_height) // 25)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.render_tree_window()
+
+    def on_tree_select(self, event=None):
+        # Selection survives scrolling: keep ids that are off-screen, replace the visible ones
+        visible_ids = {int(item) for item in self.patient_tree.get_children()}
+        self.selected_ids = (self.selected_ids - visible_ids) | {int(item) for item in self.patient_tree.selection()}
+
+    def in_history_view(self):
+        if isinstance(self.page_source, AsOfSource):
+            messagebox.showwarning("نمای تاریخی", ".جدول وضعیت گذشته را نشان می‌دهد؛ برای ویرایش یا حذف، «نمایش همه و بازنشانی» را بزنید")
+            return True
+        return False
+
+    def edit_patient(self):
+        if self.in_history_view():
+            return
+        selected_items = self.patient_tree.selection()
+        if not selected_items:
+            messagebox.showwarning("انتخاب کنید", ".لطفا یک بیمار را برای ویرایش انتخاب کنید")
+            return
+        if len(selected_items) > 1:
+            messagebox.showwarning("انتخاب چندگانه", ".فقط یک بیمار را می‌توان در هر لحظه ویرایش کرد")
+            return
+
+        item_db_id = int(selected_items[0])
+        source = self.page_source
+
+        def job(conn):
+            # A date filter may show archived patients, which cannot be changed
+            if source is not None:
+                source.check_writable(conn.cursor(), [item_db_id])
+            return PatientRepository(conn).get_patient(item_db_id)
+
+        def on_success(db_data):
+            self.selected_patient_db_id = item_db_id
+            self.entries["نام بیمار"].set(db_data[1])
+            self.entries["نام خانوادگی"].set(db_data[2])
+            self.entries["سن"].set(str(db_data[3]))
+            self.entries["بخش"].set(db_data[4])
+            self.entries["کد بیمار"].set(db_data[5])
+            self.specialist_var.set(db_data[6])
+            
+            self.submit_button.config(text="به‌روزرسانی اطلاعات")
+            self.root.title(f"در حال ویرایش بیمار: {db_data[1]} {db_data[2]}")
+
+        self.db_worker.submit(job, on_success, self.db_error_handler("خطا در خواندن اطلاعات برای ویرایش"))
+
+    def delete_selected_patients(self):
+        if self.in_history_view():
+            return
+        selected_items = sorted(self.selected_ids)
+        if not selected_items:
+            messagebox.showwarning("انتخاب کنید", ".لطفا یک یا چند بیمار را برای حذف انتخاب کنید")
+            return
+
+        confirm = messagebox.askyesno("تایید حذف", f"آیا از حذف {len(selected_items)} بیمار منتخب اطمینان دارید؟ بیماران حذف‌شده از پنجره «تاریخچه و بازیابی» قابل بازیابی هستند.")
+        if not confirm:
+            return
+
+        source = self.page_source
+
+        def write(conn):
+            if source is not None:
+                source.check_writable(conn.cursor(), selected_items)
+            PatientRepository(conn).delete_patients(selected_items)
+
+        def on_success():
+            messagebox.showinfo("موفقیت", ".بیمار(ان) با موفقیت حذف شدند")
+            self.clear_entries()
+
+        self.submit_patient_write(write, selected_items, on_success, self.db_error_handler("خطا در حذف اطلاعات"))
+
+    def filter_patients_by_specialist(self, event=None):
+        self.apply_filters()
+
+    def filter_patients_by_date_range(self):
+        self.date_filter_var.set(True)
+        self.apply_filters()
+
+    def search_patient_by_code(self, event=None):
+        self.apply_filters()
+
+    def apply_filters(self, event=None):
+        # Specialist, ward, date range, age range and the search box all narrow one query
+        self.search_controller.cancel_pending()
+        self.search_controller.search_now()
+
+    def search_criteria(self):
+        """The filter widgets as build_patient_source keywords, hashable for the search cache key.
+
+        Returns None, after telling the user, when the age range is not valid.
+        """
+        ages = []
+        for var in (self.age_min_var, self.age_max_var):
+            value = var.get().strip()
+            if value and not value.isdigit():
+                messagebox.showerror("ورودی نامعتبر", ".بازه سنی باید عدد صحیح باشد")
+                return None
+            ages.append(int(value) if value else None)
+        criteria = {"specialist": self.selected_filter_specialist(), "ward": self.selected_filter_ward(),
+                    "age_min": ages[0], "age_max": ages[1], "date_from": None, "date_to": None}
+        if self.date_filter_var.get():
+            try:
+                criteria["date_from"] = self.date1_entry.get_date().strftime('%Y-%m-%d')
+                criteria["date_to"] = self.date2_entry.get_date().strftime('%Y-%m-%d')
+            except Exception as e:
+                messagebox.showerror("خطای تاریخ", f"خطا در فیلتر تاریخ: {e}")
+                return None
+        return tuple(sorted(criteria.items()))
+
+    def selected_filter_specialist(self):
+        selected_specialist = self.filter_specialist_var.get()
+        return None if selected_specialist == "همه متخصصین" else selected_specialist
+
+    def selected_filter_ward(self):
+        selected_ward = self.filter_ward_var.get().strip()
+        return None if selected_ward in ("", "همه بخش‌ها") else selected_ward
+
+    def build_filter_source(self, criteria, search_term=None):
+        return build_patient_source(search_term=search_term, use_search_index=self.search_index_available,
+                                    storage=self.storage_mode, archives=self.archive_years, **dict(criteria))
+
+    def refresh_wards(self):
+        # The list shows what was read last; the names read now appear the next time it opens
+        self.db_worker.submit(lambda conn: PatientRepository(conn).wards(),
+                              lambda wards: self.filter_ward_combo.config(values=["همه بخش‌ها"] + wards),
+                              lambda e: logging.warning(f"Reading wards failed: {e}"), key="wards")
+
+    def export_to_excel(self):
+        if self.page_source is None or self.page_source.total == 0:
+            messagebox.showwarning("داده‌ای وجود ندارد", ".جدول خالی است. داده‌ای برای خروجی گرفتن وجود ندارد")
+            return
+        if self.task_cancel_event is not None:
+            messagebox.showwarning("عملیات در حال اجرا", ".یک عملیات دیگر در حال اجرا است")
+            return
+
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".xlsx",
+            filetypes=[("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("Parquet files", "*.parquet"), ("All files", "*.*")],
+            title="ذخیره فایل اکسل"
+        )
+        if not file_path:
+            return
+
+        # Export the whole filtered result set straight from SQLite, not the rows rendered in the grid
+        source = self.page_source
+        headers = [self.patient_tree.heading(col)["text"] for col in self.display_columns_order]
+
+        def on_progress(value):
+            written, total = value
+            self.status_var.set(f"خروجی: {written:,} از {total:,} ردیف")
+
+        def finish():
+            self.task_cancel_event = None
+            self.cancel_task_button.config(state="disabled")
+            self.status_var.set("")
+
+        def on_success(written):
+            finish()
+            messagebox.showinfo("موفقیت", f"اطلاعات با موفقیت در فایل زیر ذخیره شد:{file_path}")
+
+        def on_error(e):
+            finish()
+            if isinstance(e, TaskCancelled):
+                messagebox.showinfo("لغو شد", ".خروجی گرفتن لغو شد")
+            elif isinstance(e, ImportError):
+                messagebox.showerror("خطا در خروجی", f"برای خروجی Parquet کتابخانه pyarrow لازم است: {e}")
+            else:
+                messagebox.showerror("خطا در خروجی", f"خطا در تولید فایل اکسل: {e}")
+
+        self.task_cancel_event = self.db_worker.start_task(
+            lambda conn, progress, cancel_event: PatientRepository(conn).export(
+                source, file_path, headers, progress, cancel_event),
+            on_success, on_error, on_progress)
+        self.cancel_task_button.config(state="normal")
+
+    def import_from_file(self):
+        if self.task_cancel_event is not None:
+            messagebox.showwarning("عملیات در حال اجرا", ".یک عملیات دیگر در حال اجرا است")
+            return
+
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Excel / CSV files", "*.xlsx *.csv"), ("All files", "*.*")],
+            title="انتخاب فایل بیماران"
+        )
+        if not file_path:
+            return
+
+        def on_progress(value):
+            imported, rejected = value
+            self.status_var.set(f"ورود: {imported:,} ردیف ثبت شد، {rejected:,} ردیف رد شد")
+
+        def finish():
+            self.task_cancel_event = None
+            self.cancel_task_button.config(state="disabled")
+            self.status_var.set("")
+
+        def on_success(result):
+            finish()
+            imported, rejected, report_path = result
+            self.search_controller.invalidate()
+            message = f"{imported:,} بیمار با موفقیت ثبت شد."
+            if rejected:
+                message += f"\n{rejected:,} ردیف رد شد. گزارش ردیف‌های رد شده:\n{report_path}"
+            messagebox.showinfo("ورود گروهی", message)
+            self.reload_current_view()
+
+        def on_error(e):
+            finish()
+            if isinstance(e, TaskCancelled):
+                messagebox.showinfo("لغو شد", ".ورود گروهی لغو شد و هیچ ردیفی ثبت نشد")
+            else:
+                messagebox.showerror("خطا در ورود", f"خطا در ورود گروهی بیماران: {e}")
+
+        self.task_cancel_event = self.db_worker.start_task(
+            lambda conn, progress, cancel_event: PatientRepository(conn).import_file(file_path, progress, cancel_event),
+            on_success, on_error, on_progress)
+        self.cancel_task_button.config(state="normal")
+
+    def backup_now(self):
+        if self.task_cancel_event is not None:
+            messagebox.showwarning("عملیات در حال اجرا", ".یک عملیات دیگر در حال اجرا است")
+            return
+
+        backup_dir = filedialog.askdirectory(initialdir=BACKUP_DIR, title="انتخاب پوشه پشتیبان")
+        if not backup_dir:
+            return
+
+        def on_progress(value):
+            copied, total = value
+            self.status_var.set(f"پشتیبان‌گیری: {copied * 100 // max(total, 1)}٪")
+
+        def finish():
+            self.task_cancel_event = None
+            self.cancel_task_button.config(state="disabled")
+            self.status_var.set("")
+
+        def on_success(path):
+            finish()
+            messagebox.showinfo("پشتیبان‌گیری", f"نسخه پشتیبان بررسی و در پوشه زیر ذخیره شد:\n{path}")
+
+        def on_error(e):
+            finish()
+            if isinstance(e, TaskCancelled):
+                messagebox.showinfo("لغو شد", ".پشتیبان‌گیری لغو شد")
+            else:
+                messagebox.showerror("خطا در پشتیبان‌گیری", f"خطا در پشتیبان‌گیری: {e}")
+
+        # The app keeps working meanwhile: the copy is read from a snapshot, a few pages at a time
+        self.task_cancel_event = self.db_worker.start_task(
+            lambda conn, progress, cancel_event: backup_database(conn, backup_dir, progress=progress,
+                                                                 cancel_event=cancel_event),
+            on_success, on_error, on_progress)
+        self.cancel_task_button.config(state="normal")
+
+    def cancel_task(self):
+        if self.task_cancel_event is not None:
+            self.task_cancel_event.set()
+
+    def open_diagnostics(self):
+        if self.diagnostics_window is not None and self.diagnostics_window.window.winfo_exists():
+            self.diagnostics_window.window.lift()
+            return
+        self.diagnostics_window = DiagnosticsWindow(self.root)
+
+    def open_history(self):
+        if self.history_window is not None and self.history_window.window.winfo_exists():
+            self.history_window.window.lift()
+            return
+        self.history_window = HistoryWindow(self)
+
+    def show_as_of(self, moment):
+        self.search_controller.cancel_pending()
+        self.display_patients(AsOfSource(moment, self.archive_years))
+
+    def open_statistics(self):
+        if self.statistics_window is not None and self.statistics_window.window.winfo_exists():
+            self.statistics_window.window.lift()
+            return
+        self.statistics_window = StatisticsWindow(self.root, self.db_worker)
+
+    def on_closing(self):
+        if self.db_worker:
+            self.db_worker.close()
+        if METRICS_FILE:
+            try:
+                METRICS.dump(METRICS_FILE)
+            except OSError as e:
+                logging.warning(f"Writing metrics to {METRICS_FILE} failed: {e}")
+        self.root.destroy()
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = PatientManagementApp(root)
+    root.protocol("WM_DELETE_WINDOW", app.on_closing)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,149 @@
+"""Compare a database before and after moving its older patients to yearly archive files.
+
+Usage: python benchmarks/bench_archive.py [--sizes 10k,1m] [--storage MODE] [--before DATE] [--repeat N] [--json]
+
+The dataset from generate_dataset.py is copied to a temporary directory and
+run through archive_patients, which moves every patient submitted before
+--before to <database>_archive_<year>.db. Reported for the original and the
+archived copy (archive_ms and moved only for the latter):
+  archive_ms, moved           time to move the rows with archive_patients, and how many moved
+  main_used_bytes             pages in use in the main file (freed pages are reused by new patients)
+  archive_bytes               size of the archive files together
+  startup_display_patients    fresh connection, schema check, count + first page
+  search_substring            search box with no date range: reads the main file and the archive files
+  date_range_recent           count + first page of one month that stayed in the main file
+  date_range_archived         the same for one month of an archived year
+  search_archived_year        search box together with one archived year as the date range
+  admission_stats_archived    the statistics window over one archived year
+Timings are medians over --repeat runs on a warm cache, in milliseconds.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+from generate_dataset import FIRST_DATE, DATE_SPAN_DAYS, ensure_dataset, parse_rows
+
+
+def median_ms(func, repeat):
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - started) * 1000)
+    return statistics.median(runs)
+
+
+def random_month(rng, first, last):
+    start = first + timedelta(days=rng.randrange((last - first).days - 30))
+    return {"date_from": start.isoformat(), "date_to": (start + timedelta(days=29)).isoformat()}
+
+
+def bench_database(db_path, before, repeat, seed):
+    rng = random.Random(seed)
+    conn = service.connect_database(db_path)
+    service.migrate_schema(conn, storage=None)
+    storage = service.storage_mode(conn)
+    use_search_index = service.has_search_index(conn)
+    archives = service.archived_years(conn)
+    page_size, free_pages = (conn.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in ("page_size", "freelist_count"))
+    directory = os.path.dirname(db_path)
+    results = {"main_used_bytes": os.path.getsize(db_path) - page_size * free_pages,
+               "archive_bytes": sum(os.path.getsize(os.path.join(directory, file_name))
+                                    for (file_name,) in conn.execute("SELECT file_name FROM patient_archives"))}
+    cutoff = date.fromisoformat(before)
+    last_date = FIRST_DATE + timedelta(days=DATE_SPAN_DAYS)
+
+    def page(**criteria):
+        source = service.build_patient_source(storage=storage, use_search_index=use_search_index, archives=archives,
+                                              **criteria)
+        if criteria.get("search_term"):
+            return source.head_or_open_job()(conn)
+        return source.open_job()(conn)
+
+    def startup():
+        startup_conn = service.connect_database(db_path)
+        try:
+            service.migrate_schema(startup_conn, storage=None)
+            return service.PatientPageSource().open_job()(startup_conn)
+        finally:
+            startup_conn.close()
+
+    archived_year = rng.randrange(FIRST_DATE.year, cutoff.year)
+    results["startup_display_patients_ms"] = median_ms(startup, repeat)
+    results["search_substring_ms"] = median_ms(lambda: page(search_term=rng.choice(["محمد", "رضای", "حسین"])), repeat)
+    results["date_range_recent_ms"] = median_ms(lambda: page(**random_month(rng, cutoff, last_date)), repeat)
+    results["date_range_archived_ms"] = median_ms(lambda: page(**random_month(rng, FIRST_DATE, cutoff)), repeat)
+    results["search_archived_year_ms"] = median_ms(
+        lambda: page(search_term=rng.choice(["محمد", "رضای", "حسین"]), date_from=f"{archived_year}-01-01",
+                     date_to=f"{archived_year}-12-31"), repeat)
+    results["admission_stats_archived_ms"] = median_ms(
+        lambda: service.admission_stats(conn, f"{archived_year}-01-01", f"{archived_year}-12-31"), repeat)
+    conn.close()
+    return results
+
+
+def archive_copy(db_path, before):
+    directory = tempfile.mkdtemp(prefix="pms-bench-archive-")
+    copy_path = os.path.join(directory, os.path.basename(db_path))
+    shutil.copy(db_path, copy_path)
+    conn = service.connect_database(copy_path)
+    try:
+        service.migrate_schema(conn, storage=None)
+        started = time.perf_counter()
+        moved = service.archive_patients(conn, before)
+        archive_ms = (time.perf_counter() - started) * 1000
+    finally:
+        conn.close()
+    return directory, copy_path, {"archive_ms": archive_ms, "moved": moved}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,1m", help="comma-separated row counts, e.g. 10k,1m,10m")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=sorted(service.STORAGE_TABLES), default=service.STORAGE_CLASSIC)
+    parser.add_argument("--before", default="2024-01-01",
+                        help="archive the patients submitted before this ISO date (the datasets start in 2020)")
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = {}
+    for rows in (parse_rows(size) for size in args.sizes.split(",")):
+        db_path = ensure_dataset(args.data_dir, rows, args.seed, storage=args.storage)
+        directory, copy_path, archived = archive_copy(db_path, args.before)
+        try:
+            archived.update(bench_database(copy_path, args.before, args.repeat, args.seed))
+        finally:
+            shutil.rmtree(directory)
+        results[str(rows)] = {"original": bench_database(db_path, args.before, args.repeat, args.seed),
+                              "archived": archived}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    for rows, layouts in results.items():
+        original, archived = layouts["original"], layouts["archived"]
+        print(f"{int(rows):,} patients, archived before {args.before}: {archived['moved']:,} moved "
+              f"in {archived['archive_ms'] / 1000:.1f} s")
+        print(f"  {'':28}{'original':>14}{'archived':>14}{'ratio':>8}")
+        for metric in original:
+            unit = "MB" if metric.endswith("bytes") else "ms"
+            scale = 1 / 2 ** 20 if unit == "MB" else 1
+            ratio = f"{archived[metric] / original[metric]:7.2f}x" if original[metric] else ""
+            print(f"  {metric:28}{original[metric] * scale:11.1f} {unit}{archived[metric] * scale:11.1f} {unit}{ratio}")
+
+
+if __name__ == "__main__":
+    main()
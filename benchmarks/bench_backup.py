@@ -0,0 +1,123 @@
+"""Measure online backups and what they cost the app's own queries meanwhile.
+
+Usage: python benchmarks/bench_backup.py [--sizes 10k,1m] [--storage MODE] [--queries N] [--json]
+
+For each size a backup_database run copies the dataset from generate_dataset.py
+into a temporary directory on a background thread, like the app's scheduled
+backup, while the main thread keeps running the grid's queries (first page,
+one month's date filter, a code search) on another connection. Reported per mode:
+  backup_ms, backup_bytes   duration of the backup and size of what it wrote
+  query_p50/p95/max_ms      latency of the grid queries while it ran
+Modes: idle (no backup, the baseline), throttled (the default step size and
+pause), unthrottled (every page in one step, no pause) and throttled with gzip.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+from generate_dataset import FIRST_DATE, DATE_SPAN_DAYS, ensure_dataset, parse_rows
+
+MODES = {
+    "idle": None,
+    "throttled": {"compress": False},
+    "unthrottled": {"compress": False, "step_pages": -1, "step_pause": 0},
+    "throttled_gzip": {"compress": True},
+}
+
+
+def grid_queries(conn, rows, rng):
+    storage = service.storage_mode(conn)
+    first = FIRST_DATE + timedelta(days=rng.randrange(DATE_SPAN_DAYS - 31))
+    queries = [
+        lambda: service.PatientPageSource().open_job()(conn),
+        lambda: service.build_patient_source(date_from=first.isoformat(), date_to=(first + timedelta(days=30)).isoformat(),
+                                             storage=storage).open_job()(conn),
+        lambda: service.build_patient_source(search_term=f"P{rng.randint(1, rows):08d}", storage=storage,
+                                             use_search_index=service.has_search_index(conn)).head_or_open_job()(conn),
+    ]
+    return rng.choice(queries)
+
+
+def bench_mode(db_path, rows, options, queries, seed):
+    rng = random.Random(seed)
+    conn = service.connect_database(db_path)
+    service.migrate_schema(conn, storage=None)
+    backup_dir = tempfile.mkdtemp(prefix="pms-bench-backup-")
+    outcome = {}
+
+    def backup():
+        backup_conn = service.connect_database(db_path)
+        try:
+            started = time.perf_counter()
+            path = service.backup_database(backup_conn, backup_dir, keep=0, **options)
+            outcome["backup_ms"] = (time.perf_counter() - started) * 1000
+            outcome["backup_bytes"] = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        finally:
+            backup_conn.close()
+
+    thread = None
+    if options is not None:
+        thread = threading.Thread(target=backup)
+        thread.start()
+    latencies = []
+
+    def running():
+        # Without a backup a fixed number of queries; with one, as many as run until it ends
+        return thread.is_alive() if thread is not None else len(latencies) < queries
+    while running():
+        query = grid_queries(conn, rows, rng)
+        started = time.perf_counter()
+        query()
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.005)
+    if thread is not None:
+        thread.join()
+    conn.close()
+    shutil.rmtree(backup_dir)
+    latencies.sort()
+    outcome.update({"queries": len(latencies), "query_p50_ms": statistics.median(latencies),
+                    "query_p95_ms": latencies[int(len(latencies) * 0.95)], "query_max_ms": latencies[-1]})
+    return outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,1m", help="comma-separated row counts, e.g. 10k,1m,10m")
+    parser.add_argument("--queries", type=int, default=200, help="grid queries timed without a backup running")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=sorted(service.STORAGE_TABLES), default=service.STORAGE_CLASSIC)
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = {}
+    for rows in (parse_rows(size) for size in args.sizes.split(",")):
+        db_path = ensure_dataset(args.data_dir, rows, args.seed, storage=args.storage)
+        results[str(rows)] = {mode: bench_mode(db_path, rows, options, args.queries, args.seed)
+                              for mode, options in MODES.items()}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    for rows, modes in results.items():
+        print(f"{int(rows):,} patients{'':8}{'backup':>10}{'size':>10}{'queries':>9}{'p50':>9}{'p95':>9}{'max':>9}")
+        for mode, values in modes.items():
+            backup = f"{values['backup_ms'] / 1000:8.1f} s" if "backup_ms" in values else f"{'-':>10}"
+            size = f"{values['backup_bytes'] / 2 ** 20:7.1f} MB" if "backup_bytes" in values else f"{'-':>10}"
+            print(f"  {mode:22}{backup}{size}{values['queries']:9}{values['query_p50_ms']:7.2f}ms"
+                  f"{values['query_p95_ms']:7.2f}ms{values['query_max_ms']:7.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
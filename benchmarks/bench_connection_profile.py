@@ -0,0 +1,105 @@
+"""Compare SQLite connection profiles on the app's real schema and statements.
+
+Usage: python benchmarks/bench_connection_profile.py [--rows N] [--commits N] [--reads N] [--json]
+
+Each profile in CONNECTION_PROFILES gets a fresh database file seeded with the
+same synthetic patients, then runs:
+  * single_commit_inserts - one INSERT + commit per patient, like the entry form
+  * batch_insert          - one executemany transaction, like the bulk import
+  * keyset_pages          - random specialist-filtered grid pages
+  * point_lookups         - SELECT by id, like edit_patient
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+
+
+def patient_rows(count, start=0):
+    rng = random.Random(start)
+    for i in range(start, start + count):
+        yield (f"name{i}", f"family{rng.randrange(5000)}", rng.randrange(1, 100), f"ward{rng.randrange(20)}",
+               f"P{i:07d}", service.INITIAL_SPECIALISTS[rng.randrange(len(service.INITIAL_SPECIALISTS))],
+               f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}", "10:00:00")
+
+
+INSERT_SQL = ("INSERT INTO patients (patient_name, last_name, age, ward, patient_code, specialist, "
+              "submission_date, submission_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def bench_profile(profile, rows, commits, reads):
+    directory = tempfile.mkdtemp(prefix=f"pms-bench-{profile}-")
+    db_path = os.path.join(directory, "hospital_patients.db")
+    conn = service.connect_database(db_path, profile)
+    service.migrate_schema(conn)
+    conn.execute("PRAGMA foreign_keys=ON")
+    results = {}
+
+    started = time.perf_counter()
+    conn.executemany(INSERT_SQL, patient_rows(rows))
+    conn.commit()
+    results["batch_insert_rows_per_sec"] = rows / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for row in patient_rows(commits, start=rows):
+        conn.execute(INSERT_SQL, row)
+        conn.commit()
+    results["single_commit_inserts_per_sec"] = commits / (time.perf_counter() - started)
+
+    rng = random.Random(42)
+    storage = service.storage_mode(conn)
+    total = rows + commits
+    started = time.perf_counter()
+    for _ in range(reads):
+        source = service.build_patient_source(specialist=rng.choice(service.INITIAL_SPECIALISTS), storage=storage)
+        source.total = total
+        source.load_pages_job([rng.randrange(5)])(conn)
+    results["keyset_pages_per_sec"] = reads / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(reads * 10):
+        conn.execute("SELECT patient_name, last_name, age, ward, patient_code, specialist FROM patients WHERE id=?",
+                     (rng.randrange(1, total + 1),)).fetchone()
+    results["point_lookups_per_sec"] = reads * 10 / (time.perf_counter() - started)
+
+    service.run_maintenance(conn)
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--commits", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = {profile: bench_profile(profile, args.rows, args.commits, args.reads)
+               for profile in service.CONNECTION_PROFILES}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    metrics = list(next(iter(results.values())))
+    baseline = results.get("legacy")
+    print(f"{'metric':32}" + "".join(f"{profile:>16}" for profile in results))
+    for metric in metrics:
+        line = f"{metric:32}"
+        for profile, values in results.items():
+            cell = f"{values[metric]:,.0f}"
+            if baseline and profile != "legacy":
+                cell += f" ({values[metric] / baseline[metric]:.1f}x)"
+            line += f"{cell:>16}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
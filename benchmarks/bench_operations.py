@@ -0,0 +1,229 @@
+"""Time the app's user-facing operations on synthetic databases of several sizes.
+
+Usage: python benchmarks/bench_operations.py [--sizes 10k,1m,10m] [--repeat N] [--storage MODE] [--output FILE]
+                                             [--baseline FILE [--threshold RATIO] [--min-delta-ms MS]]
+
+Each operation runs the same job the GUI submits to its DatabaseWorker, so no
+display is needed:
+  startup_display_patients   fresh connection, schema check, count + first page
+  filter_by_specialist       build_patient_source(specialist=...).open_job()
+  filter_by_date_range       one month, as picked with the two DateEntry fields
+  filter_combined            a specialist, one month and an age range together (FilterPlan path)
+  search_exact_code          search box: one exact patient code
+  search_name_prefix         search box: a two-letter prefix (prefix ranges on the NOCASE indexes)
+  search_substring           search box: a common 3+ letter substring (trigram path)
+  scroll_deep_page           jumping the scrollbar to the middle of the full list
+  bulk_delete_500            PatientRepository.delete_patients on 500 ids
+  bulk_restore_500           PatientRepository.restore_patients putting the same 500 back
+  view_as_of                 count + first page of the list as of an hour ago (AsOfSource), which
+                             replays the audit entries the delete/restore runs left behind
+  admission_stats_year       the statistics window over one year (patient_stats summary)
+  export_csv, export_xlsx    exporting one specialist's patients (run once per size)
+
+Datasets come from generate_dataset.py and are cached under --data-dir. Results
+are written as JSON (median/min/max milliseconds per operation and size).
+With --baseline, medians are compared to an earlier run and the exit status is
+1 when any operation got slower than --threshold times its baseline and by at
+least --min-delta-ms, so timer noise on sub-millisecond queries is ignored.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+from generate_dataset import FIRST_DATE, DATE_SPAN_DAYS, ensure_dataset, parse_rows
+
+EXPORT_HEADERS = ["نام بیمار", "نام خانوادگی", "سن", "بخش", "کد بیمار", "پزشک متخصص", "تاریخ ثبت", "زمان ثبت", "ردیف"]
+
+
+def timed(func, repeat):
+    runs, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        runs.append((time.perf_counter() - started) * 1000)
+    return runs, result
+
+
+def summary(runs, rows):
+    return {"median_ms": statistics.median(runs), "min_ms": min(runs), "max_ms": max(runs), "runs": len(runs),
+            "rows": rows}
+
+
+def bench_size(db_path, rows, repeat, seed):
+    rng = random.Random(seed)
+    results = {}
+    conn = service.connect_database(db_path)
+    repository = service.PatientRepository(conn)
+    use_search_index = service.has_search_index(conn)
+    storage = service.storage_mode(conn)
+    active, _ = repository.get_specialists()
+
+    def startup():
+        startup_conn = service.connect_database(db_path)
+        try:
+            service.migrate_schema(startup_conn, storage=None)
+            return service.PatientPageSource().open_job()(startup_conn)
+        finally:
+            startup_conn.close()
+    runs, (total, _) = timed(startup, repeat)
+    results["startup_display_patients"] = summary(runs, total)
+
+    specialists = iter(rng.choice(active) for _ in range(repeat))
+    runs, (total, _) = timed(lambda: service.build_patient_source(specialist=next(specialists), storage=storage).open_job()(conn), repeat)
+    results["filter_by_specialist"] = summary(runs, total)
+
+    def date_range():
+        first = FIRST_DATE + timedelta(days=rng.randrange(DATE_SPAN_DAYS - 31))
+        source = service.build_patient_source(date_from=first.isoformat(), date_to=(first + timedelta(days=30)).isoformat(),
+                                              storage=storage)
+        return source.open_job()(conn)
+    runs, (total, _) = timed(date_range, repeat)
+    results["filter_by_date_range"] = summary(runs, total)
+
+    def combined():
+        first = FIRST_DATE + timedelta(days=rng.randrange(DATE_SPAN_DAYS - 31))
+        age_min = rng.randrange(1, 80)
+        source = service.build_patient_source(specialist=rng.choice(active), date_from=first.isoformat(),
+                                              date_to=(first + timedelta(days=30)).isoformat(),
+                                              age_min=age_min, age_max=age_min + 20, storage=storage)
+        return source.open_job()(conn)
+    runs, (total, _) = timed(combined, repeat)
+    results["filter_combined"] = summary(runs, total)
+
+    def search(terms):
+        def run():
+            source = service.build_patient_source(search_term=next(terms), use_search_index=use_search_index,
+                                                  storage=storage)
+            materialized, opened = source.head_or_open_job()(conn)
+            return len(materialized) if materialized is not None else opened[0]
+        return run
+    for name, make_term in (("search_exact_code", lambda: f"P{rng.randint(1, rows):08d}"),
+                            ("search_name_prefix", lambda: rng.choice(["عل", "مح", "سا", "رض"])),
+                            ("search_substring", lambda: rng.choice(["محمد", "رضای", "حسین", "کریم"]))):
+        runs, matched = timed(search(iter([make_term() for _ in range(repeat)])), repeat)
+        results[name] = summary(runs, matched)
+
+    def stats_year():
+        first = FIRST_DATE + timedelta(days=rng.randrange(DATE_SPAN_DAYS - 365))
+        return service.admission_stats(conn, first.isoformat(), (first + timedelta(days=364)).isoformat())["total"]
+    runs, total = timed(stats_year, repeat)
+    results["admission_stats_year"] = summary(runs, total)
+
+    def deep_page():
+        source = service.PatientPageSource()
+        source.total = rows
+        index = rows // 2 // source.page_size
+        return len(source.load_pages_job([index])(conn)[0][2])
+    runs, fetched = timed(deep_page, repeat)
+    results["scroll_deep_page"] = summary(runs, fetched)
+
+    delete_runs, restore_runs = [], []
+    for _ in range(repeat):
+        ids = rng.sample(range(1, rows + 1), min(500, rows))
+        started = time.perf_counter()
+        deleted = repository.delete_patients(ids)
+        delete_runs.append((time.perf_counter() - started) * 1000)
+        # Restoring keeps the ids, so the patients stay identical between runs; only patient_audit grows
+        started = time.perf_counter()
+        restored = repository.restore_patients(ids)
+        restore_runs.append((time.perf_counter() - started) * 1000)
+        conn.execute("DELETE FROM change_log")
+        conn.commit()
+    results["bulk_delete_500"] = summary(delete_runs, deleted)
+    results["bulk_restore_500"] = summary(restore_runs, len(restored))
+
+    moment = service.audit_timestamp(datetime.now() - timedelta(hours=1))
+    runs, (total, _) = timed(lambda: service.AsOfSource(moment).open_job()(conn), repeat)
+    results["view_as_of"] = summary(runs, total)
+
+    export_dir = tempfile.mkdtemp(prefix="pms-bench-export-")
+    source = service.build_patient_source(specialist=active[1 % len(active)], storage=storage)
+    source.total = repository.count_patients(source)
+    for extension in ("csv", "xlsx"):
+        path = os.path.join(export_dir, f"export.{extension}")
+        runs, written = timed(lambda: repository.export(source, path, EXPORT_HEADERS), 1)
+        results[f"export_{extension}"] = summary(runs, written)
+        os.remove(path)
+    os.rmdir(export_dir)
+
+    conn.close()
+    return results
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    regressions = []
+    for size, operations in results.items():
+        for operation, values in operations.items():
+            previous = baseline.get(size, {}).get(operation)
+            if not previous:
+                continue
+            ratio = values["median_ms"] / max(previous["median_ms"], 1e-6)
+            flag = ""
+            if ratio > threshold and values["median_ms"] - previous["median_ms"] >= min_delta_ms:
+                flag = "  REGRESSION"
+                regressions.append((size, operation, ratio))
+            print(f"{size:>10} {operation:28} {previous['median_ms']:10.2f} -> {values['median_ms']:10.2f} ms "
+                  f"({ratio:.2f}x){flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,1m", help="comma-separated row counts, e.g. 10k,1m,10m")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=sorted(service.STORAGE_TABLES), default=service.STORAGE_CLASSIC)
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--min-delta-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    results = {}
+    for rows in (parse_rows(size) for size in args.sizes.split(",")):
+        db_path = ensure_dataset(args.data_dir, rows, args.seed, storage=args.storage)
+        print(f"benchmarking {rows:,} rows", file=sys.stderr)
+        results[str(rows)] = bench_size(db_path, rows, args.repeat, args.seed)
+
+    report = {
+        "meta": {
+            "date": date.today().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "profile": service.DB_PROFILE,
+            "storage": args.storage,
+            "metrics": service.METRICS.enabled,
+            "schema_version": service.SCHEMA_VERSION,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold, args.min_delta_ms):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
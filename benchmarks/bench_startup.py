@@ -0,0 +1,115 @@
+"""Measure cold startup of the desktop app in fresh interpreter processes.
+
+Usage: python benchmarks/bench_startup.py [--sizes 10k,1m] [--storage MODE] [--repeat N] [--json]
+
+Each run starts a new Python process, so imports and the database file are
+opened cold (as far as the OS page cache allows), and reports in milliseconds:
+  process_ms       from launching the interpreter until the child reports back
+  import_ms        importing the app module (tkinter, tkcalendar, patient_service)
+  window_shown_ms  until Tk is idle with the main window built
+  first_page_ms    until the first page of patients is in the grid
+The last two are measured from the app's STARTUP_BEGAN, like the "startup_*"
+series in the diagnostics window. Without a display the child runs the same
+worker jobs as the app (schema check, specialists, first page) directly and
+reports no window_shown_ms. Values are medians over --repeat processes.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+from generate_dataset import ensure_dataset, parse_rows
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Patient Management System simple.py")
+
+CHILD = r'''
+import importlib.util, json, os, sys, time
+sys.path.insert(0, os.path.dirname(sys.argv[1]))
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("patient_app", sys.argv[1])
+app_module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app_module)
+result = {"import_ms": (time.perf_counter() - started) * 1000}
+service = sys.modules["patient_service"]
+try:
+    root = app_module.tk.Tk()
+except app_module.tk.TclError:
+    root = None
+if root is None:
+    conn = service.connect_database("hospital_patients.db")
+    service.migrate_schema(conn)
+    service.has_search_index(conn)
+    service.storage_mode(conn)
+    repository = service.PatientRepository(conn)
+    repository.latest_change_seq()
+    repository.get_specialists()
+    service.PatientPageSource().open_job()(conn)
+    result["first_page_ms"] = (time.perf_counter() - app_module.STARTUP_BEGAN) * 1000
+    conn.close()
+else:
+    app = app_module.PatientManagementApp(root)
+    deadline = time.time() + 120
+    while not app.first_page_shown and time.time() < deadline:
+        root.update()
+        time.sleep(0.001)
+    for entry in service.METRICS.snapshot()["series"]:
+        if entry["kind"] == "ui" and entry["name"].startswith("startup_"):
+            result[entry["name"][len("startup_"):] + "_ms"] = entry["max_ms"]
+    app.on_closing()
+print(json.dumps(result))
+'''
+
+
+def run_once(db_path):
+    # The app opens hospital_patients.db in its working directory
+    directory = tempfile.mkdtemp(prefix="pms-bench-startup-")
+    os.symlink(os.path.abspath(db_path), os.path.join(directory, "hospital_patients.db"))
+    try:
+        started = time.perf_counter()
+        child = subprocess.run([sys.executable, "-c", CHILD, APP_PATH], cwd=directory, capture_output=True, text=True)
+        if child.returncode:
+            raise RuntimeError(f"startup run failed:\n{child.stderr}")
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        result["process_ms"] = (time.perf_counter() - started) * 1000
+        return result
+    finally:
+        os.remove(os.path.join(directory, "hospital_patients.db"))
+        os.rmdir(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,1m", help="comma-separated row counts, e.g. 10k,1m,10m")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=sorted(service.STORAGE_TABLES), default=service.STORAGE_CLASSIC)
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = {}
+    for rows in (parse_rows(size) for size in args.sizes.split(",")):
+        db_path = ensure_dataset(args.data_dir, rows, args.seed, storage=args.storage)
+        runs = [run_once(db_path) for _ in range(args.repeat)]
+        results[str(rows)] = {metric: statistics.median(run[metric] for run in runs)
+                              for metric in ("process_ms", "import_ms", "window_shown_ms", "first_page_ms")
+                              if all(metric in run for run in runs)}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    for rows, metrics in results.items():
+        print(f"{int(rows):,} patients")
+        for metric, value in metrics.items():
+            print(f"  {metric:18}{value:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Compare the classic and compact patient storage on the same synthetic data.
+
+Usage: python benchmarks/bench_storage.py [--sizes 10k,1m] [--repeat N] [--json]
+
+Both layouts come from generate_dataset.py (the compact one is the classic
+dataset run through convert_storage) and are cached under --data-dir.
+Reported per size and layout:
+  file_bytes, used_bytes         file size, and pages in use per table/index (dbstat)
+  count_all                      COUNT(*) behind the status line of the unfiltered grid
+  count_specialist               COUNT(*) of one specialist's patients
+  count_date_range               COUNT(*) of one year of submissions
+  page_date_range                count + first page of one month, as the date filter shows it
+  full_scan                      every row in display columns, as an export reads them
+Timings are medians over --repeat runs on a warm cache, in milliseconds.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+from generate_dataset import FIRST_DATE, DATE_SPAN_DAYS, ensure_dataset, parse_rows
+
+
+def median_ms(func, repeat):
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - started) * 1000)
+    return statistics.median(runs)
+
+
+def object_sizes(conn):
+    try:
+        rows = conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC").fetchall()
+    except sqlite3.OperationalError:
+        return None  # SQLite built without the dbstat table
+    return dict(rows)
+
+
+def bench_storage(db_path, repeat, seed):
+    rng = random.Random(seed)
+    conn = service.connect_database(db_path)
+    service.migrate_schema(conn, storage=None)
+    storage = service.storage_mode(conn)
+    specialist = service.PatientRepository(conn).get_specialists()[0][1]
+    cursor = conn.cursor()
+    sizes = object_sizes(conn)
+    results = {"file_bytes": os.path.getsize(db_path),
+               "used_bytes": sum(sizes.values()) if sizes else None,
+               "objects": sizes}
+
+    def source(**criteria):
+        return service.build_patient_source(storage=storage, **criteria)
+
+    def random_range(days):
+        first = FIRST_DATE + timedelta(days=rng.randrange(DATE_SPAN_DAYS - days))
+        return {"date_from": first.isoformat(), "date_to": (first + timedelta(days=days - 1)).isoformat()}
+
+    results["count_all_ms"] = median_ms(lambda: source()._count(cursor), repeat)
+    results["count_specialist_ms"] = median_ms(lambda: source(specialist=specialist)._count(cursor), repeat)
+    results["count_date_range_ms"] = median_ms(lambda: source(**random_range(365))._count(cursor), repeat)
+    results["page_date_range_ms"] = median_ms(lambda: source(**random_range(30)).open_job()(conn), repeat)
+    results["full_scan_ms"] = median_ms(lambda: sum(len(batch) for batch in source().iter_batches(cursor)),
+                                        max(1, repeat // 2))
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10k,1m", help="comma-separated row counts, e.g. 10k,1m,10m")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = {}
+    for rows in (parse_rows(size) for size in args.sizes.split(",")):
+        results[str(rows)] = {storage: bench_storage(ensure_dataset(args.data_dir, rows, args.seed, storage=storage),
+                                                     args.repeat, args.seed)
+                              for storage in (service.STORAGE_CLASSIC, service.STORAGE_COMPACT)}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    for rows, layouts in results.items():
+        classic, compact = layouts[service.STORAGE_CLASSIC], layouts[service.STORAGE_COMPACT]
+        print(f"{int(rows):,} patients{'':14}{'classic':>14}{'compact':>14}{'ratio':>8}")
+        for metric in classic:
+            if metric == "objects" or classic[metric] is None:
+                continue
+            unit = "MB" if metric.endswith("bytes") else "ms"
+            scale = 1 / 2 ** 20 if unit == "MB" else 1
+            print(f"  {metric:26}{classic[metric] * scale:11.1f} {unit}{compact[metric] * scale:11.1f} {unit}"
+                  f"{compact[metric] / max(classic[metric], 1e-9):7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Generate a deterministic synthetic hospital database.
+
+Usage: python benchmarks/generate_dataset.py ROWS [--seed N] [--specialists N] [--storage MODE] [--db PATH]
+
+ROWS accepts suffixes, e.g. 10k, 1m, 10m. The same ROWS, seed and specialist
+count always produce the same patients and specialists, on the app's current
+schema and in the chosen storage mode (classic or compact). Names, wards and specialists follow skewed distributions so filters
+see realistic selectivity. Submission dates grow with the id over six years,
+as in a database that has been in use that long.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+
+FIRST_NAMES = ["علی", "محمد", "حسین", "رضا", "مهدی", "امیر", "فاطمه", "زهرا", "مریم", "سارا", "نرگس", "لیلا",
+               "حمید", "سعید", "مینا", "نازنین", "کیان", "آرش", "پریسا", "یاسمن", "بهرام", "شیرین", "الهام", "داوود"]
+LAST_NAMES = ["محمدی", "حسینی", "احمدی", "رضایی", "کریمی", "موسوی", "جعفری", "صادقی", "رحیمی", "نوری", "کاظمی",
+              "قاسمی", "یزدانی", "اکبری", "سلیمانی", "شریفی", "بهرامی", "فرهادی", "عباسی", "طاهری", "مرادی", "زمانی"]
+WARDS = ["اورژانس", "داخلی", "جراحی", "اطفال", "زنان", "قلب", "ارتوپدی", "چشم", "گوش و حلق و بینی", "روان",
+         "ICU", "CCU", "NICU", "دیالیز", "سرپایی"]
+FIRST_DATE = date(2020, 1, 1)
+DATE_SPAN_DAYS = 6 * 365
+BATCH_SIZE = 50000
+
+
+def parse_rows(value):
+    value = value.strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(value[-1:], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
+def specialist_names(count):
+    names = list(service.INITIAL_SPECIALISTS[:count])
+    for index in range(len(names), count):
+        names.append(f"تخصص {index + 1} - دکتر {LAST_NAMES[index % len(LAST_NAMES)]}")
+    return names
+
+
+def patient_rows(rows, specialists, seed):
+    rng = random.Random(seed)
+    # Zipf-like weights: the first specialists and wards see most of the patients
+    specialist_weights = [1 / (rank + 1) for rank in range(len(specialists))]
+    ward_weights = [1 / (rank + 1) for rank in range(len(WARDS))]
+    for start in range(0, rows, BATCH_SIZE):
+        count = min(BATCH_SIZE, rows - start)
+        chosen_specialists = rng.choices(specialists, specialist_weights, k=count)
+        chosen_wards = rng.choices(WARDS, ward_weights, k=count)
+        batch = []
+        for offset in range(count):
+            i = start + offset
+            submitted = FIRST_DATE + timedelta(days=i * DATE_SPAN_DAYS // rows)
+            batch.append((rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.randint(1, 99), chosen_wards[offset],
+                          f"P{i + 1:08d}", chosen_specialists[offset], submitted.isoformat(),
+                          f"{rng.randrange(8, 20):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}"))
+        yield batch
+
+
+def generate(db_path, rows, seed=0, specialists=len(service.INITIAL_SPECIALISTS), progress=None,
+             storage=service.STORAGE_CLASSIC):
+    """Create `db_path` holding `rows` synthetic patients; refuses to touch an existing file."""
+    if os.path.exists(db_path):
+        raise FileExistsError(db_path)
+    temp_path = db_path + ".part"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(temp_path + suffix):
+            os.remove(temp_path + suffix)
+    conn = service.connect_database(temp_path)
+    try:
+        # Loaded in classic storage and converted at the end, whatever PMS_STORAGE says
+        service.migrate_schema(conn, storage=None)
+        names = specialist_names(specialists)
+        conn.execute("DELETE FROM specialists")
+        conn.executemany("INSERT INTO specialists (specialist_name, is_active) VALUES (?, 1)", [(n,) for n in names])
+        # Seeded rows are existing history: skip the per-row FTS, change_log, count and stats triggers and index in one pass
+        triggers = service.drop_bulk_insert_triggers(conn)
+        written = 0
+        for batch in patient_rows(rows, names, seed):
+            conn.executemany(service.INSERT_PATIENT_SQL, batch)
+            written += len(batch)
+            if progress:
+                progress(written)
+        if service.has_search_index(conn):
+            conn.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+        service.recount_specialist_patients(conn)
+        service.rebuild_patient_stats(conn)
+        service.restore_bulk_insert_triggers(conn, triggers)
+        conn.execute("DELETE FROM change_log")
+        conn.commit()
+        if storage != service.STORAGE_CLASSIC:
+            service.convert_storage(conn, storage)
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    os.replace(temp_path, db_path)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(temp_path + suffix):
+            os.remove(temp_path + suffix)
+
+
+def dataset_path(data_dir, rows, seed=0, specialists=len(service.INITIAL_SPECIALISTS), storage=service.STORAGE_CLASSIC):
+    suffix = "" if storage == service.STORAGE_CLASSIC else f"-{storage}"
+    return os.path.join(data_dir, f"patients-{rows}-s{seed}-sp{specialists}{suffix}.db")
+
+
+def ensure_dataset(data_dir, rows, seed=0, specialists=len(service.INITIAL_SPECIALISTS), storage=service.STORAGE_CLASSIC):
+    """Path of the cached dataset for these parameters, generating it on first use."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = dataset_path(data_dir, rows, seed, specialists, storage)
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        generate(path, rows, seed, specialists,
+                 lambda written: print(f"\r  generating {os.path.basename(path)}: {written:,}/{rows:,}",
+                                       end="", file=sys.stderr, flush=True), storage)
+        print(f"\r  generated {os.path.basename(path)} in {time.perf_counter() - started:.1f}s" + " " * 20,
+              file=sys.stderr)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rows", type=parse_rows)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--specialists", type=int, default=len(service.INITIAL_SPECIALISTS))
+    parser.add_argument("--storage", choices=sorted(service.STORAGE_TABLES), default=service.STORAGE_CLASSIC)
+    parser.add_argument("--db", help="output file (default: benchmarks/data/patients-<rows>-s<seed>-sp<n>[-<storage>].db)")
+    args = parser.parse_args()
+    if args.db:
+        generate(args.db, args.rows, args.seed, args.specialists, storage=args.storage)
+        print(args.db)
+    else:
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+        print(ensure_dataset(data_dir, args.rows, args.seed, args.specialists, args.storage))
+
+
+if __name__ == "__main__":
+    main()
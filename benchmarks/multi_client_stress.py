@@ -0,0 +1,130 @@
+"""Run several terminals' worth of traffic against one shared database file.
+
+Usage: python benchmarks/multi_client_stress.py [--writers N] [--readers N] [--seconds S] [--db PATH]
+
+Writers insert, update and delete patients through the app's connection
+profile, the way the entry form and bulk import do. Readers page the grid and
+poll change_log the way PatientManagementApp.poll_changes does, checking that
+sequence numbers only move forward. The run fails if any process hits
+"database is locked" or if change_log does not account for every write.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+
+INSERT_SQL = ("INSERT INTO patients (patient_name, last_name, age, ward, patient_code, specialist, "
+              "submission_date, submission_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def writer(db_path, seconds, seed, results):
+    conn = service.connect_database(db_path)
+    rng = random.Random(seed)
+    stats = {"role": "writer", "writes": 0, "locked": 0}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            choice = rng.random()
+            if choice < 0.6:
+                conn.execute(INSERT_SQL, (f"w{seed}", "family", rng.randrange(1, 100), "ward", f"S{seed}-{rng.randrange(10**6)}",
+                                          rng.choice(service.INITIAL_SPECIALISTS), "2024-01-01", "10:00:00"))
+                stats["writes"] += 1
+            elif choice < 0.8:
+                cursor = conn.execute("UPDATE patients SET age=? WHERE id=(SELECT MAX(id) FROM patients)", (rng.randrange(1, 100),))
+                stats["writes"] += cursor.rowcount
+            elif choice < 0.9:
+                cursor = conn.execute("DELETE FROM patients WHERE id=(SELECT MIN(id) FROM patients)")
+                stats["writes"] += cursor.rowcount
+            else:
+                # A small bulk batch, taking the write lock up front like import_patients
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(INSERT_SQL, [(f"b{seed}", "family", 30, "ward", f"B{seed}-{i}", service.INITIAL_SPECIALISTS[0],
+                                               "2024-01-01", "10:00:00") for i in range(50)])
+                stats["writes"] += 50
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if "locked" not in str(e):
+                raise
+            stats["locked"] += 1
+    conn.close()
+    results.put(stats)
+
+
+def reader(db_path, seconds, seed, results):
+    conn = service.connect_database(db_path)
+    rng = random.Random(seed)
+    storage = service.storage_mode(conn)
+    stats = {"role": "reader", "pages": 0, "polls": 0, "locked": 0, "out_of_order": 0}
+    last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            source = service.build_patient_source(specialist=rng.choice(service.INITIAL_SPECIALISTS), storage=storage)
+            source.total, loaded = source.open_job()(conn)
+            stats["pages"] += 1
+            rows = conn.execute("SELECT seq FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                                (last_seq, service.CHANGE_BATCH_LIMIT)).fetchall()
+            stats["polls"] += 1
+            if rows:
+                if rows[0][0] <= last_seq:
+                    stats["out_of_order"] += 1
+                last_seq = rows[-1][0]
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            stats["locked"] += 1
+    conn.close()
+    results.put(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--db", help="existing database to use (default: a fresh temporary one)")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="pms-stress-"), "hospital_patients.db")
+    conn = service.connect_database(db_path)
+    service.migrate_schema(conn)
+    start_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+    conn.close()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=writer, args=(db_path, args.seconds, i, results)) for i in range(args.writers)]
+    processes += [multiprocessing.Process(target=reader, args=(db_path, args.seconds, 1000 + i, results)) for i in range(args.readers)]
+    for process in processes:
+        process.start()
+    stats = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    conn = service.connect_database(db_path)
+    logged = conn.execute("SELECT COUNT(*) FROM change_log WHERE seq > ? AND table_name='patients'", (start_seq,)).fetchone()[0]
+    conn.close()
+    summary = {
+        "writes": sum(s.get("writes", 0) for s in stats),
+        "writes_per_sec": sum(s.get("writes", 0) for s in stats) / args.seconds,
+        "pages_per_sec": sum(s.get("pages", 0) for s in stats) / args.seconds,
+        "change_log_entries": logged,
+        "locked_errors": sum(s["locked"] for s in stats),
+        "out_of_order_polls": sum(s.get("out_of_order", 0) for s in stats),
+    }
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+    ok = summary["locked_errors"] == 0 and summary["out_of_order_polls"] == 0 and logged == summary["writes"]
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""Asynchronous HTTP/JSON API over the patient service layer.
+
+Usage: python patient_api.py [--host HOST] [--port N] [--db PATH] [--workers N]
+
+Endpoints (request and response bodies are JSON):
+  GET    /health
+  GET    /specialists                  {"active": [...], "all": [...]}
+  POST   /specialists                  {"name": ...}
+  DELETE /specialists/<name>           deactivate; refused while patients refer to it
+  GET    /patients                     ?specialist=&ward=&date_from=&date_to=&age_min=&age_max=&q=&limit=&cursor=
+                                       &total=1; the criteria combine with AND
+                                       ?as_of=YYYY-MM-DD[ HH:MM:SS] lists the patients as they were then
+                                       (an as_of date alone means the end of that day)
+                                       a date range reaching archived years reads their archive files too, as
+                                       does q without dates (the newest 8 years; "archived_years_skipped"
+                                       lists older ones left out)
+  GET    /patients/<id>
+  POST   /patients                     one patient object
+  PUT    /patients/<id>
+  DELETE /patients/<id>
+  POST   /patients/bulk                {"patients": [...]} -> new ids plus rejected entries
+  POST   /patients/bulk-delete         {"ids": [...]}
+  GET    /patients/deleted             ?limit= -> deleted patients not restored since, newest first
+  POST   /patients/restore             {"ids": [...]} -> the ids restored under their old ids
+  GET    /patients/<id>/history        audit entries: op, changed_at, changed_by and the row before the change
+  GET    /changes                      ?since=<seq> -> change_log summary, as polled by the GUI
+  GET    /stats                        ?date_from=&date_to=&period=day|month -> admissions per period,
+                                       specialist, ward and age decade
+  GET    /archives                     the yearly archive files older patients were moved to (read-only)
+  GET    /metrics                      latency percentiles in Prometheus text format
+  GET    /metrics.json                 the same, plus slow queries with their plans
+
+Patient writes are recorded in patient_audit as "api:<PMS_USER or login@host>".
+
+The event loop only parses and answers HTTP. Every database call runs on a
+thread pool whose threads each own a connection, so reads proceed in
+parallel under WAL while SQLite serialises the writes.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from patient_service import (
+    DB_PROFILE, DELETED_LIST_LIMIT, METRICS, PAGE_SIZE, PATIENT_COLUMNS, AsOfSource, ConflictError, NotFoundError,
+    PatientRepository, ServiceError, archived_years, audit_timestamp, audit_user, build_patient_source,
+    connect_database, has_search_index, migrate_schema, storage_mode,
+)
+
+PATIENT_FIELDS = [column.strip() for column in PATIENT_COLUMNS.split(",")]
+AUDIT_OPERATIONS = {"I": "insert", "U": "update", "D": "delete", "R": "restore"}
+MAX_PAGE_SIZE = 1000
+MAX_BODY_BYTES = 16 * 1024 * 1024
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def patient_json(row):
+    return dict(zip(PATIENT_FIELDS, row))
+
+
+def patient_values(payload):
+    # Field order of PatientRepository.add_patient / add_patients
+    if not isinstance(payload, dict):
+        raise HttpError(400, "patient must be a JSON object")
+    return tuple(payload.get(field) for field in PATIENT_FIELDS[1:])
+
+
+def int_param(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HttpError(400, f"{name} must be an integer")
+
+
+def date_param(query, name):
+    value = query.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HttpError(400, f"{name} must be a YYYY-MM-DD date")
+
+
+def moment_param(query, name):
+    value = query.get(name)
+    if not value:
+        return None
+    try:
+        if len(value) == 10:
+            return f"{date.fromisoformat(value).isoformat()} 23:59:59"
+        return audit_timestamp(datetime.fromisoformat(value))
+    except ValueError:
+        raise HttpError(400, f"{name} must be a YYYY-MM-DD date or a YYYY-MM-DD HH:MM:SS time")
+
+
+def ids_param(body):
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list):
+        raise HttpError(400, 'expected {"ids": [...]}')
+    return [int_param(patient_id, "ids") for patient_id in ids]
+
+
+class PatientApi:
+    def __init__(self, db_name, workers=8, profile=DB_PROFILE):
+        self.db_name = db_name
+        self.profile = profile
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-db")
+        conn = connect_database(db_name, profile)
+        try:
+            migrate_schema(conn)
+            self.use_search_index = has_search_index(conn)
+            self.storage = storage_mode(conn)
+        finally:
+            conn.close()
+        self.actor = f"api:{audit_user()}"
+        self.routes = [
+            ("GET", re.compile(r"/health"), self.health),
+            ("GET", re.compile(r"/specialists"), self.list_specialists),
+            ("POST", re.compile(r"/specialists"), self.add_specialist),
+            ("DELETE", re.compile(r"/specialists/([^/]+)"), self.deactivate_specialist),
+            ("GET", re.compile(r"/patients"), self.list_patients),
+            ("POST", re.compile(r"/patients"), self.add_patient),
+            ("POST", re.compile(r"/patients/bulk"), self.add_patients),
+            ("POST", re.compile(r"/patients/bulk-delete"), self.delete_patients),
+            ("GET", re.compile(r"/patients/deleted"), self.deleted_patients),
+            ("POST", re.compile(r"/patients/restore"), self.restore_patients),
+            ("GET", re.compile(r"/patients/(\d+)/history"), self.patient_history),
+            ("GET", re.compile(r"/patients/(\d+)"), self.get_patient),
+            ("PUT", re.compile(r"/patients/(\d+)"), self.update_patient),
+            ("DELETE", re.compile(r"/patients/(\d+)"), self.delete_patient),
+            ("GET", re.compile(r"/changes"), self.changes),
+            ("GET", re.compile(r"/stats"), self.stats),
+            ("GET", re.compile(r"/archives"), self.list_archives),
+            ("GET", re.compile(r"/metrics"), self.metrics_text),
+            ("GET", re.compile(r"/metrics\.json"), self.metrics_json),
+        ]
+
+    def _call(self, func):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = connect_database(self.db_name, self.profile)
+        try:
+            return func(PatientRepository(conn, self.actor))
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    async def run_db(self, func):
+        """Run `func(repository)` on the database pool and await its result."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, func)
+
+    # --- Handlers: (match, query, body) -> (status, payload) ---
+
+    async def health(self, match, query, body):
+        return 200, {"status": "ok"}
+
+    async def list_specialists(self, match, query, body):
+        active, all_specialists = await self.run_db(lambda repository: repository.get_specialists())
+        return 200, {"active": active, "all": all_specialists}
+
+    async def add_specialist(self, match, query, body):
+        name = body.get("name") if isinstance(body, dict) else None
+        if not isinstance(name, str):
+            raise HttpError(400, 'expected {"name": "..."}')
+        await self.run_db(lambda repository: repository.add_specialist(name))
+        return 201, {"name": name.strip()}
+
+    async def deactivate_specialist(self, match, query, body):
+        name = unquote(match.group(1))
+        await self.run_db(lambda repository: repository.deactivate_specialist(name))
+        return 200, {"name": name, "is_active": False}
+
+    async def list_patients(self, match, query, body):
+        limit = max(1, min(int_param(query.get("limit", PAGE_SIZE), "limit"), MAX_PAGE_SIZE))
+        cursor = int_param(query["cursor"], "cursor") if query.get("cursor") else None
+        ages = [int_param(query[name], name) if query.get(name) else None for name in ("age_min", "age_max")]
+        moment = moment_param(query, "as_of")
+        if moment is not None:
+            criteria = ("specialist", "ward", "date_from", "date_to", "age_min", "age_max", "q")
+            if any(query.get(name) for name in criteria):
+                raise HttpError(400, "as_of cannot be combined with other criteria")
+        filters = dict(specialist=query.get("specialist"), date_from=date_param(query, "date_from"),
+                       date_to=date_param(query, "date_to"), search_term=query.get("q", "").strip(),
+                       use_search_index=self.use_search_index, storage=self.storage,
+                       ward=query.get("ward") or None, age_min=ages[0], age_max=ages[1])
+        with_total = query.get("total") in ("1", "true")
+
+        def job(repository):
+            # The archived years are read per request: maintenance may have moved patients since the last one
+            archives = archived_years(repository.conn)
+            if moment is not None:
+                source = AsOfSource(moment, archives)
+            else:
+                source = build_patient_source(archives=archives, **filters)
+            rows, next_cursor = repository.list_patients(source, cursor, limit)
+            return rows, next_cursor, repository.count_patients(source) if with_total else None, source
+
+        rows, next_cursor, total, source = await self.run_db(job)
+        payload = {"items": [patient_json(row) for row in rows], "next_cursor": next_cursor}
+        if with_total:
+            payload["total"] = total
+        if getattr(source, "skipped_years", None):
+            payload["archived_years_skipped"] = list(source.skipped_years)
+        return 200, payload
+
+    async def get_patient(self, match, query, body):
+        patient_id = int(match.group(1))
+        return 200, patient_json(await self.run_db(lambda repository: repository.get_patient(patient_id)))
+
+    async def add_patient(self, match, query, body):
+        values = patient_values(body)
+        row = await self.run_db(lambda repository: repository.get_patient(repository.add_patient(*values)))
+        return 201, patient_json(row)
+
+    async def update_patient(self, match, query, body):
+        patient_id = int(match.group(1))
+        values = patient_values(body)[:6]
+
+        def job(repository):
+            repository.update_patient(patient_id, *values)
+            return repository.get_patient(patient_id)
+        return 200, patient_json(await self.run_db(job))
+
+    async def delete_patient(self, match, query, body):
+        patient_id = int(match.group(1))
+        # delete_patients raises NotFoundError for an id that is missing or archived
+        return 200, {"deleted": await self.run_db(lambda repository: repository.delete_patients([patient_id]))}
+
+    async def add_patients(self, match, query, body):
+        patients = body.get("patients") if isinstance(body, dict) else None
+        if not isinstance(patients, list):
+            raise HttpError(400, 'expected {"patients": [...]}')
+        records, rejected = [], []
+        for index, patient in enumerate(patients):
+            try:
+                records.append((index, patient_values(patient)))
+            except HttpError as e:
+                rejected.append({"index": index, "error": str(e)})
+        ids, invalid = await self.run_db(lambda repository: repository.add_patients(values for _, values in records))
+        rejected += [{"index": records[position][0], "error": message} for position, message in invalid]
+        rejected.sort(key=lambda entry: entry["index"])
+        return 201, {"ids": ids, "inserted": len(ids), "rejected": rejected}
+
+    async def delete_patients(self, match, query, body):
+        ids = ids_param(body)
+        return 200, {"deleted": await self.run_db(lambda repository: repository.delete_patients(ids))}
+
+    async def deleted_patients(self, match, query, body):
+        limit = max(1, min(int_param(query.get("limit", DELETED_LIST_LIMIT), "limit"), DELETED_LIST_LIMIT))
+        rows = await self.run_db(lambda repository: repository.deleted_patients(limit))
+        return 200, {"items": [dict(patient_json(row[:9]), deleted_at=row[9], deleted_by=row[10]) for row in rows]}
+
+    async def restore_patients(self, match, query, body):
+        ids = ids_param(body)
+        restored = await self.run_db(lambda repository: repository.restore_patients(ids))
+        return 200, {"restored": restored}
+
+    async def patient_history(self, match, query, body):
+        patient_id = int(match.group(1))
+        entries = await self.run_db(lambda repository: repository.patient_history(patient_id))
+        return 200, {"id": patient_id, "entries": [
+            {"seq": seq, "op": AUDIT_OPERATIONS.get(op, op), "changed_at": changed_at, "changed_by": changed_by,
+             "before": None if before[0] is None else patient_json((patient_id,) + tuple(before))}
+            for seq, op, changed_at, changed_by, *before in entries]}
+
+    async def changes(self, match, query, body):
+        since = int_param(query.get("since", 0), "since")
+        newest_seq, patient_ids, specialists_changed = await self.run_db(
+            lambda repository: repository.changes_since(since))
+        return 200, {"seq": newest_seq, "reload": patient_ids is None,
+                     "patient_ids": sorted(patient_ids or ()), "specialists_changed": specialists_changed}
+
+    async def stats(self, match, query, body):
+        period = query.get("period") or None
+        if period not in (None, "day", "month"):
+            raise HttpError(400, "period must be day or month")
+        date_from, date_to = date_param(query, "date_from"), date_param(query, "date_to")
+        stats = await self.run_db(lambda repository: repository.admission_stats(date_from, date_to, period))
+        for key in ("by_period", "by_specialist", "by_ward", "by_age"):
+            stats[key] = [{"key": bucket, "admissions": admissions} for bucket, admissions in stats[key]]
+        return 200, stats
+
+    async def list_archives(self, match, query, body):
+        rows = await self.run_db(lambda repository: repository.archives())
+        fields = ("year", "file_name", "patients", "archived_before", "archived_at")
+        return 200, {"items": [dict(zip(fields, row)) for row in rows]}
+
+    async def metrics_text(self, match, query, body):
+        return 200, METRICS.to_prometheus()
+
+    async def metrics_json(self, match, query, body):
+        return 200, METRICS.snapshot()
+
+    # --- HTTP plumbing ---
+
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        path = url.path.rstrip("/") or "/"
+        path_known = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(path)
+            if not match:
+                continue
+            path_known = True
+            if route_method != method:
+                continue
+            started = time.perf_counter()
+            try:
+                return await handler(match, query, json.loads(body) if body else None)
+            except json.JSONDecodeError as e:
+                return 400, {"error": f"invalid JSON: {e}"}
+            except HttpError as e:
+                return e.status, {"error": str(e)}
+            except NotFoundError as e:
+                return 404, {"error": str(e), "title": e.title}
+            except ConflictError as e:
+                return 409, {"error": str(e), "title": e.title}
+            except ServiceError as e:
+                return 400, {"error": str(e), "title": e.title}
+            except sqlite3.IntegrityError as e:
+                return 409, {"error": str(e)}
+            except Exception:
+                logging.exception(f"{method} {target} failed")
+                return 500, {"error": "internal error"}
+            finally:
+                METRICS.record("http", f"{method} {pattern.pattern}", (time.perf_counter() - started) * 1000)
+        return (405, {"error": "method not allowed"}) if path_known else (404, {"error": "not found"})
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive; one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                if not request_line.strip():
+                    continue
+                parts = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get("connection", "").lower()
+                keep_alive = len(parts) == 3 and (connection == "keep-alive" or
+                                                  (parts[2] == "HTTP/1.1" and connection != "close"))
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if len(parts) != 3 or length < 0:
+                    status, payload, keep_alive = 400, {"error": "malformed request"}, False
+                elif length > MAX_BODY_BYTES:
+                    status, payload, keep_alive = 413, {"error": "request body too large"}, False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.dispatch(parts[0], parts[1], body)
+                if isinstance(payload, str):
+                    data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+                else:
+                    data, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                             f"Content-Type: {content_type}; charset=utf-8\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.info(f"Patient API listening on {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", default="hospital_patients.db")
+    parser.add_argument("--workers", type=int, default=8, help="database threads (one connection each)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    api = PatientApi(args.db, args.workers)
+    try:
+        asyncio.run(api.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2795 @@
+"""Patient records service layer: schema, queries and business rules without any UI.
+
+Both the Tk application and the HTTP API (patient_api.py) go through this
+module, so validation, the specialist soft-delete rules, filtering, paging,
+import and export behave the same wherever they are called from.
+"""
+import calendar
+import getpass
+import sqlite3
+from datetime import datetime, date, time as dt_time, timedelta
+import logging
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+PATIENT_COLUMNS = "id, patient_name, last_name, age, ward, patient_code, specialist, submission_date, submission_time"
+# The patient columns patient_audit keeps a copy of
+PATIENT_AUDIT_COLUMNS = PATIENT_COLUMNS.split(", ", 1)[1]
+PAGE_SIZE = 200
+MAX_CACHED_PAGES = 20
+SEARCH_MATERIALIZE_LIMIT = 2000
+# Shorter search terms cannot form a trigram: they match the start of the code or a name instead (build_search_filter)
+SEARCH_SUBSTRING_MIN_CHARS = 3
+EXPORT_BATCH_SIZE = 5000
+IMPORT_BATCH_SIZE = 20000
+MAX_AGE = 149
+# FilterPlan's cost of reading a row next to the previous one, relative to looking one up by id
+SEQUENTIAL_ROW_COST = 0.15
+STATS_DAILY_MAX_DAYS = 92
+
+# PRAGMAs applied to every connection the app opens. "legacy" keeps SQLite's defaults
+# (rollback journal, synchronous=FULL); pick one with the PMS_DB_PROFILE environment variable.
+CONNECTION_PROFILES = {
+    "legacy": {},
+    "tuned": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative = KiB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+DB_PROFILE = os.environ.get("PMS_DB_PROFILE", "tuned")
+CHANGE_BATCH_LIMIT = 500
+CHANGE_LOG_RETENTION = "-1 day"
+# Latency instrumentation: PMS_METRICS=0 turns it off, PMS_SLOW_QUERY_MS sets when a statement counts as slow
+METRICS_ENABLED = os.environ.get("PMS_METRICS", "1") != "0"
+SLOW_QUERY_MS = float(os.environ.get("PMS_SLOW_QUERY_MS", "100"))
+LATENCY_WINDOW = 1024
+MAX_METRIC_SERIES = 500
+MAX_SLOW_QUERIES = 50
+# How patient rows are stored: "classic" keeps the original wide TEXT table, "compact" the
+# normalised one (see convert_storage). PMS_STORAGE converts the database on startup; unset keeps it.
+STORAGE_CLASSIC = "classic"
+STORAGE_COMPACT = "compact"
+STORAGE_TABLES = {STORAGE_CLASSIC: "patients", STORAGE_COMPACT: "patient_records"}
+STORAGE_MODE = os.environ.get("PMS_STORAGE") or None
+# Who patient_audit records as making a change: PMS_USER, else the login and machine (audit_user)
+AUDIT_USER = os.environ.get("PMS_USER") or None
+# archive_old_records moves audit entries older than this many days to the archive file; 0 keeps them all in place
+AUDIT_RETENTION_DAYS = int(os.environ.get("PMS_AUDIT_RETENTION_DAYS", "365"))
+DELETED_LIST_LIMIT = 500
+# archive_old_records moves patients submitted more than this many days ago into per-year archive files; 0 never does
+ARCHIVE_AFTER_DAYS = int(os.environ.get("PMS_ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_BATCH_SIZE = 5000
+# Archive files one query may read; SQLite attaches at most 10 databases, and the audit archive needs one
+ARCHIVE_ATTACH_LIMIT = 8
+# Scheduled online backups go here (unset = none), every BACKUP_INTERVAL_HOURS, keeping the newest BACKUP_KEEP
+BACKUP_DIR = os.environ.get("PMS_BACKUP_DIR") or None
+BACKUP_INTERVAL_HOURS = float(os.environ.get("PMS_BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.environ.get("PMS_BACKUP_KEEP", "7"))
+BACKUP_COMPRESS = os.environ.get("PMS_BACKUP_COMPRESS", "1") != "0"
+# A backup copies this many pages per step and then pauses, so the app's own queries keep the disk
+BACKUP_STEP_PAGES = 128
+BACKUP_STEP_PAUSE = 0.02
+BACKUP_CHUNK_BYTES = 256 * 1024
+# A file without WAL is copied unpinned and starts over when written meanwhile; after this many restarts it gives up
+BACKUP_MAX_RESTARTS = 5
+
+
+class PatientPageSource:
+    """Keyset-paginated view over the (optionally filtered) patients table.
+
+    Pages are fetched on demand with ``id < last_id ORDER BY id DESC LIMIT n``
+    and kept in a small LRU cache, so only the rows around the visible window
+    are ever held in memory. The cache is owned by the Tk thread; the
+    ``*_job`` methods return callables that run on the database worker and
+    only read the immutable filter plus a snapshot of the known page bounds.
+
+    Ranked result sets (``rank_sql`` given, e.g. search relevance) cannot be
+    keyset-paged on id alone and fall back to LIMIT/OFFSET over the match set.
+
+    Rows are read from ``patients`` (the one in `schema`, for an archive part
+    of a PartitionedSource); counts and page seeks go to `table`, the relation
+    actually storing them (the connection's, if None).
+    With a FilterPlan `plan`, counts may come from the summary tables and the
+    ids of each page are selected through the index the plan picks.
+    """
+
+    def __init__(self, where="", params=(), rank_sql="", rank_params=(), page_size=PAGE_SIZE,
+                 max_cached_pages=MAX_CACHED_PAGES, table=None, plan=None, schema=None):
+        self.where = where
+        self.params = tuple(params)
+        self.rank_sql = rank_sql
+        self.rank_params = tuple(rank_params)
+        self.table = table
+        self.plan = plan
+        self.schema = schema
+        self.relation = f"{schema}.patients" if schema else "patients"
+        self.page_size = page_size
+        self.max_cached_pages = max_cached_pages
+        self.total = 0
+        self.pages = OrderedDict()
+        # page index -> exclusive upper id bound of that page (None = no bound)
+        self.page_bounds = {0: None}
+
+    def _where_sql(self, extra=None):
+        clauses = [c for c in (self.where, extra) if c]
+        return " WHERE " + " AND ".join(f"({c})" for c in clauses) if clauses else ""
+
+    def _table(self, cursor, limit=None):
+        # The storage table, with the plan's index choice for reading the newest `limit` matches
+        table = self.table or patient_table(cursor.connection)
+        return table + self.plan.hint(cursor, limit) if self.plan is not None else table
+
+    def reopened(self):
+        """A new source over the same filter, with nothing cached."""
+        return PatientPageSource(self.where, self.params, self.rank_sql, self.rank_params, self.page_size,
+                                 self.max_cached_pages, self.table, self.plan, self.schema)
+
+    def _count(self, cursor):
+        if not self.where and self.table is None:
+            # Every patient has a specialist and triggers keep patient_count exact, so the
+            # unfiltered grid (the first query at startup) needs no scan of the patients
+            cursor.execute("SELECT COALESCE(SUM(patient_count), 0) FROM specialists")
+            return cursor.fetchone()[0]
+        if self.plan is not None:
+            count = self.plan.exact_count(cursor)
+            if count is not None:
+                return count
+        cursor.execute(f"SELECT COUNT(*) FROM {self._table(cursor)}{self._where_sql()}", self.params)
+        return cursor.fetchone()[0]
+
+    def _seek_bound(self, cursor, index):
+        # Jumped past pages we have not walked yet: seek the boundary id once via the id index.
+        offset = index * self.page_size - 1
+        cursor.execute(f"SELECT id FROM {self._table(cursor, offset + 1)}{self._where_sql()} "
+                       f"ORDER BY id DESC LIMIT 1 OFFSET ?", self.params + (offset,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _fetch(self, cursor, bound, limit):
+        params = self.params
+        extra = None
+        if bound is not None:
+            extra = "id < ?"
+            params += (bound,)
+        if self.plan is not None:
+            # Pick the ids through the planned index, then read just those rows
+            cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM {self.relation} WHERE id IN (SELECT id FROM "
+                           f"{self._table(cursor, limit)}{self._where_sql(extra)} ORDER BY id DESC LIMIT ?) "
+                           f"ORDER BY id DESC", params + (limit,))
+        else:
+            cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM {self.relation}{self._where_sql(extra)} "
+                           f"ORDER BY id DESC LIMIT ?", params + (limit,))
+        return cursor.fetchall()
+
+    def _fetch_ranked(self, cursor, offset, limit):
+        cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM {self.relation}{self._where_sql()} "
+                       f"ORDER BY {self.rank_sql}, id DESC LIMIT ? OFFSET ?",
+                       self.params + self.rank_params + (limit, offset))
+        return cursor.fetchall()
+
+    def load_pages_job(self, indexes):
+        bounds = dict(self.page_bounds)
+
+        def job(conn):
+            cursor = conn.cursor()
+            loaded = []
+            for index in indexes:
+                if self.rank_sql:
+                    loaded.append((index, None, self._fetch_ranked(cursor, index * self.page_size, self.page_size)))
+                    continue
+                bound = bounds[index] if index in bounds else self._seek_bound(cursor, index)
+                rows = self._fetch(cursor, bound, self.page_size)
+                if rows:
+                    bounds[index + 1] = rows[-1][0]
+                loaded.append((index, bound, rows))
+            return loaded
+        return job
+
+    def head_job(self, limit):
+        # First `limit` rows in display order; lets callers materialise small result sets in one query
+        def job(conn):
+            cursor = conn.cursor()
+            if self.rank_sql:
+                return self._fetch_ranked(cursor, 0, limit)
+            return self._fetch(cursor, None, limit)
+        return job
+
+    def open_job(self):
+        load_first_page = self.load_pages_job([0])
+
+        def job(conn):
+            return self._count(conn.cursor()), load_first_page(conn)
+        return job
+
+    def head_or_open_job(self, materialize_limit=SEARCH_MATERIALIZE_LIMIT):
+        # Result sets of up to `materialize_limit` rows come back whole as (rows, None);
+        # larger ones as (None, open_job() result) to be paged like any other filter
+        head = self.head_job(materialize_limit + 1)
+        open_source = self.open_job()
+
+        def job(conn):
+            rows = head(conn)
+            if len(rows) <= materialize_limit:
+                return rows, None
+            return None, open_source(conn)
+        return job
+
+    def _matching_rows(self, cursor, ids, columns=PATIENT_COLUMNS):
+        # The rows among `ids` that pass the filter, looked up by primary key in chunks
+        ids = sorted(ids)
+        matching = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f"SELECT {columns} FROM {self.relation}"
+                           f"{self._where_sql('id IN (' + ', '.join('?' * len(chunk)) + ')')}",
+                           self.params + tuple(chunk))
+            matching.extend(cursor.fetchall())
+        return matching
+
+    def refresh_job(self, changed_ids):
+        # Re-read just the changed rows that still pass the filter, plus the new total
+        def job(conn):
+            cursor = conn.cursor()
+            return self._matching_rows(cursor, changed_ids), self._count(cursor)
+        return job
+
+    def mutation_job(self, write, ids=()):
+        """Job running ``write(conn)`` and returning ``(changed_ids, matching, delta)`` for this view.
+
+        `ids` are the existing patients the write touches; `write` returns the ids
+        of any it inserts. Only those rows are checked against the filter, before
+        and after the write, so the caller can pass ``total + delta`` to
+        apply_changes without counting the whole filter again.
+        """
+        def job(conn):
+            cursor = conn.cursor()
+            before = len(self._matching_rows(cursor, ids, "id")) if ids else 0
+            changed = set(ids) | set(write(conn) or ())
+            matching = self._matching_rows(cursor, changed)
+            return changed, matching, len(matching) - before
+        return job
+
+    def check_writable(self, cursor, ids):
+        """Raise ConflictError if any of `ids` shown by this view cannot be edited or deleted."""
+
+    def apply_changes(self, changed_ids, matching, total):
+        """Patch the cached pages after the rows in `changed_ids` were written.
+
+        `matching` holds those rows that still pass the filter. When every change
+        falls inside the run of cached pages starting at the top, that run is
+        re-sorted and re-chunked in memory; otherwise only the pages that lie
+        entirely above the changes (whose positions cannot have moved) are kept.
+        Returns False when the caller has to reload instead.
+        """
+        if self.rank_sql:
+            # Ranked pages are addressed by offset, which any change can shift: refetch the visible ones
+            self.total = total
+            self.pages.clear()
+            return True
+        old_total, self.total = self.total, total
+        run = []
+        index = 0
+        while index in self.pages:
+            run.extend(self.pages[index])
+            index += 1
+        covers_all = len(run) >= old_total
+        if run and (covers_all or min(changed_ids) > run[-1][0]):
+            rows = [row for row in run if row[0] not in changed_ids] + list(matching)
+            rows.sort(key=lambda row: row[0], reverse=True)
+            self.pages.clear()
+            self.page_bounds = {0: None}
+            for index, start in enumerate(range(0, len(rows), self.page_size)):
+                chunk = rows[start:start + self.page_size]
+                if len(chunk) < self.page_size and not covers_all:
+                    break
+                self.pages[index] = chunk
+                self.page_bounds[index + 1] = chunk[-1][0]
+            return True
+
+        highest = max(changed_ids)
+        for index in list(self.pages):
+            rows = self.pages[index]
+            if not rows or rows[-1][0] <= highest:
+                del self.pages[index]
+        self.page_bounds = {index: bound for index, bound in self.page_bounds.items()
+                            if index == 0 or (bound is not None and bound > highest)}
+        return True
+
+    def store_pages(self, loaded):
+        for index, bound, rows in loaded:
+            self.page_bounds[index] = bound
+            if rows and not self.rank_sql:
+                self.page_bounds[index + 1] = rows[-1][0]
+            self.pages[index] = rows
+            self.pages.move_to_end(index)
+        while len(self.pages) > self.max_cached_pages:
+            self.pages.popitem(last=False)
+
+    def missing_pages(self, start, count):
+        end = min(start + count, self.total)
+        if end <= start:
+            return []
+        first, last = start // self.page_size, (end - 1) // self.page_size
+        return [index for index in range(first, last + 1) if index not in self.pages]
+
+    def is_cached(self, index):
+        return index in self.pages
+
+    def rows(self, start, count):
+        # Only valid once missing_pages() is empty for the same window.
+        end = min(start + count, self.total)
+        result = []
+        while start < end:
+            index, page_offset = divmod(start, self.page_size)
+            page_rows = self.pages.get(index)
+            if not page_rows:
+                break
+            self.pages.move_to_end(index)
+            chunk = page_rows[page_offset:page_offset + end - start]
+            result.extend(chunk)
+            start += len(chunk)
+        return result
+
+    def iter_batches(self, cursor, batch_size=EXPORT_BATCH_SIZE):
+        # One streaming statement over the whole result set, read with fetchmany (used for exports)
+        order_sql = f"{self.rank_sql}, id DESC" if self.rank_sql else "id DESC"
+        if self.plan is not None:
+            cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM {self.relation} WHERE id IN (SELECT id FROM "
+                           f"{self._table(cursor)}{self._where_sql()}) ORDER BY id DESC", self.params)
+        else:
+            cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM {self.relation}{self._where_sql()} ORDER BY {order_sql}",
+                           self.params + (self.rank_params if self.rank_sql else ()))
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return
+            yield batch
+
+
+class CachedResultSource(PatientPageSource):
+    """A fully materialised result set served from memory (small search results).
+
+    Given the `source` it was read through and the search `term`, changed rows
+    are re-checked against the same filter and merged back in rank order.
+    """
+
+    def __init__(self, rows, source=None, term=None):
+        if source is None:
+            super().__init__()
+        else:
+            super().__init__(source.where, source.params, source.rank_sql, source.rank_params, table=source.table,
+                             plan=source.plan, schema=source.schema)
+        self.source = source
+        self.all_rows = rows
+        self.total = len(rows)
+        self.term = term
+
+    def missing_pages(self, start, count):
+        return []
+
+    def is_cached(self, index):
+        return True
+
+    def check_writable(self, cursor, ids):
+        if self.source is not None:
+            self.source.check_writable(cursor, ids)
+
+    def rows(self, start, count):
+        return self.all_rows[start:start + count]
+
+    def apply_changes(self, changed_ids, matching, total):
+        if self.term is None:
+            return False
+        rows = [row for row in self.all_rows if row[0] not in changed_ids] + list(matching)
+        rows.sort(key=lambda row: (search_rank(row, self.term), -row[0]))
+        self.all_rows = rows
+        self.total = len(rows)
+        return True
+
+    def iter_batches(self, cursor, batch_size=EXPORT_BATCH_SIZE):
+        for start in range(0, self.total, batch_size):
+            yield self.all_rows[start:start + batch_size]
+
+
+class AsOfSource(PatientPageSource):
+    """The patients as they were at `moment` ('YYYY-MM-DD HH:MM:SS'), rebuilt from patient_audit.
+
+    A patient untouched since then is read from patients as it is now; one
+    updated or deleted since is read from its first audit entry after the
+    moment, which holds the row as it was before that change. Patients added
+    since, or restored after being deleted before it, are left out. The work
+    grows with the changes made after `moment`, not with the history before.
+    Patients moved to the archive files of `years` (archived_years) are read
+    from there: archived rows never change, so each one without an audit
+    entry after the moment was there as it is.
+    """
+
+    def __init__(self, moment, years=(), page_size=PAGE_SIZE, max_cached_pages=MAX_CACHED_PAGES):
+        super().__init__(page_size=page_size, max_cached_pages=max_cached_pages)
+        self.moment = moment
+        self.years = tuple(years)
+        # ?1 is the moment; parameters written as ? after it continue from ?2
+        untouched = "id NOT IN (SELECT patient_id FROM main.patient_audit WHERE changed_at > ?1)"
+        archived = "".join(f"""
+            UNION ALL
+            SELECT {PATIENT_COLUMNS} FROM {archive_schema(year)}.patients WHERE {untouched}""" for year in self.years)
+        self.history_relation = f"""(
+            SELECT {PATIENT_COLUMNS} FROM main.patients WHERE {untouched}{archived}
+            UNION ALL
+            SELECT patient_id, {PATIENT_AUDIT_COLUMNS} FROM main.patient_audit
+            WHERE seq IN (SELECT MIN(seq) FROM main.patient_audit WHERE changed_at > ?1 GROUP BY patient_id)
+              AND op IN ('U', 'D')
+        )"""
+
+    def reopened(self):
+        return AsOfSource(self.moment, self.years, self.page_size, self.max_cached_pages)
+
+    def _check_history(self, cursor):
+        horizon = cursor.execute("SELECT MAX(compacted_before) FROM audit_compactions").fetchone()[0]
+        if horizon is not None and self.moment < horizon:
+            raise ConflictError("تاریخچه بایگانی شده", f".تغییرات پیش از {horizon} به فایل بایگانی منتقل شده‌اند")
+        attach_archives(cursor.connection, self.years)
+
+    def _count(self, cursor):
+        # Patients now, less those changed since the moment, plus those of them that existed then;
+        # each archive file counts its patients in its own summary
+        self._check_history(cursor)
+        archived = "".join(f"""
+                 + (SELECT COALESCE(SUM(admissions), 0) FROM {schema}.patient_stats WHERE dimension = 'specialist')
+                 - (SELECT COUNT(*) FROM {schema}.patients
+                    WHERE id IN (SELECT patient_id FROM main.patient_audit WHERE changed_at > ?1))"""
+                           for schema in map(archive_schema, self.years))
+        cursor.execute(f"""
+            SELECT (SELECT COALESCE(SUM(patient_count), 0) FROM main.specialists)
+                 - (SELECT COUNT(*) FROM main.patients
+                    WHERE id IN (SELECT patient_id FROM main.patient_audit WHERE changed_at > ?1))
+                 + (SELECT COUNT(*) FROM main.patient_audit
+                    WHERE seq IN (SELECT MIN(seq) FROM main.patient_audit WHERE changed_at > ?1 GROUP BY patient_id)
+                      AND op IN ('U', 'D')){archived}
+        """, (self.moment,))
+        return cursor.fetchone()[0]
+
+    def _seek_bound(self, cursor, index):
+        attach_archives(cursor.connection, self.years)
+        cursor.execute(f"SELECT id FROM {self.history_relation} ORDER BY id DESC LIMIT 1 OFFSET ?",
+                       (self.moment, index * self.page_size - 1))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _fetch(self, cursor, bound, limit):
+        if bound is None:
+            self._check_history(cursor)
+            cursor.execute(f"SELECT * FROM {self.history_relation} ORDER BY id DESC LIMIT ?", (self.moment, limit))
+        else:
+            attach_archives(cursor.connection, self.years)
+            cursor.execute(f"SELECT * FROM {self.history_relation} WHERE id < ? ORDER BY id DESC LIMIT ?",
+                           (self.moment, bound, limit))
+        return cursor.fetchall()
+
+    def _matching_rows(self, cursor, ids, columns=PATIENT_COLUMNS):
+        attach_archives(cursor.connection, self.years)
+        ids = sorted(ids)
+        matching = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f"SELECT {columns} FROM {self.history_relation} WHERE id IN ({', '.join('?' * len(chunk))})",
+                           (self.moment,) + tuple(chunk))
+            matching.extend(cursor.fetchall())
+        return matching
+
+    def iter_batches(self, cursor, batch_size=EXPORT_BATCH_SIZE):
+        self._check_history(cursor)
+        cursor.execute(f"SELECT * FROM {self.history_relation} ORDER BY id DESC", (self.moment,))
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return
+            yield batch
+
+
+class PartitionedSource(PatientPageSource):
+    """One filter over the main file plus the archive files of the given `years`.
+
+    `hot` is the filter on the main file and each of `archives` the same
+    filter on one attached archive (built by build_patient_source). Every
+    part picks its newest matching ids through its own indexes and plan, and
+    SQLite merges the parts in id order, so a page reads about a page from
+    each part; counts add up the parts' counts, from their own summaries
+    where possible. Archived rows never change, so writes only concern `hot`.
+    `skipped_years` are archived years the filter would cover but does not read.
+    """
+
+    def __init__(self, hot, archives, years, skipped_years=()):
+        super().__init__(hot.where, hot.params, hot.rank_sql, hot.rank_params, hot.page_size, hot.max_cached_pages,
+                         hot.table, hot.plan)
+        self.hot = hot
+        self.archives = archives
+        self.years = tuple(years)
+        self.skipped_years = tuple(skipped_years)
+
+    def reopened(self):
+        return PartitionedSource(self.hot.reopened(), [part.reopened() for part in self.archives], self.years,
+                                 self.skipped_years)
+
+    def _parts(self, cursor):
+        attach_archives(cursor.connection, self.years)
+        return [self.hot] + self.archives
+
+    def _union(self, cursor, arm):
+        # `arm(part)` gives each part's (sql, params); the parts are joined in order with UNION ALL
+        arms = [arm(part) for part in self._parts(cursor)]
+        return " UNION ALL ".join(f"SELECT * FROM ({sql})" for sql, _ in arms), tuple(
+            value for _, params in arms for value in params)
+
+    def _newest_ids(self, cursor, part, limit, extra=None, extra_params=()):
+        return (f"SELECT id FROM {part._table(cursor, limit)}{part._where_sql(extra)} ORDER BY id DESC LIMIT ?",
+                part.params + extra_params + (limit,))
+
+    def _count(self, cursor):
+        return sum(part._count(cursor) for part in self._parts(cursor))
+
+    def _seek_bound(self, cursor, index):
+        offset = index * self.page_size - 1
+        sql, params = self._union(cursor, lambda part: self._newest_ids(cursor, part, offset + 1))
+        cursor.execute(f"SELECT id FROM ({sql}) ORDER BY id DESC LIMIT 1 OFFSET ?", params + (offset,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _fetch(self, cursor, bound, limit):
+        extra, extra_params = ("id < ?", (bound,)) if bound is not None else (None, ())
+
+        def arm(part):
+            ids_sql, params = self._newest_ids(cursor, part, limit, extra, extra_params)
+            return f"SELECT {PATIENT_COLUMNS} FROM {part.relation} WHERE id IN ({ids_sql})", params
+        sql, params = self._union(cursor, arm)
+        cursor.execute(f"SELECT * FROM ({sql}) ORDER BY id DESC LIMIT ?", params + (limit,))
+        return cursor.fetchall()
+
+    def _ranked(self, part, limit=None):
+        # The part's rows with their rank as a column, which the merged ORDER BY can refer to
+        sql = (f"SELECT {PATIENT_COLUMNS}, {part.rank_sql} AS search_rank FROM {part.relation}{part._where_sql()} "
+               f"ORDER BY search_rank, id DESC")
+        params = part.rank_params + part.params
+        return (sql + " LIMIT ?", params + (limit,)) if limit is not None else (sql, params)
+
+    def _fetch_ranked(self, cursor, offset, limit):
+        sql, params = self._union(cursor, lambda part: self._ranked(part, offset + limit))
+        cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM ({sql}) ORDER BY search_rank, id DESC LIMIT ? OFFSET ?",
+                       params + (limit, offset))
+        return cursor.fetchall()
+
+    def _matching_rows(self, cursor, ids, columns=PATIENT_COLUMNS):
+        return [row for part in self._parts(cursor) for row in part._matching_rows(cursor, ids, columns)]
+
+    def check_writable(self, cursor, ids):
+        # Writes go to the main file only; rows this view reads from an archive file are read-only
+        archived = {row[0] for part in self._parts(cursor)[1:] for row in part._matching_rows(cursor, ids, "id")}
+        if archived:
+            raise ConflictError("بیمار بایگانی‌شده", f".{len(archived)} بیمار انتخاب‌شده بایگانی شده و فقط خواندنی است")
+
+    def iter_batches(self, cursor, batch_size=EXPORT_BATCH_SIZE):
+        if self.rank_sql:
+            sql, params = self._union(cursor, self._ranked)
+            cursor.execute(f"SELECT {PATIENT_COLUMNS} FROM ({sql}) ORDER BY search_rank, id DESC", params)
+        else:
+            sql, params = self._union(cursor, lambda part: (
+                f"SELECT {PATIENT_COLUMNS} FROM {part.relation} WHERE id IN "
+                f"(SELECT id FROM {part._table(cursor)}{part._where_sql()})", part.params))
+            cursor.execute(f"SELECT * FROM ({sql}) ORDER BY id DESC", params)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return
+            yield batch
+
+
+# --- Instrumentation ---
+
+class LatencyHistogram:
+    """Count, sum and max of one latency series, plus its most recent samples for percentiles."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = deque(maxlen=window)
+
+    def record(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.samples.append(ms)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def snapshot(self):
+        return {"count": self.count, "total_ms": self.total_ms, "mean_ms": self.total_ms / self.count if self.count else 0.0,
+                "p50_ms": self.percentile(0.50), "p95_ms": self.percentile(0.95), "p99_ms": self.percentile(0.99),
+                "max_ms": self.max_ms}
+
+
+class Metrics:
+    """Thread-safe latency registry shared by every connection and UI hook in the process.
+
+    Series are keyed by (kind, name): "sql" statements (normalised text),
+    "job" database worker jobs, "ui" Tk refreshes, "export"/"import" runs and
+    "http" API routes. Statements slower than `slow_query_ms` are also kept
+    with their EXPLAIN QUERY PLAN.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED, slow_query_ms=SLOW_QUERY_MS):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.lock = threading.Lock()
+        self.series = {}
+        self.slow_queries = deque(maxlen=MAX_SLOW_QUERIES)
+        self.started = time.time()
+
+    def record(self, kind, name, ms):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.series.get((kind, name))
+            if histogram is None:
+                if len(self.series) >= MAX_METRIC_SERIES:
+                    name = "(other)"
+                histogram = self.series.setdefault((kind, name), LatencyHistogram())
+            histogram.record(ms)
+
+    @contextmanager
+    def timed(self, kind, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, (time.perf_counter() - started) * 1000)
+
+    def record_statement(self, conn, sql, parameters, ms):
+        statement = normalize_sql(sql)
+        self.record("sql", statement, ms)
+        if ms < self.slow_query_ms or parameters is None:
+            return
+        try:
+            plan = [row[3] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+        except sqlite3.Error as e:
+            plan = [f"(plan unavailable: {e})"]
+        with self.lock:
+            self.slow_queries.append({"at": datetime.now().isoformat(timespec="seconds"), "ms": ms,
+                                      "statement": statement, "plan": plan})
+        logging.warning(f"Slow query ({ms:.0f} ms): {statement} | plan: {'; '.join(plan)}")
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+            self.slow_queries.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            series = [dict(kind=kind, name=name, **histogram.snapshot())
+                      for (kind, name), histogram in self.series.items()]
+            slow_queries = list(self.slow_queries)
+        series.sort(key=lambda entry: entry["total_ms"], reverse=True)
+        return {"since": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                "slow_query_ms": self.slow_query_ms, "series": series, "slow_queries": slow_queries}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self):
+        lines = ["# HELP pms_latency_milliseconds Latency of SQL statements, worker jobs, UI refreshes, exports and API calls.",
+                 "# TYPE pms_latency_milliseconds summary"]
+        for entry in self.snapshot()["series"]:
+            name = entry["name"].replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+            labels = f'kind="{entry["kind"]}",name="{name}"'
+            for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")):
+                lines.append(f'pms_latency_milliseconds{{{labels},quantile="{quantile}"}} {entry[key]:.6g}')
+            lines.append(f"pms_latency_milliseconds_sum{{{labels}}} {entry['total_ms']:.6g}")
+            lines.append(f"pms_latency_milliseconds_count{{{labels}}} {entry['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, file_path):
+        # Format follows the extension: .prom/.txt for Prometheus text, anything else JSON
+        text = self.to_prometheus() if os.path.splitext(file_path)[1].lower() in (".prom", ".txt") else self.to_json()
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+METRICS = Metrics()
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    # One series per statement shape: collapse whitespace and variable-length "?, ?, ?" lists
+    return re.sub(r"\?(\s*,\s*\?)+", "?, ...", " ".join(sql.split()))
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement's time spent in execute and fetch calls to METRICS."""
+
+    pending = None  # [sql, parameters, seconds] of the statement still being read
+
+    def _run(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self.pending is not None:
+                self.pending[2] += time.perf_counter() - started
+
+    def finish_statement(self):
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            METRICS.record_statement(self.connection, pending[0], pending[1], pending[2] * 1000)
+
+    def execute(self, sql, parameters=()):
+        self.finish_statement()
+        self.pending = [sql, parameters, 0.0]
+        try:
+            self._run(super().execute, sql, parameters)
+        except BaseException:
+            self.finish_statement()
+            raise
+        if self.description is None:
+            self.finish_statement()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish_statement()
+        self.pending = [sql, None, 0.0]
+        try:
+            self._run(super().executemany, sql, seq_of_parameters)
+        finally:
+            self.finish_statement()
+        return self
+
+    def fetchone(self):
+        row = self._run(super().fetchone)
+        self.finish_statement()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._run(super().fetchmany, size)
+        if len(rows) < size:
+            self.finish_statement()
+        return rows
+
+    def fetchall(self):
+        rows = self._run(super().fetchall)
+        self.finish_statement()
+        return rows
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    def __del__(self):
+        try:
+            self.finish_statement()
+        except Exception:
+            pass
+
+
+class PatientConnection(sqlite3.Connection):
+    # What connect_database returns: a plain connection that also keeps its SpecialistRegistry
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.specialist_registry = SpecialistRegistry()
+        self.storage = None  # cached by storage_mode()
+
+
+class InstrumentedConnection(PatientConnection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect_database(db_name, profile=DB_PROFILE):
+    conn = sqlite3.connect(db_name, factory=InstrumentedConnection if METRICS.enabled else PatientConnection)
+    for pragma, value in CONNECTION_PROFILES[profile].items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def run_maintenance(conn):
+    # Fold the WAL back into the database so it does not grow between idle periods, then refresh planner stats
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        busy, log_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        logging.info(f"WAL checkpoint: {checkpointed}/{log_pages} pages{' (busy)' if busy else ''}.")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='change_log'").fetchone():
+        conn.execute("DELETE FROM change_log WHERE changed_at < datetime('now', ?)", (CHANGE_LOG_RETENTION,))
+        conn.commit()
+    conn.execute("PRAGMA optimize")
+
+
+def archive_old_records(conn, cancel_event=None):
+    """Move old audit entries and patients to their archive files; returns (entries, patients) moved.
+
+    Entries older than AUDIT_RETENTION_DAYS go to the audit archive, patients
+    submitted more than ARCHIVE_AFTER_DAYS ago to the yearly archive files.
+    The first run over a large database moves hundreds of thousands of rows,
+    so callers give it its own connection rather than run it with
+    run_maintenance on one the grid's queries wait behind.
+    """
+    entries = patients = 0
+    if AUDIT_RETENTION_DAYS and conn.execute("SELECT 1 FROM sqlite_master WHERE name='patient_audit'").fetchone():
+        before = audit_timestamp(datetime.now() - timedelta(days=AUDIT_RETENTION_DAYS))
+        entries = compact_audit_log(conn, before)
+        if entries:
+            logging.info(f"Moved {entries} audit entries from before {before} to the archive.")
+    if ARCHIVE_AFTER_DAYS and conn.execute("SELECT 1 FROM sqlite_master WHERE name='patient_archives'").fetchone():
+        before = (date.today() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+        patients = archive_patients(conn, before, cancel_event=cancel_event)
+        if patients:
+            logging.info(f"Moved {patients} patients submitted before {before} to the yearly archive files.")
+    return entries, patients
+
+
+INITIAL_SPECIALISTS = [
+    "قلب و عروق - دکتر کریمی", "داخلی - دکتر رضایی", "اطفال - دکتر محمدی",
+    "پوست - دکتر قاسمی", "چشم - دکتر احمدی", "ارتوپدی - دکتر حسینی",
+    "گوش و حلق و بینی - دکتر نوری", "مغز و اعصاب - دکتر مرادی",
+    "جراحی - دکتر یوسفی", "اورولوژی - دکتر بهرامی", "زنان و زایمان - دکتر علوی",
+    "ریه - دکتر پارسا", "غدد - دکتر اکبری", "گوارش - دکتر شجاعی",
+    "روانپزشکی - دکتر جمشیدی"
+]
+
+
+# --- Schema migrations ---
+# Each migration runs once, in order, inside its own transaction; PRAGMA user_version
+# records the last one applied so existing hospital_patients.db files upgrade in place.
+
+def create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            ward TEXT NOT NULL,
+            patient_code TEXT NOT NULL,
+            specialist TEXT NOT NULL,
+            submission_date TEXT NOT NULL,
+            submission_time TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS specialists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            specialist_name TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    # Insert initial specialists if table is empty
+    if conn.execute("SELECT COUNT(*) FROM specialists").fetchone()[0] == 0:
+        conn.executemany("INSERT INTO specialists (specialist_name, is_active) VALUES (?, 1)",
+                         [(spec,) for spec in INITIAL_SPECIALISTS])
+
+
+CLASSIC_PATIENTS_TABLE = '''
+    CREATE TABLE {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_name TEXT NOT NULL,
+        last_name TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        ward TEXT NOT NULL,
+        patient_code TEXT NOT NULL,
+        specialist TEXT NOT NULL REFERENCES specialists(specialist_name) ON UPDATE CASCADE,
+        submission_date TEXT NOT NULL,
+        submission_time TEXT NOT NULL
+    )
+'''
+
+
+def add_specialist_foreign_key(conn):
+    # Collapse duplicate names (keeping the oldest row, active if any copy was) so the name can be UNIQUE
+    conn.execute('''
+        UPDATE specialists SET is_active=1
+        WHERE id IN (SELECT MIN(id) FROM specialists GROUP BY specialist_name HAVING MAX(is_active)=1)
+    ''')
+    conn.execute("DELETE FROM specialists WHERE id NOT IN (SELECT MIN(id) FROM specialists GROUP BY specialist_name)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_specialists_name ON specialists(specialist_name)")
+    # Patients referencing a name that is no longer in the registry keep it as an inactive specialist
+    conn.execute('''
+        INSERT INTO specialists (specialist_name, is_active)
+        SELECT DISTINCT specialist, 0 FROM patients
+        WHERE specialist NOT IN (SELECT specialist_name FROM specialists)
+    ''')
+
+    # SQLite cannot add a constraint to an existing table, so rebuild patients around it
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='patients'").fetchone()
+    conn.execute(CLASSIC_PATIENTS_TABLE.format(name="patients_new"))
+    conn.execute(f"INSERT INTO patients_new ({PATIENT_COLUMNS}) SELECT {PATIENT_COLUMNS} FROM patients")
+    conn.execute("DROP TABLE patients")
+    conn.execute("ALTER TABLE patients_new RENAME TO patients")
+    if sequence:
+        conn.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='patients'", sequence)
+
+
+# The columns search terms are matched against, and their NOCASE indexes for short terms
+SEARCH_COLUMNS = ("patient_code", "patient_name", "last_name")
+
+
+def create_search_prefix_indexes(conn, table="patients"):
+    for column in SEARCH_COLUMNS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column}_nocase ON {table}({column} COLLATE NOCASE)")
+
+
+def add_patient_indexes(conn):
+    # Serve the keyset-paged specialist filter, the date range filter and the in-use check in delete_specialist
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_specialist_id ON patients(specialist, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_submission_date_id ON patients(submission_date, id)")
+
+
+PATIENTS_FTS_INSERT_TRIGGER = '''
+    CREATE TRIGGER patients_fts_insert AFTER INSERT ON patients BEGIN
+        INSERT INTO patients_fts (rowid, patient_code, patient_name, last_name)
+        VALUES (new.id, new.patient_code, new.patient_name, new.last_name);
+    END
+'''
+
+
+SPECIALIST_COUNT_INSERT_TRIGGER = '''
+    CREATE TRIGGER specialists_count_insert AFTER INSERT ON patients BEGIN
+        UPDATE specialists SET patient_count = patient_count + 1 WHERE specialist_name = new.specialist;
+    END
+'''
+
+
+CHANGE_LOG_INSERT_TRIGGER = '''
+    CREATE TRIGGER change_log_patients_insert AFTER INSERT ON patients BEGIN
+        INSERT INTO change_log (table_name, row_id, op) VALUES ('patients', new.id, 'I');
+    END
+'''
+
+
+def add_patient_search_index(conn):
+    # Trigram FTS5 index over code and names: serves substring search without scanning patients
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE patients_fts USING fts5(
+                patient_code, patient_name, last_name,
+                content='patients', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 trigram search is not available in this SQLite build ({e}); falling back to LIKE search.")
+        return
+    conn.execute(PATIENTS_FTS_INSERT_TRIGGER)
+    conn.execute('''
+        CREATE TRIGGER patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, patient_code, patient_name, last_name)
+            VALUES ('delete', old.id, old.patient_code, old.patient_name, old.last_name);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER patients_fts_update AFTER UPDATE OF patient_code, patient_name, last_name ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, patient_code, patient_name, last_name)
+            VALUES ('delete', old.id, old.patient_code, old.patient_name, old.last_name);
+            INSERT INTO patients_fts (rowid, patient_code, patient_name, last_name)
+            VALUES (new.id, new.patient_code, new.patient_name, new.last_name);
+        END
+    ''')
+    conn.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+
+
+def add_change_log(conn):
+    # Every workstation polls this table to refresh just the rows other terminals changed
+    conn.execute('''
+        CREATE TABLE change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute(CHANGE_LOG_INSERT_TRIGGER)
+    for table, event, op, row in (("patients", "UPDATE", "U", "new"), ("patients", "DELETE", "D", "old"),
+                                  ("specialists", "INSERT", "I", "new"), ("specialists", "UPDATE", "U", "new")):
+        conn.execute(f'''
+            CREATE TRIGGER change_log_{table}_{event.lower()} AFTER {event} ON {table} BEGIN
+                INSERT INTO change_log (table_name, row_id, op) VALUES ('{table}', {row}.id, '{op}');
+            END
+        ''')
+
+
+def recount_specialist_patients(conn):
+    # One index range count per specialist; for migrations and after writes that bypassed the triggers
+    if storage_mode(conn) == STORAGE_CLASSIC:
+        conn.execute("UPDATE specialists SET patient_count = "
+                     "(SELECT COUNT(*) FROM patients WHERE specialist = specialist_name)")
+    else:
+        conn.execute("UPDATE specialists SET patient_count = "
+                     "(SELECT COUNT(*) FROM patient_records WHERE specialist_id = specialists.id)")
+
+
+def add_specialist_patient_counts(conn):
+    # Keep each specialist's patient count on its row, so the in-use check and SpecialistRegistry never count patients
+    conn.execute("ALTER TABLE specialists ADD COLUMN patient_count INTEGER NOT NULL DEFAULT 0")
+    recount_specialist_patients(conn)
+    conn.execute(SPECIALIST_COUNT_INSERT_TRIGGER)
+    conn.execute('''
+        CREATE TRIGGER specialists_count_delete AFTER DELETE ON patients BEGIN
+            UPDATE specialists SET patient_count = patient_count - 1 WHERE specialist_name = old.specialist;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER specialists_count_update AFTER UPDATE OF specialist ON patients
+        WHEN old.specialist IS NOT new.specialist BEGIN
+            UPDATE specialists SET patient_count = patient_count - 1 WHERE specialist_name = old.specialist;
+            UPDATE specialists SET patient_count = patient_count + 1 WHERE specialist_name = new.specialist;
+        END
+    ''')
+    # Count bookkeeping is not a specialist change the other terminals need to reload for
+    conn.execute("DROP TRIGGER change_log_specialists_update")
+    conn.execute('''
+        CREATE TRIGGER change_log_specialists_update AFTER UPDATE OF specialist_name, is_active ON specialists BEGIN
+            INSERT INTO change_log (table_name, row_id, op) VALUES ('specialists', new.id, 'U');
+        END
+    ''')
+
+
+PATIENT_STATS_TABLE = '''
+    CREATE TABLE patient_stats (
+        dimension TEXT NOT NULL,
+        day TEXT NOT NULL,
+        bucket NOT NULL,
+        admissions INTEGER NOT NULL,
+        PRIMARY KEY (dimension, day, bucket)
+    ) WITHOUT ROWID
+'''
+
+# Adds the admissions of the patients with id > ?1 to patient_stats: the whole table from 0,
+# or the rows of a bulk load that ran with the per-row trigger dropped
+PATIENT_STATS_CATCH_UP_SQL = '''
+    INSERT INTO patient_stats (dimension, day, bucket, admissions)
+    SELECT 'specialist', submission_date, specialist, COUNT(*) FROM patients WHERE id > ?1 GROUP BY 2, 3
+    UNION ALL
+    SELECT 'ward', submission_date, ward, COUNT(*) FROM patients WHERE id > ?1 GROUP BY 2, 3
+    UNION ALL
+    SELECT 'age', submission_date, age / 10 * 10, COUNT(*) FROM patients WHERE id > ?1 GROUP BY 2, 3
+    ON CONFLICT (dimension, day, bucket) DO UPDATE SET admissions = admissions + excluded.admissions
+'''
+
+
+def patient_stats_terms(storage, row):
+    # (day, [(dimension, bucket)], columns that move a patient between buckets) in the trigger's terms
+    if storage == STORAGE_CLASSIC:
+        return (f"{row}.submission_date",
+                [("specialist", f"{row}.specialist"), ("ward", f"{row}.ward"), ("age", f"{row}.age / 10 * 10")],
+                ["specialist", "ward", "age", "submission_date"])
+    return (f"date({row}.submitted_at, 'unixepoch')",
+            [("specialist", f"(SELECT specialist_name FROM specialists WHERE id = {row}.specialist_id)"),
+             ("ward", f"(SELECT ward_name FROM wards WHERE id = {row}.ward_id)"), ("age", f"{row}.age / 10 * 10")],
+            ["specialist_id", "ward_id", "age", "submitted_at"])
+
+
+def create_patient_stats_triggers(conn, storage):
+    table = STORAGE_TABLES[storage]
+
+    def add(row):
+        day, buckets, _ = patient_stats_terms(storage, row)
+        values = ", ".join(f"('{dimension}', {day}, {bucket}, 1)" for dimension, bucket in buckets)
+        return (f"INSERT INTO patient_stats (dimension, day, bucket, admissions) VALUES {values} "
+                "ON CONFLICT (dimension, day, bucket) DO UPDATE SET admissions = admissions + 1;")
+
+    def remove(row):
+        day, buckets, _ = patient_stats_terms(storage, row)
+        return "\n".join(f"UPDATE patient_stats SET admissions = admissions - 1 "
+                         f"WHERE dimension = '{dimension}' AND day = {day} AND bucket = {bucket};"
+                         for dimension, bucket in buckets)
+
+    old_day, old_buckets, columns = patient_stats_terms(storage, "old")
+    new_day, new_buckets, _ = patient_stats_terms(storage, "new")
+    moved = " OR ".join(f"{old} IS NOT {new}" for old, new in zip(
+        [old_day] + [bucket for _, bucket in old_buckets], [new_day] + [bucket for _, bucket in new_buckets]))
+    conn.execute(f"CREATE TRIGGER patient_stats_insert AFTER INSERT ON {table} BEGIN {add('new')} END")
+    conn.execute(f"CREATE TRIGGER patient_stats_delete AFTER DELETE ON {table} BEGIN {remove('old')} END")
+    conn.execute(f'''
+        CREATE TRIGGER patient_stats_update AFTER UPDATE OF {", ".join(columns)} ON {table}
+        WHEN {moved} BEGIN
+            {remove('old')}
+            {add('new')}
+        END
+    ''')
+
+
+def rebuild_patient_stats(conn):
+    conn.execute("DELETE FROM patient_stats")
+    conn.execute(PATIENT_STATS_CATCH_UP_SQL, (0,))
+
+
+def add_patient_stats(conn):
+    # Admissions per day by specialist, ward and age decade, so the statistics window sums
+    # a few thousand summary rows instead of scanning every patient
+    conn.execute(PATIENT_STATS_TABLE)
+    create_patient_stats_triggers(conn, storage_mode(conn))
+    rebuild_patient_stats(conn)
+
+
+PATIENT_AUDIT_TABLE = '''
+    CREATE TABLE {name} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        changed_at TEXT NOT NULL,
+        changed_by TEXT NOT NULL,
+        patient_name TEXT,
+        last_name TEXT,
+        age INTEGER,
+        ward TEXT,
+        patient_code TEXT,
+        specialist TEXT,
+        submission_date TEXT,
+        submission_time TEXT
+    )
+'''
+
+PATIENT_AUDIT_GUARDS = {
+    event: f'''
+    CREATE TRIGGER patient_audit_no_{event.lower()} BEFORE {event} ON patient_audit BEGIN
+        SELECT RAISE(ABORT, 'patient_audit is append-only');
+    END
+    '''
+    for event in ("UPDATE", "DELETE")
+}
+
+
+def add_patient_audit(conn):
+    # Append-only history of patient writes: who, when, and for updates and deletes the row as it
+    # was before, so deleted patients can be restored and any past state rebuilt (AsOfSource)
+    conn.execute(PATIENT_AUDIT_TABLE.format(name="patient_audit"))
+    conn.execute("CREATE INDEX idx_patient_audit_patient_seq ON patient_audit(patient_id, seq)")
+    conn.execute("CREATE INDEX idx_patient_audit_changed_at ON patient_audit(changed_at)")
+    for statement in PATIENT_AUDIT_GUARDS.values():
+        conn.execute(statement)
+    conn.execute('''
+        CREATE TABLE audit_compactions (
+            compacted_before TEXT NOT NULL,
+            archive_path TEXT NOT NULL,
+            entries INTEGER NOT NULL,
+            compacted_at TEXT NOT NULL
+        )
+    ''')
+
+
+def add_patient_archives(conn):
+    # The per-year archive files patients were moved to (archive_patients), for date ranges to reach them
+    conn.execute('''
+        CREATE TABLE patient_archives (
+            year INTEGER PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            patients INTEGER NOT NULL,
+            archived_before TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    ''')
+
+
+
+def add_search_prefix_indexes(conn):
+    # Short search terms become prefix ranges on these (build_search_filter); archive files made before get them too
+    create_search_prefix_indexes(conn, patient_table(conn))
+    directory = os.path.dirname(main_database_file(conn))
+    for (file_name,) in conn.execute("SELECT file_name FROM patient_archives").fetchall():
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            archive = sqlite3.connect(path)
+            try:
+                create_search_prefix_indexes(archive)
+                archive.commit()
+            finally:
+                archive.close()
+
+
+SCHEMA_MIGRATIONS = [
+    create_base_tables,
+    add_specialist_foreign_key,
+    add_patient_indexes,
+    add_patient_search_index,
+    add_change_log,
+    add_specialist_patient_counts,
+    add_patient_stats,
+    add_patient_audit,
+    add_patient_archives,
+    add_search_prefix_indexes,
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+
+def migrate_schema(conn, storage=STORAGE_MODE):
+    """Apply pending SCHEMA_MIGRATIONS, then convert to `storage` if given and different."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        # Foreign key enforcement cannot change inside a transaction and must be off while tables are rebuilt
+        conn.execute("PRAGMA foreign_keys=OFF")
+        for target_version, migration in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                migration(conn)
+                violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError(f"foreign key violations after migration {target_version}: {violations[:5]}")
+                conn.execute(f"PRAGMA user_version={target_version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logging.info(f"Database schema migrated to version {target_version} ({migration.__name__}).")
+        conn.execute("PRAGMA foreign_keys=ON")
+    if storage and storage != storage_mode(conn):
+        convert_storage(conn, storage)
+
+
+# --- Storage modes ---
+# "compact" keeps patient rows in patient_records: specialists and wards as integer ids into
+# their lookup tables and one INTEGER timestamp instead of two TEXT columns. A view named
+# patients, with INSTEAD OF triggers, presents the classic columns so reads and writes work
+# unchanged; filters that want the integer columns use them directly (build_patient_source).
+# Timestamps count seconds since 1970-01-01 00:00 of the recorded wall-clock time, so SQLite's
+# date()/time() give back the stored text exactly, with no time zone involved.
+
+def storage_mode(conn):
+    mode = getattr(conn, "storage", None)
+    if mode is None:
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name='patients'").fetchone()
+        mode = STORAGE_COMPACT if row and row[0] == "view" else STORAGE_CLASSIC
+        if isinstance(conn, PatientConnection):
+            conn.storage = mode
+    return mode
+
+
+def patient_table(conn):
+    # The table that holds the rows: counts, seeks and deletes by id go straight to it
+    return STORAGE_TABLES[storage_mode(conn)]
+
+
+def date_epoch(value):
+    """Timestamp of 00:00 on the ISO date `value`, in the compact storage's convention."""
+    return calendar.timegm(date.fromisoformat(value).timetuple())
+
+
+COMPACT_TIMESTAMP_SQL = "CAST(strftime('%s', {0}submission_date || ' ' || {0}submission_time) AS INTEGER)"
+
+COMPACT_STORAGE_TABLES = [
+    '''
+    CREATE TABLE wards (
+        id INTEGER PRIMARY KEY,
+        ward_name TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE patient_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_name TEXT NOT NULL,
+        last_name TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        ward_id INTEGER NOT NULL REFERENCES wards(id),
+        patient_code TEXT NOT NULL,
+        specialist_id INTEGER NOT NULL REFERENCES specialists(id),
+        submitted_at INTEGER NOT NULL
+    )
+    ''',
+]
+
+COMPACT_PATIENTS_VIEW = '''
+    CREATE VIEW {name} AS
+    SELECT r.id, r.patient_name, r.last_name, r.age, w.ward_name AS ward, r.patient_code,
+           s.specialist_name AS specialist, date(r.submitted_at, 'unixepoch') AS submission_date,
+           time(r.submitted_at, 'unixepoch') AS submission_time, r.ward_id, r.specialist_id, r.submitted_at
+    FROM patient_records r
+    LEFT JOIN wards w ON w.id = r.ward_id
+    LEFT JOIN specialists s ON s.id = r.specialist_id
+'''
+
+COMPACT_VIEW_TRIGGERS = [
+    f'''
+    CREATE TRIGGER patients_insert INSTEAD OF INSERT ON patients BEGIN
+        INSERT OR IGNORE INTO wards (ward_name) VALUES (new.ward);
+        INSERT INTO patient_records (id, patient_name, last_name, age, ward_id, patient_code, specialist_id, submitted_at)
+        VALUES (new.id, new.patient_name, new.last_name, new.age, (SELECT id FROM wards WHERE ward_name = new.ward),
+                new.patient_code, (SELECT id FROM specialists WHERE specialist_name = new.specialist),
+                {COMPACT_TIMESTAMP_SQL.format("new.")});
+    END
+    ''',
+    f'''
+    CREATE TRIGGER patients_update INSTEAD OF UPDATE ON patients BEGIN
+        INSERT OR IGNORE INTO wards (ward_name) VALUES (new.ward);
+        UPDATE patient_records
+        SET patient_name = new.patient_name, last_name = new.last_name, age = new.age,
+            ward_id = (SELECT id FROM wards WHERE ward_name = new.ward), patient_code = new.patient_code,
+            specialist_id = (SELECT id FROM specialists WHERE specialist_name = new.specialist),
+            submitted_at = {COMPACT_TIMESTAMP_SQL.format("new.")}
+        WHERE id = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER patients_delete INSTEAD OF DELETE ON patients BEGIN
+        DELETE FROM patient_records WHERE id = old.id;
+    END
+    ''',
+]
+
+
+def create_storage_indexes(conn, storage):
+    if storage == STORAGE_CLASSIC:
+        add_patient_indexes(conn)
+        create_search_prefix_indexes(conn)
+        return
+    # Covering for the keyset-paged specialist filter and the date range filter
+    conn.execute("CREATE INDEX idx_patient_records_specialist_id ON patient_records(specialist_id, id DESC)")
+    conn.execute("CREATE INDEX idx_patient_records_submitted_at_id ON patient_records(submitted_at, id)")
+    create_search_prefix_indexes(conn, "patient_records")
+
+
+def create_storage_triggers(conn, storage):
+    # The search index, change_log and specialist count triggers, on whichever table holds the rows
+    table = STORAGE_TABLES[storage]
+    owner = "specialist" if storage == STORAGE_CLASSIC else "specialist_id"
+    match = "specialist_name" if storage == STORAGE_CLASSIC else "id"
+    if has_search_index(conn):
+        conn.execute(f'''
+            CREATE TRIGGER patients_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO patients_fts (rowid, patient_code, patient_name, last_name)
+                VALUES (new.id, new.patient_code, new.patient_name, new.last_name);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER patients_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO patients_fts (patients_fts, rowid, patient_code, patient_name, last_name)
+                VALUES ('delete', old.id, old.patient_code, old.patient_name, old.last_name);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER patients_fts_update AFTER UPDATE OF patient_code, patient_name, last_name ON {table} BEGIN
+                INSERT INTO patients_fts (patients_fts, rowid, patient_code, patient_name, last_name)
+                VALUES ('delete', old.id, old.patient_code, old.patient_name, old.last_name);
+                INSERT INTO patients_fts (rowid, patient_code, patient_name, last_name)
+                VALUES (new.id, new.patient_code, new.patient_name, new.last_name);
+            END
+        ''')
+    for event, op, row in (("INSERT", "I", "new"), ("UPDATE", "U", "new"), ("DELETE", "D", "old")):
+        conn.execute(f'''
+            CREATE TRIGGER change_log_patients_{event.lower()} AFTER {event} ON {table} BEGIN
+                INSERT INTO change_log (table_name, row_id, op) VALUES ('patients', {row}.id, '{op}');
+            END
+        ''')
+    conn.execute(f'''
+        CREATE TRIGGER specialists_count_insert AFTER INSERT ON {table} BEGIN
+            UPDATE specialists SET patient_count = patient_count + 1 WHERE {match} = new.{owner};
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER specialists_count_delete AFTER DELETE ON {table} BEGIN
+            UPDATE specialists SET patient_count = patient_count - 1 WHERE {match} = old.{owner};
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER specialists_count_update AFTER UPDATE OF {owner} ON {table}
+        WHEN old.{owner} IS NOT new.{owner} BEGIN
+            UPDATE specialists SET patient_count = patient_count - 1 WHERE {match} = old.{owner};
+            UPDATE specialists SET patient_count = patient_count + 1 WHERE {match} = new.{owner};
+        END
+    ''')
+    create_patient_stats_triggers(conn, storage)
+
+
+def _check_copy(conn, source, target):
+    # Every row, compared column by column; raises rather than commit a lossy conversion
+    different = conn.execute(f"SELECT COUNT(*) FROM (SELECT {PATIENT_COLUMNS} FROM {source} "
+                             f"EXCEPT SELECT {PATIENT_COLUMNS} FROM {target})").fetchone()[0]
+    counts = [conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0] for name in (source, target)]
+    if different or counts[0] != counts[1]:
+        raise sqlite3.IntegrityError(f"storage conversion would change {different} of {counts[0]} patients")
+
+
+def _to_compact(conn):
+    unconvertible = [row[0] for row in conn.execute(
+        f"SELECT id FROM patients WHERE {COMPACT_TIMESTAMP_SQL.format('')} IS NULL "
+        f"OR date({COMPACT_TIMESTAMP_SQL.format('')}, 'unixepoch') IS NOT submission_date "
+        f"OR time({COMPACT_TIMESTAMP_SQL.format('')}, 'unixepoch') IS NOT submission_time LIMIT 10")]
+    if unconvertible:
+        raise ValueError(f"submission date/time cannot be stored as a timestamp for patients {unconvertible}")
+    for statement in COMPACT_STORAGE_TABLES:
+        conn.execute(statement)
+    # The most used wards get the smallest ids, which SQLite stores in a single byte
+    conn.execute("INSERT INTO wards (ward_name) SELECT ward FROM patients GROUP BY ward ORDER BY COUNT(*) DESC, ward")
+    conn.execute(f'''
+        INSERT INTO patient_records (id, patient_name, last_name, age, ward_id, patient_code, specialist_id, submitted_at)
+        SELECT p.id, p.patient_name, p.last_name, p.age, w.id, p.patient_code, s.id, {COMPACT_TIMESTAMP_SQL.format("p.")}
+        FROM patients p JOIN wards w ON w.ward_name = p.ward LEFT JOIN specialists s ON s.specialist_name = p.specialist
+        ORDER BY p.id
+    ''')
+    conn.execute(COMPACT_PATIENTS_VIEW.format(name="patients_compact"))
+    _check_copy(conn, "patients", "patients_compact")
+    conn.execute("DROP VIEW patients_compact")
+    # Keep AUTOINCREMENT from ever reusing the id of a deleted patient
+    conn.execute("DELETE FROM sqlite_sequence WHERE name='patient_records'")
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'patient_records', seq FROM sqlite_sequence "
+                 "WHERE name='patients'")
+    conn.execute("DROP TABLE patients")
+    conn.execute(COMPACT_PATIENTS_VIEW.format(name="patients"))
+    for statement in COMPACT_VIEW_TRIGGERS:
+        conn.execute(statement)
+
+
+def _to_classic(conn):
+    conn.execute(CLASSIC_PATIENTS_TABLE.format(name="patients_classic"))
+    conn.execute(f"INSERT INTO patients_classic ({PATIENT_COLUMNS}) SELECT {PATIENT_COLUMNS} FROM patients ORDER BY id")
+    _check_copy(conn, "patients", "patients_classic")
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='patient_records'").fetchone()
+    conn.execute("DROP VIEW patients")
+    conn.execute("DROP TABLE patient_records")
+    conn.execute("DROP TABLE wards")
+    conn.execute("ALTER TABLE patients_classic RENAME TO patients")
+    if sequence:
+        conn.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='patients'", sequence)
+
+
+def convert_storage(conn, storage):
+    """Rebuild patient storage in the `storage` layout, in one transaction.
+
+    Every row is compared with its copy before the old layout is dropped, so
+    the conversion either keeps all data exactly or raises and changes
+    nothing. Ids, the search index and the change_log history carry over.
+    VACUUM afterwards returns the freed pages to the file system.
+    """
+    if storage not in STORAGE_TABLES:
+        raise ValueError(f"unknown storage mode {storage!r}")
+    started = time.perf_counter()
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if storage == STORAGE_COMPACT:
+            _to_compact(conn)
+        else:
+            _to_classic(conn)
+        create_storage_indexes(conn, storage)
+        create_storage_triggers(conn, storage)
+        violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            raise sqlite3.IntegrityError(f"foreign key violations after storage conversion: {violations[:5]}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+        if isinstance(conn, PatientConnection):
+            conn.storage = None
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    logging.info(f"Patient storage converted to {storage} in {time.perf_counter() - started:.1f}s.")
+
+
+def bulk_insert_triggers(storage):
+    # Per-row AFTER INSERT triggers on the patient rows, and the set-based statement that
+    # replaces each one while a bulk load has it dropped
+    table = STORAGE_TABLES[storage]
+    owner = "specialist = specialist_name" if storage == STORAGE_CLASSIC else "specialist_id = specialists.id"
+    return [
+        ("patients_fts_insert", f'''
+            INSERT INTO patients_fts (rowid, patient_code, patient_name, last_name)
+            SELECT id, patient_code, patient_name, last_name FROM {table} WHERE id > ?
+        '''),
+        ("change_log_patients_insert", f'''
+            INSERT INTO change_log (table_name, row_id, op) SELECT 'patients', id, 'I' FROM {table} WHERE id > ?
+        '''),
+        ("specialists_count_insert", f'''
+            UPDATE specialists SET patient_count = patient_count + (
+                SELECT COUNT(*) FROM {table} WHERE {owner} AND id > ?)
+        '''),
+        ("patient_stats_insert", PATIENT_STATS_CATCH_UP_SQL),
+    ]
+
+
+def drop_bulk_insert_triggers(conn):
+    """Drop the per-row insert triggers before a bulk load; pass the result to restore_bulk_insert_triggers."""
+    existing = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger'"))
+    triggers = [(name, existing[name], bulk_sql)
+                for name, bulk_sql in bulk_insert_triggers(storage_mode(conn)) if name in existing]
+    for name, _, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    return triggers
+
+
+def restore_bulk_insert_triggers(conn, triggers, last_old_id=None):
+    # Catch up on the rows above `last_old_id`, the highest id before the load, in one statement
+    # per trigger (None: the caller rebuilds everything itself), then put the triggers back
+    for _, create_sql, bulk_sql in triggers:
+        if last_old_id is not None:
+            conn.execute(bulk_sql, (last_old_id,))
+        conn.execute(create_sql)
+
+
+def has_search_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='patients_fts'").fetchone() is not None
+
+
+def build_search_filter(search_term, use_search_index=True, schema=None):
+    """Return (where, params, rank_sql, rank_params) matching code, first or last name.
+
+    Terms of SEARCH_SUBSTRING_MIN_CHARS or more characters match anywhere and
+    are answered by the trigram index (LIKE without it). Shorter ones cannot
+    form a trigram, and as substrings they would match most patients through
+    a full scan; they match the start of the code or a name instead, as a
+    range on each column's NOCASE index (case-insensitive for ASCII, like
+    LIKE). Results rank exact code matches first, then code prefixes, then
+    name prefixes, then other substrings. With `schema`, the indexes of that
+    attached archive are used.
+    """
+    escaped = search_term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    if len(search_term) < SEARCH_SUBSTRING_MIN_CHARS:
+        # U+10FFFF sorts after any character that can follow the term
+        where = " OR ".join(f"({column} >= ? COLLATE NOCASE AND {column} < ? COLLATE NOCASE)"
+                            for column in SEARCH_COLUMNS)
+        params = [search_term, search_term + "\U0010ffff"] * len(SEARCH_COLUMNS)
+    elif use_search_index:
+        fts_table = f"{schema}.patients_fts" if schema else "patients_fts"
+        where = f"id IN (SELECT rowid FROM {fts_table} WHERE patients_fts MATCH ?)"
+        params = ['"' + search_term.replace('"', '""') + '"']
+    else:
+        where = "patient_code LIKE ? ESCAPE '\\' OR patient_name LIKE ? ESCAPE '\\' OR last_name LIKE ? ESCAPE '\\'"
+        params = [f"%{escaped}%"] * 3
+    rank_sql = (
+        "CASE WHEN patient_code = ? THEN 0"
+        " WHEN patient_code LIKE ? ESCAPE '\\' THEN 1"
+        " WHEN patient_name LIKE ? ESCAPE '\\' OR last_name LIKE ? ESCAPE '\\' THEN 2"
+        " ELSE 3 END"
+    )
+    rank_params = [search_term, f"{escaped}%", f"{escaped}%", f"{escaped}%"]
+    return where, params, rank_sql, rank_params
+
+
+class FilterPlan:
+    """Chooses how a combined filter is counted and paged, from the patient_stats summary.
+
+    ANALYZE tells SQLite how many patients a specialist has, but not how they
+    spread over the dates, so for a specialist plus a date range it may walk
+    one index for seconds where the other needs milliseconds. The summary
+    knows, and each estimate below is a short range scan of it. Filters on a
+    date range plus at most one of specialist, ward or whole age decades are
+    counted from the summary exactly. With `schema`, all of this applies to
+    the archive file attached under that name, from its own summary.
+    """
+
+    def __init__(self, storage, specialist=None, ward=None, date_from=None, date_to=None, age_min=None, age_max=None,
+                 schema=None):
+        self.indexes = FILTER_INDEXES[storage]
+        self.schema = schema
+        self.stats_table = f"{schema}.patient_stats" if schema else "patient_stats"
+        self.specialist = specialist
+        self.date_from, self.date_to = date_from, date_to
+        # (dimension, first bucket, last bucket) of the criteria patient_stats breaks admissions down by
+        self.buckets = []
+        if specialist:
+            self.buckets.append(("specialist", specialist, specialist))
+        if ward:
+            self.buckets.append(("ward", ward, ward))
+        if age_min is not None or age_max is not None:
+            low, high = age_min if age_min is not None else 0, age_max if age_max is not None else MAX_AGE
+            self.buckets.append(("age", low // 10 * 10, high // 10 * 10))
+        self.whole_decades = ((age_min is None or age_min % 10 == 0) and
+                              (age_max is None or age_max % 10 == 9 or age_max >= MAX_AGE))
+        self._estimates = None
+
+    def _admissions(self, cursor, dimension, bucket=None, after=None):
+        # Patients in one dimension's buckets within the date range (after `after`, when given, instead)
+        sql, params = f"SELECT COALESCE(SUM(admissions), 0) FROM {self.stats_table} WHERE dimension = ?", [dimension]
+        if bucket is not None:
+            sql += " AND bucket BETWEEN ? AND ?"
+            params += bucket
+        if after is not None:
+            sql += " AND day > ?"
+            params.append(after)
+        else:
+            if self.date_from:
+                sql += " AND day >= ?"
+                params.append(self.date_from)
+            if self.date_to:
+                sql += " AND day <= ?"
+                params.append(self.date_to)
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0]
+
+    def exact_count(self, cursor):
+        """The filter's row count when the summary holds it exactly, else None."""
+        if len(self.buckets) > 1 or not (self.buckets or self.date_from or self.date_to):
+            return None
+        if not self.buckets:
+            return self._admissions(cursor, "specialist")
+        dimension, first, last = self.buckets[0]
+        if dimension == "age" and not self.whole_decades:
+            return None
+        return self._admissions(cursor, dimension, (first, last))
+
+    def estimates(self, cursor):
+        """(estimated matches, rows in the date range or None, {walkable index: (rows, newer, in range)})."""
+        if self._estimates is None:
+            if self.schema is None:
+                total, specialist_rows = cursor.execute(
+                    "SELECT COALESCE(SUM(patient_count), 0), COALESCE(SUM(patient_count * (specialist_name = ?)), 0) "
+                    "FROM specialists", (self.specialist,)).fetchone()
+            else:
+                total, specialist_rows = cursor.execute(
+                    f"SELECT COALESCE(SUM(admissions), 0), COALESCE(SUM(admissions * (bucket = ?)), 0) "
+                    f"FROM {self.stats_table} WHERE dimension = 'specialist'", (self.specialist,)).fetchone()
+            dated = bool(self.date_from or self.date_to)
+            in_range = self._admissions(cursor, "specialist") if dated else total
+            bucket_rows = {dimension: self._admissions(cursor, dimension, (first, last))
+                           for dimension, first, last in self.buckets}
+            # Criteria are taken as independent within the date range
+            matches = in_range
+            for rows in bucket_rows.values():
+                matches *= rows / max(in_range, 1)
+            # A walk down an id-ordered index passes the rows newer than the date range first;
+            # ids grow with the submission date in normal use
+            walks = {"rowid": (total, self._admissions(cursor, "specialist", after=self.date_to) if self.date_to else 0,
+                               in_range)}
+            if self.specialist:
+                bucket = (self.specialist, self.specialist)
+                walks["specialist"] = (specialist_rows, self._admissions(cursor, "specialist", bucket, after=self.date_to)
+                                       if self.date_to else 0, bucket_rows["specialist"])
+            self._estimates = (matches, in_range if dated else None, walks)
+        return self._estimates
+
+    def hint(self, cursor, limit=None):
+        """INDEXED BY / NOT INDEXED clause for reading the newest `limit` matches (None = all of them).
+
+        A walk down an id-ordered index stops after `limit` matches, so it costs
+        the rows it passes; a date range reads the whole range and sorts it.
+        Rows met in id order (the table itself, or a date range) sit next to
+        each other; rows reached through the specialist index are one lookup
+        each, unless that index alone decides the filter.
+        """
+        matches, range_rows, walks = self.estimates(cursor)
+        costs = {}
+        for name, (rows, newer, in_range) in walks.items():
+            visited = rows if limit is None or matches <= limit else newer + limit * in_range / matches
+            lookups = name == "specialist" and (len(self.buckets) > 1 or self.date_from or self.date_to)
+            costs[name] = visited * (1 if lookups else SEQUENTIAL_ROW_COST)
+        if range_rows is not None:
+            costs["date"] = range_rows * SEQUENTIAL_ROW_COST
+        best = min(costs, key=costs.get)
+        return " NOT INDEXED" if best == "rowid" else f" INDEXED BY {self.indexes[best]}"
+
+
+# The id-ordered and date-ordered indexes FilterPlan can choose between, per storage mode
+FILTER_INDEXES = {
+    STORAGE_CLASSIC: {"specialist": "idx_patients_specialist_id", "date": "idx_patients_submission_date_id"},
+    STORAGE_COMPACT: {"specialist": "idx_patient_records_specialist_id", "date": "idx_patient_records_submitted_at_id"},
+}
+
+
+def build_patient_source(specialist=None, date_from=None, date_to=None, search_term=None, use_search_index=True,
+                         storage=STORAGE_CLASSIC, ward=None, age_min=None, age_max=None, archives=()):
+    """Page source for the patients matching every given criterion (None or "" = not filtered).
+
+    All criteria compose into one parameterized WHERE clause. With compact
+    `storage` the filters compare the integer specialist, ward and timestamp
+    columns, so they can be answered from patient_records alone. Unranked
+    filters get a FilterPlan; searches are driven by the search index.
+
+    `archives` are the archived years (archived_years). A date range reaching
+    into archived years gives a PartitionedSource that also reads those
+    years' archive files. A search without a date range reads the newest
+    ARCHIVE_ATTACH_LIMIT archived years, and the source's `skipped_years`
+    lists any older ones left out. Other filters without a date range read
+    the main file only.
+    """
+    criteria = dict(specialist=specialist, date_from=date_from, date_to=date_to, search_term=search_term,
+                    use_search_index=use_search_index, ward=ward, age_min=age_min, age_max=age_max)
+    source = _filtered_source(storage, **criteria)
+    skipped = []
+    if date_from or date_to:
+        years = archive_years_in_range(archives, date_from, date_to)
+    elif search_term:
+        years, skipped = archives[-ARCHIVE_ATTACH_LIMIT:], archives[:-ARCHIVE_ATTACH_LIMIT]
+    else:
+        years = []
+    if not years:
+        return source
+    return PartitionedSource(source, [_filtered_source(STORAGE_CLASSIC, schema=archive_schema(year), **criteria)
+                                      for year in years], years, skipped)
+
+
+def _filtered_source(storage, specialist=None, date_from=None, date_to=None, search_term=None, use_search_index=True,
+                     ward=None, age_min=None, age_max=None, schema=None):
+    # The criteria over the main file's patients, or over the archive attached as `schema`
+    clauses, params = [], []
+    rank_sql, rank_params = "", []
+    compact = storage == STORAGE_COMPACT
+    if search_term:
+        where, params, rank_sql, rank_params = build_search_filter(search_term, use_search_index, schema)
+        clauses.append(where)
+    if specialist:
+        clauses.append("specialist_id = (SELECT id FROM specialists WHERE specialist_name = ?)" if compact
+                       else "specialist=?")
+        params.append(specialist)
+    if ward:
+        clauses.append("ward_id = (SELECT id FROM wards WHERE ward_name = ?)" if compact else "ward=?")
+        params.append(ward)
+    if date_from:
+        clauses.append("submitted_at >= ?" if compact else "submission_date >= ?")
+        params.append(date_epoch(date_from) if compact else date_from)
+    if date_to:
+        clauses.append("submitted_at < ?" if compact else "submission_date <= ?")
+        params.append(date_epoch(date_to) + 86400 if compact else date_to)
+    if age_min is not None:
+        clauses.append("age >= ?")
+        params.append(age_min)
+    if age_max is not None:
+        clauses.append("age <= ?")
+        params.append(age_max)
+    where = clauses[0] if len(clauses) == 1 else " AND ".join(f"({clause})" for clause in clauses)
+    plan = None
+    if where and not rank_sql:
+        plan = FilterPlan(storage, specialist, ward, date_from, date_to, age_min, age_max, schema)
+    table = f"{schema}.patients" if schema else STORAGE_TABLES[storage]
+    return PatientPageSource(where, params, rank_sql, rank_params, table=table, plan=plan, schema=schema)
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class ServiceError(Exception):
+    """A business rule refused the operation; `title` and the message are meant for the user."""
+
+    def __init__(self, title, message):
+        super().__init__(message)
+        self.title = title
+
+
+class PatientValidationError(ServiceError, ValueError):
+    pass
+
+
+class NotFoundError(ServiceError):
+    pass
+
+
+class ConflictError(ServiceError):
+    pass
+
+
+def validate_patient(name, last_name, age, ward, code, specialist, active_specialists=None):
+    """Apply the patient form rules; returns the cleaned values or raises PatientValidationError."""
+    if isinstance(age, float) and age.is_integer():
+        age = int(age)
+    name, last_name, age_str, ward, code, specialist = (
+        "" if value is None else str(value).strip() for value in (name, last_name, age, ward, code, specialist))
+    if not all([name, last_name, age_str, ward, code, specialist]):
+        raise PatientValidationError("ورودی ناقص", ".لطفا تمام فیلدها را پر کنید")
+    try:
+        age = int(age_str)
+        if not (0 < age <= MAX_AGE): raise ValueError
+    except ValueError:
+        raise PatientValidationError("ورودی نامعتبر", ".سن باید یک عدد صحیح معتبر باشد")
+    if active_specialists is not None and specialist not in active_specialists:
+        raise PatientValidationError("پزشک نامعتبر", ".پزشک متخصص ثبت نشده یا غیرفعال است")
+    return name, last_name, age, ward, code, specialist
+
+
+def normalize_submission(date_value=None, time_value=None, now=None):
+    """Return (submission_date, submission_time) as stored; blanks default to `now`. Raises ValueError."""
+    now = now or datetime.now()
+    if date_value in (None, ""):
+        submission_date = now.strftime("%Y-%m-%d")
+    elif isinstance(date_value, (datetime, date)):
+        submission_date = date_value.strftime("%Y-%m-%d")
+    else:
+        submission_date = date.fromisoformat(str(date_value).strip()).isoformat()
+    if time_value in (None, ""):
+        submission_time = now.strftime("%H:%M:%S")
+    elif isinstance(time_value, (datetime, dt_time)):
+        submission_time = time_value.strftime("%H:%M:%S")
+    else:
+        submission_time = dt_time.fromisoformat(str(time_value).strip()).strftime("%H:%M:%S")
+    return submission_date, submission_time
+
+
+INSERT_PATIENT_SQL = ("INSERT INTO patients (patient_name, last_name, age, ward, patient_code, specialist, "
+                      "submission_date, submission_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+# Accepted import headers: the export's Persian column titles or the database column names
+IMPORT_FIELDS = [
+    ("patient_name", "نام بیمار"), ("last_name", "نام خانوادگی"), ("age", "سن"), ("ward", "بخش"),
+    ("patient_code", "کد بیمار"), ("specialist", "پزشک متخصص"),
+    ("submission_date", "تاریخ ثبت"), ("submission_time", "زمان ثبت"),
+]
+
+
+def iter_import_rows(file_path):
+    if os.path.splitext(file_path)[1].lower() == ".csv":
+        with open(file_path, newline="", encoding="utf-8-sig") as f:
+            yield from csv.reader(f)
+    else:
+        import openpyxl  # imported on first use: it takes longer to load than the rest of startup
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+
+def import_patients(conn, file_path, progress=None, cancel_event=None, actor=None):
+    """Bulk-load patients from .csv or .xlsx in one transaction.
+
+    Rows are validated with the same rules as the entry form (plus an active
+    specialist) and inserted with executemany in IMPORT_BATCH_SIZE batches.
+    Rejected rows are written next to the source file as `<name>_rejected.csv`.
+    Returns (imported, rejected, report_path or None).
+    """
+    started = time.perf_counter()
+    rows = iter_import_rows(file_path)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("فایل خالی است")
+    lookup = {}
+    for field, title in IMPORT_FIELDS:
+        lookup[field] = lookup[title] = field
+    positions = {}
+    for index, cell in enumerate(header):
+        field = lookup.get("" if cell is None else str(cell).strip().strip(":"))
+        if field and field not in positions:
+            positions[field] = index
+    missing = [title for field, title in IMPORT_FIELDS[:6] if field not in positions]
+    if missing:
+        raise ValueError(f"ستون‌های لازم در فایل یافت نشد: {', '.join(missing)}")
+    required = [positions[field] for field, _ in IMPORT_FIELDS[:6]]
+    date_index = positions.get("submission_date")
+    time_index = positions.get("submission_time")
+
+    active_specialists = PatientRepository(conn).active_specialists()
+    now = datetime.now()
+
+    imported = 0
+    rejected = []
+    batch = []
+    try:
+        # IMMEDIATE takes the write lock up front, so other terminals wait instead of failing mid-import
+        conn.execute("BEGIN IMMEDIATE")
+        # Indexing the new rows in one statement at the end is an order of magnitude faster
+        # than the per-row triggers; the transaction keeps other writers out meanwhile.
+        last_old_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {patient_table(conn)}").fetchone()[0]
+        bulk_triggers = drop_bulk_insert_triggers(conn)
+        for line_number, row in enumerate(rows, start=2):
+            if not any(row):
+                continue
+            row = tuple(row) + (None,) * (len(header) - len(row))
+            try:
+                record = validate_patient(*(row[i] for i in required), active_specialists=active_specialists)
+                submission = normalize_submission(None if date_index is None else row[date_index],
+                                                  None if time_index is None else row[time_index], now)
+            except PatientValidationError as e:
+                rejected.append((line_number, str(e), row))
+                continue
+            except ValueError:
+                rejected.append((line_number, ".تاریخ یا زمان ثبت نامعتبر است", row))
+                continue
+            batch.append(record + submission)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise TaskCancelled()
+                conn.executemany(INSERT_PATIENT_SQL, batch)
+                imported += len(batch)
+                batch.clear()
+                if progress:
+                    progress((imported, len(rejected)))
+        if batch:
+            conn.executemany(INSERT_PATIENT_SQL, batch)
+            imported += len(batch)
+        restore_bulk_insert_triggers(conn, bulk_triggers, last_old_id)
+        conn.execute(f"INSERT INTO patient_audit (patient_id, op, changed_at, changed_by) "
+                     f"SELECT id, 'I', ?, ? FROM {patient_table(conn)} WHERE id > ?",
+                     (audit_timestamp(), actor or audit_user(), last_old_id))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    report_path = None
+    if rejected:
+        report_path = os.path.splitext(file_path)[0] + "_rejected.csv"
+        with open(report_path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(["ردیف فایل", "دلیل"] + ["" if cell is None else cell for cell in header])
+            for line_number, reason, row in rejected:
+                writer.writerow([line_number, reason] + ["" if cell is None else cell for cell in row])
+    METRICS.record("import", os.path.splitext(file_path)[1].lower(), (time.perf_counter() - started) * 1000)
+    return imported, len(rejected), report_path
+
+
+def export_patients(conn, source, file_path, headers, progress=None, cancel_event=None):
+    """Stream `source` into `file_path` in constant memory; returns the number of rows written.
+
+    The format follows the extension: .csv and .parquet (needs pyarrow) take
+    the fast paths, anything else is written as .xlsx with openpyxl in
+    write-only mode. Output goes to a temporary file that only replaces
+    `file_path` once the export has finished.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    temp_path = file_path + ".part"
+    written = 0
+    started = time.perf_counter()
+    try:
+        if extension == ".csv":
+            with open(temp_path, "w", newline="", encoding="utf-8-sig") as f:
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                for batch in source.iter_batches(conn.cursor()):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise TaskCancelled()
+                    writer.writerows(row[1:] + (written + i,) for i, row in enumerate(batch, start=1))
+                    written += len(batch)
+                    if progress:
+                        progress((written, source.total))
+        elif extension == ".parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            writer = None
+            try:
+                for batch in source.iter_batches(conn.cursor()):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise TaskCancelled()
+                    columns = [list(column) for column in zip(*batch)][1:]
+                    columns.append(list(range(written + 1, written + len(batch) + 1)))
+                    table = pa.table(dict(zip(headers, columns)))
+                    if writer is None:
+                        writer = pq.ParquetWriter(temp_path, table.schema)
+                    writer.write_table(table)
+                    written += len(batch)
+                    if progress:
+                        progress((written, source.total))
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            import openpyxl
+            workbook = openpyxl.Workbook(write_only=True)
+            sheet = workbook.create_sheet("گزارش بیماران")
+            sheet.sheet_view.rightToLeft = True
+            sheet.append(headers)
+            for batch in source.iter_batches(conn.cursor()):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise TaskCancelled()
+                for row in batch:
+                    written += 1
+                    sheet.append(row[1:] + (written,))
+                if progress:
+                    progress((written, source.total))
+            workbook.save(temp_path)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    METRICS.record("export", extension if extension in (".csv", ".parquet") else ".xlsx",
+                   (time.perf_counter() - started) * 1000)
+    return written
+
+
+def admission_stats(conn, date_from=None, date_to=None, period=None):
+    """Admissions between two ISO dates (inclusive; None = open) from the patient_stats summary.
+
+    Returns {"total", "period", "by_period", "by_specialist", "by_ward",
+    "by_age"}; each breakdown is a list of (key, admissions), age keys being
+    the first year of a decade. `period` is "day" or "month"; by default days
+    for ranges of up to STATS_DAILY_MAX_DAYS days and months otherwise.
+    """
+    if period is None:
+        period = "month"
+        if date_from and date_to and (date.fromisoformat(date_to) - date.fromisoformat(date_from)).days < STATS_DAILY_MAX_DAYS:
+            period = "day"
+    if period not in ("day", "month"):
+        raise ValueError(f"unknown period {period!r}")
+    # The archived years the range reaches (all of them without one) add up their files' summaries too;
+    # attach_archives refuses more than ARCHIVE_ATTACH_LIMIT rather than leaving some out of the total
+    years = archive_years_in_range(archived_years(conn), date_from, date_to)
+    attach_archives(conn, years)
+    schemas = ["main"] + [archive_schema(year) for year in years]
+    where, params = "dimension = ?", []
+    if date_from:
+        where += " AND day >= ?"
+        params.append(date_from)
+    if date_to:
+        where += " AND day <= ?"
+        params.append(date_to)
+
+    def breakdown(dimension, key="bucket", order="2 DESC, 1"):
+        if len(schemas) == 1:
+            return conn.execute(f"SELECT {key}, SUM(admissions) FROM patient_stats WHERE {where} GROUP BY 1 "
+                                f"HAVING SUM(admissions) > 0 ORDER BY {order}", [dimension] + params).fetchall()
+        # Grouped per file first, so each part is read along its primary key instead of through a UNION ALL co-routine
+        parts = " UNION ALL ".join(f"SELECT {key} AS k, SUM(admissions) AS admissions FROM {schema}.patient_stats "
+                                   f"WHERE {where} GROUP BY 1" for schema in schemas)
+        return conn.execute(f"SELECT k, SUM(admissions) FROM ({parts}) GROUP BY 1 HAVING SUM(admissions) > 0 "
+                            f"ORDER BY {order}", ([dimension] + params) * len(schemas)).fetchall()
+
+    stats = {
+        "period": period,
+        "by_period": breakdown("specialist", "day" if period == "day" else "substr(day, 1, 7)", "1"),
+        "by_specialist": breakdown("specialist"),
+        "by_ward": breakdown("ward"),
+        "by_age": breakdown("age", order="1"),
+    }
+    stats["total"] = sum(admissions for _, admissions in stats["by_specialist"])
+    return stats
+
+
+def search_rank(row, term):
+    # In-memory mirror of the ORDER BY built by build_search_filter
+    code, name, last_name = row[5].lower(), row[1].lower(), row[2].lower()
+    if row[5] == term:
+        return 0
+    if code.startswith(term.lower()):
+        return 1
+    if name.startswith(term.lower()) or last_name.startswith(term.lower()):
+        return 2
+    return 3
+
+
+def row_matches_term(row, term):
+    # In-memory mirror of the WHERE built by build_search_filter
+    values = (row[5].lower(), row[1].lower(), row[2].lower())
+    term = term.lower()
+    if len(term) < SEARCH_SUBSTRING_MIN_CHARS:
+        return any(value.startswith(term) for value in values)
+    return any(term in value for value in values)
+
+
+def term_narrows(previous, term):
+    """Whether every patient matching `term` also matches `previous`, so a result for `previous` can be filtered."""
+    previous, term = previous.lower(), term.lower()
+    if len(previous) < SEARCH_SUBSTRING_MIN_CHARS:
+        # `previous` matched prefixes only: a longer term matching anywhere may find patients it did not
+        return len(term) < SEARCH_SUBSTRING_MIN_CHARS and term.startswith(previous)
+    return previous in term
+
+
+# --- Audit log ---
+# patient_audit is written by PatientRepository and import_patients in the same transaction as
+# the change itself: 'I' added, 'U' updated and 'D' deleted (both with the row as it was before),
+# 'R' restored. Deleting is therefore soft: the row leaves patients, so the live table and its
+# indexes only hold current patients, but its last image stays in the log for restore_patients.
+
+@lru_cache(maxsize=None)
+def audit_user():
+    if AUDIT_USER:
+        return AUDIT_USER
+    try:
+        login = getpass.getuser()
+    except Exception:  # neither a login variable nor a password database entry
+        login = "unknown"
+    return f"{login}@{socket.gethostname()}"
+
+
+def audit_timestamp(moment=None):
+    # Local wall-clock time, like submission_date/time; sorts as text
+    return (moment or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def record_audit(conn, op, patient_ids, actor, with_image=False):
+    """Append one patient_audit entry per id; `with_image` copies the row as it is now, so call it before the write."""
+    changed_at = audit_timestamp()
+    if with_image:
+        conn.executemany(f"INSERT INTO patient_audit (patient_id, op, changed_at, changed_by, {PATIENT_AUDIT_COLUMNS}) "
+                         f"SELECT id, ?, ?, ?, {PATIENT_AUDIT_COLUMNS} FROM patients WHERE id = ?",
+                         [(op, changed_at, actor, patient_id) for patient_id in patient_ids])
+    else:
+        conn.executemany("INSERT INTO patient_audit (patient_id, op, changed_at, changed_by) VALUES (?, ?, ?, ?)",
+                         [(patient_id, op, changed_at, actor) for patient_id in patient_ids])
+
+
+def main_database_file(conn):
+    return next(row[2] for row in conn.execute("PRAGMA database_list") if row[1] == "main")
+
+
+def audit_archive_path(conn):
+    return os.path.splitext(main_database_file(conn))[0] + "_audit_archive.db"
+
+
+def compact_audit_log(conn, before, archive_path=None):
+    """Move patient_audit entries from before `before` to an archive database file.
+
+    The entries left in place are all that views as of `before` or later
+    need; AsOfSource refuses earlier moments. Entries are copied with INSERT
+    OR IGNORE on their seq before they are deleted, so a run interrupted
+    between the two files' commits is completed by the next one without
+    duplicates. A patient deleted before `before` can no longer be restored.
+    Returns how many entries moved.
+    """
+    if not conn.execute("SELECT 1 FROM patient_audit WHERE changed_at < ? LIMIT 1", (before,)).fetchone():
+        return 0
+    archive_path = archive_path or audit_archive_path(conn)
+    started = time.perf_counter()
+    conn.execute("ATTACH DATABASE ? AS audit_archive", (archive_path,))
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(PATIENT_AUDIT_TABLE.format(name="IF NOT EXISTS audit_archive.patient_audit"))
+            conn.execute("INSERT OR IGNORE INTO audit_archive.patient_audit "
+                         "SELECT * FROM main.patient_audit WHERE changed_at < ?", (before,))
+            conn.execute("DROP TRIGGER patient_audit_no_delete")
+            moved = conn.execute("DELETE FROM main.patient_audit WHERE changed_at < ?", (before,)).rowcount
+            conn.execute(PATIENT_AUDIT_GUARDS["DELETE"])
+            conn.execute("INSERT INTO audit_compactions (compacted_before, archive_path, entries, compacted_at) "
+                         "VALUES (?, ?, ?, ?)", (before, archive_path, moved, audit_timestamp()))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute("DETACH DATABASE audit_archive")
+    METRICS.record("job", "compact_audit_log", (time.perf_counter() - started) * 1000)
+    return moved
+
+
+# --- Archive partitions ---
+# Patients submitted before a cutoff can be moved out of the main file, one SQLite file per
+# submission year (<database>_archive_<year>.db) listed in patient_archives. The main file then
+# holds the working set that the unfiltered grid and undated filters read; a date range that
+# reaches into archived years attaches those files and reads them too (build_patient_source,
+# admission_stats), as do searches and the list as of a past moment (AsOfSource).
+# Archived patients are read-only, and patient_stats
+# and specialists.patient_count in the main file count the working set only.
+
+# The classic layout without the foreign key: the specialists table stays in the main file
+ARCHIVE_PATIENTS_TABLE = CLASSIC_PATIENTS_TABLE.replace(" REFERENCES specialists(specialist_name) ON UPDATE CASCADE", "")
+
+
+def archive_schema(year):
+    return f"archive_{year}"
+
+
+def archived_years(conn):
+    return [year for (year,) in conn.execute("SELECT year FROM patient_archives ORDER BY year")]
+
+
+def archive_years_in_range(years, date_from=None, date_to=None):
+    # The archived years that hold submissions between two ISO dates (inclusive; None = open)
+    return [year for year in years
+            if (not date_from or date_from <= f"{year}-12-31") and (not date_to or date_to >= f"{year}-01-01")]
+
+
+def attach_archives(conn, years):
+    """Attach the archive file of each of `years` that is not attached yet, detaching unneeded ones to make room."""
+    attached = [row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith("archive_")]
+    wanted = {archive_schema(year) for year in years}
+    missing = [year for year in years if archive_schema(year) not in attached]
+    if not missing:
+        return
+    if len(wanted) > ARCHIVE_ATTACH_LIMIT:
+        raise ConflictError("بازه زمانی طولانی", f".حداکثر {ARCHIVE_ATTACH_LIMIT} سال بایگانی‌شده را می‌توان همزمان خواند")
+    spare = [name for name in attached if name not in wanted]
+    for name in spare[:max(0, len(attached) + len(missing) - ARCHIVE_ATTACH_LIMIT)]:
+        conn.execute(f"DETACH DATABASE {name}")
+    directory = os.path.dirname(main_database_file(conn))
+    files = dict(conn.execute("SELECT year, file_name FROM patient_archives"))
+    for year in missing:
+        path = os.path.join(directory, files[year])
+        if not os.path.exists(path):
+            # ATTACH would silently create an empty file in its place
+            raise NotFoundError("بایگانی یافت نشد", f".فایل بایگانی سال {year} یافت نشد: {path}")
+        conn.execute(f"ATTACH DATABASE ? AS {archive_schema(year)}", (path,))
+
+
+def create_archive_file(path, search_index=True):
+    # Same indexes, search index and summary (with their triggers) as a classic main file
+    archive = sqlite3.connect(path)
+    try:
+        archive.execute(ARCHIVE_PATIENTS_TABLE.format(name="patients"))
+        add_patient_indexes(archive)
+        create_search_prefix_indexes(archive)
+        archive.execute(PATIENT_STATS_TABLE)
+        create_patient_stats_triggers(archive, STORAGE_CLASSIC)
+        if search_index:
+            add_patient_search_index(archive)
+        archive.commit()
+    finally:
+        archive.close()
+
+
+def archive_patients(conn, before, batch_size=ARCHIVE_BATCH_SIZE, cancel_event=None):
+    """Move the patients submitted before `before` (an ISO date) to their year's archive file.
+
+    Each batch is copied with INSERT OR IGNORE and committed to the archive
+    before it is deleted from the main file, so other terminals wait for one
+    batch at most, and a run interrupted between the two commits is completed
+    by the next one without duplicates. The main file's triggers keep the
+    specialist counts, patient_stats, search index and change_log in step
+    (other terminals reload), and the archive's own maintain its summary and
+    search index. Deletes here are not recorded in patient_audit: the rows
+    still exist, and AsOfSource reads them from the archive files. Setting
+    `cancel_event` stops the run between batches with TaskCancelled. Returns
+    how many patients moved.
+    """
+    table = patient_table(conn)
+    if storage_mode(conn) == STORAGE_CLASSIC:
+        column, first_year_sql, bound = "submission_date", "substr(MIN(submission_date), 1, 4)", before
+    else:
+        column, first_year_sql, bound = "submitted_at", "strftime('%Y', MIN(submitted_at), 'unixepoch')", date_epoch(before)
+    first_year = conn.execute(f"SELECT {first_year_sql} FROM {table} WHERE {column} < ?", (bound,)).fetchone()[0]
+    if first_year is None:
+        return 0
+    started = time.perf_counter()
+    directory, main_name = os.path.split(main_database_file(conn))
+    search_index = has_search_index(conn)
+    moved = 0
+    for year in range(int(first_year), int(before[:4]) + 1):
+        first_day, end_day = f"{year}-01-01", min(before, f"{year + 1}-01-01")
+        low, high = first_day, end_day
+        if column == "submitted_at":
+            low, high = date_epoch(low), date_epoch(high)
+        if not conn.execute(f"SELECT 1 FROM {table} WHERE {column} >= ? AND {column} < ? LIMIT 1",
+                            (low, high)).fetchone():
+            continue
+        file_name = f"{os.path.splitext(main_name)[0]}_archive_{year}.db"
+        if not os.path.exists(os.path.join(directory, file_name)):
+            create_archive_file(os.path.join(directory, file_name), search_index)
+        # Listed before any row leaves the main file, so date ranges over the year find the file from the start
+        conn.execute("INSERT INTO patient_archives (year, file_name, patients, archived_before, archived_at) "
+                     "VALUES (?, ?, 0, ?, ?) ON CONFLICT (year) DO UPDATE SET "
+                     "archived_before = MAX(archived_before, excluded.archived_before)",
+                     (year, file_name, before, audit_timestamp()))
+        conn.commit()
+        attach_archives(conn, [year])
+        schema = archive_schema(year)
+        while True:
+            ids = [row[0] for row in conn.execute(f"SELECT id FROM {table} WHERE {column} >= ? AND {column} < ? LIMIT ?",
+                                                  (low, high, batch_size))]
+            if not ids:
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                raise TaskCancelled()
+            placeholders = ", ".join("?" * len(ids))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(f"INSERT OR IGNORE INTO {schema}.patients ({PATIENT_COLUMNS}) "
+                             f"SELECT {PATIENT_COLUMNS} FROM main.patients WHERE id IN ({placeholders})", ids)
+                conn.commit()
+                conn.execute("BEGIN IMMEDIATE")
+                moved += conn.execute(f"DELETE FROM main.{table} WHERE id IN "
+                                      f"(SELECT id FROM {schema}.patients WHERE id IN ({placeholders}))", ids).rowcount
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        conn.execute(f"ANALYZE {schema}")
+        # The delete triggers leave the moved days' summary rows at zero; the archive has its own
+        conn.execute("DELETE FROM main.patient_stats WHERE day >= ? AND day < ? AND admissions = 0", (first_day, end_day))
+        conn.execute(f"UPDATE patient_archives SET patients = (SELECT COUNT(*) FROM {schema}.patients), archived_at = ? "
+                     f"WHERE year = ?", (audit_timestamp(), year))
+        conn.commit()
+    if isinstance(conn, PatientConnection):
+        conn.specialist_registry.invalidate()
+    METRICS.record("job", "archive_patients", (time.perf_counter() - started) * 1000)
+    return moved
+
+
+# --- Backup ---
+# backup_database copies the live files with SQLite's online backup API while terminals keep
+# working. On a WAL file it holds one read transaction for the whole copy, so the copy is a single
+# consistent snapshot that never restarts while writers commit meanwhile. Under a rollback journal
+# (the legacy profile, and the archive files) that transaction would hold a SHARED lock blocking
+# every writer for the whole paced copy, so there each step locks the file only while it runs and
+# SQLite starts the copy over when another connection writes the file. A backup
+# is one directory, <database>-<YYYYMMDD-HHMMSS>[-N], holding the main file (compact or classic
+# storage, patient_stats, patient_audit and all), the audit archive and the yearly archive files,
+# each optionally gzip-compressed, and a manifest.json. Restoring means putting the files back
+# next to each other, decompressed, while no terminal has the database open.
+
+def list_backups(backup_dir, db_path):
+    """Completed backup directories of `db_path` in `backup_dir`, oldest first."""
+    prefix = os.path.splitext(os.path.basename(db_path))[0] + "-"
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(name for name in os.listdir(backup_dir)
+                  if name.startswith(prefix) and not name.endswith(".part")
+                  and os.path.isfile(os.path.join(backup_dir, name, "manifest.json")))
+
+
+def backup_due(backup_dir, db_path, interval_hours=BACKUP_INTERVAL_HOURS):
+    backups = list_backups(backup_dir, db_path)
+    if not backups:
+        return True
+    newest = os.path.getmtime(os.path.join(backup_dir, backups[-1], "manifest.json"))
+    return time.time() - newest >= interval_hours * 3600
+
+
+def prune_backups(backup_dir, db_path, keep=BACKUP_KEEP):
+    # Older backups beyond the newest `keep` (0 keeps them all), and leftovers of runs cut off a day ago or more
+    backups = list_backups(backup_dir, db_path)
+    for name in backups[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(backup_dir, name))
+    prefix = os.path.splitext(os.path.basename(db_path))[0] + "-"
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if name.startswith(prefix) and name.endswith(".part") and time.time() - os.path.getmtime(path) > 86400:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def backup_database(conn, backup_dir, compress=BACKUP_COMPRESS, verify=True, keep=BACKUP_KEEP,
+                    step_pages=BACKUP_STEP_PAGES, step_pause=BACKUP_STEP_PAUSE, progress=None, cancel_event=None):
+    """Back up `conn`'s database and its archive files into a new directory under `backup_dir`.
+
+    The copy advances `step_pages` pages at a time with `step_pause` seconds
+    between steps; `progress` receives (pages copied, pages in all files). A
+    file not in WAL mode that is written more than BACKUP_MAX_RESTARTS times
+    during its copy makes the backup fail with ConflictError. With
+    `verify` each copy must pass PRAGMA quick_check before it is kept; pages
+    are copied verbatim, so integrity_check's index cross-check would only
+    take four times as long. The
+    directory gets its final name only once every file is written, and then
+    backups beyond the newest `keep` are removed. Returns the directory's path.
+    """
+    started = time.perf_counter()
+    main_file = main_database_file(conn)
+    paths = [audit_archive_path(conn)]
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='patient_archives'").fetchone():
+        paths += [os.path.join(os.path.dirname(main_file), file_name)
+                  for (file_name,) in conn.execute("SELECT file_name FROM patient_archives ORDER BY year")]
+    stem = os.path.join(backup_dir, os.path.splitext(os.path.basename(main_file))[0] + "-" +
+                        datetime.now().strftime("%Y%m%d-%H%M%S"))
+    # Names have one-second resolution: a second backup within the same second (or by another terminal) gets -2, -3...
+    target_dir, suffix = stem, 1
+    while True:
+        try:
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir + ".part")
+                break
+        except FileExistsError:
+            pass
+        suffix += 1
+        target_dir = f"{stem}-{suffix}"
+    sources = [(os.path.basename(main_file), conn)]
+    manifest = {"created_at": audit_timestamp(), "database": main_file, "files": []}
+    try:
+        sources += [(os.path.basename(path), sqlite3.connect(path)) for path in paths if os.path.exists(path)]
+        total_pages = sum(source.execute("PRAGMA page_count").fetchone()[0] for _, source in sources)
+        copied = 0
+
+        def pause():
+            # Between steps of every phase (copy, compression, checksum), so the app's queries get the disk and CPU
+            if cancel_event is not None and cancel_event.is_set():
+                raise TaskCancelled()
+            time.sleep(step_pause)
+
+        def chunks(f):
+            for chunk in iter(lambda: f.read(BACKUP_CHUNK_BYTES), b""):
+                yield chunk
+                pause()
+
+        for file_name, source in sources:
+            path = os.path.join(target_dir + ".part", file_name)
+            # Only WAL lets writers commit past a read transaction held for the whole copy
+            pinned = source.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+            state = {"remaining": None, "restarts": 0}
+
+            def step(status, remaining, pages):
+                if state["remaining"] is not None and remaining >= state["remaining"]:
+                    # Every step copies pages, so none left fewer to go: another connection wrote the file,
+                    # and SQLite started the copy over
+                    state["restarts"] += 1
+                    if state["restarts"] > BACKUP_MAX_RESTARTS:
+                        raise ConflictError("پشتیبان‌گیری ناتمام",
+                                            f".فایل {file_name} در حین کپی مرتب تغییر کرد؛ بعدا دوباره تلاش کنید")
+                state["remaining"] = remaining
+                if progress:
+                    progress((copied + pages - remaining, total_pages))
+                pause()
+
+            target = sqlite3.connect(path)
+            try:
+                if pinned:
+                    # One snapshot for the whole copy: writes committed meanwhile do not restart it
+                    source.execute("BEGIN")
+                    source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                try:
+                    source.backup(target, pages=step_pages, progress=step)
+                finally:
+                    if pinned:
+                        source.rollback()
+                # The copy of a WAL database would otherwise need -wal and -shm files next to it
+                target.execute("PRAGMA journal_mode=DELETE")
+                copied += target.execute("PRAGMA page_count").fetchone()[0]
+                if source is conn:
+                    # Read from the copy, so they describe exactly what was backed up
+                    manifest["schema_version"] = target.execute("PRAGMA user_version").fetchone()[0]
+                    manifest["storage"] = storage_mode(target)
+                    manifest["patients"] = target.execute(
+                        "SELECT COALESCE(SUM(patient_count), 0) FROM specialists").fetchone()[0]
+                if verify:
+                    problems = [row[0] for row in target.execute("PRAGMA quick_check")]
+                    if problems != ["ok"]:
+                        raise sqlite3.DatabaseError(f"backup of {file_name} failed quick_check: {problems[:5]}")
+            finally:
+                target.close()
+            # The checksum is of the database file itself, as it is again after decompressing; gzip level 1
+            # compresses twice as fast as the default for a slightly larger file
+            digest = hashlib.sha256()
+            with open(path, "rb") as plain, (gzip.open(path + ".gz", "wb", compresslevel=1) if compress
+                                             else nullcontext()) as packed:
+                for chunk in chunks(plain):
+                    digest.update(chunk)
+                    if packed is not None:
+                        packed.write(chunk)
+            if compress:
+                os.remove(path)
+                path += ".gz"
+            manifest["files"].append({"name": os.path.basename(path), "source": file_name, "compressed": compress,
+                                      "bytes": os.path.getsize(path), "sha256": digest.hexdigest()})
+        manifest["verified"] = verify
+        with open(os.path.join(target_dir + ".part", "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        os.rename(target_dir + ".part", target_dir)
+    except BaseException:
+        shutil.rmtree(target_dir + ".part", ignore_errors=True)
+        raise
+    finally:
+        for _, source in sources[1:]:
+            source.close()
+    prune_backups(backup_dir, main_file, keep)
+    METRICS.record("job", "backup_database", (time.perf_counter() - started) * 1000)
+    return target_dir
+
+
+class SpecialistRegistry:
+    """In-memory copy of the specialists table with each one's patient count.
+
+    Each connection keeps one, read once and then kept current: the
+    repository applies its own writes to it, and ``PRAGMA data_version``
+    (which moves only when another connection commits) says when to re-read
+    the table. Checks against it are dictionary lookups.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()  # name -> [is_active, patient_count], in registration order
+        self.active = frozenset()
+        self.data_version = None
+
+    def sync(self, conn):
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            rows = conn.execute("SELECT specialist_name, is_active, patient_count FROM specialists ORDER BY id")
+            self.entries = OrderedDict((name, [bool(is_active), count]) for name, is_active, count in rows)
+            self._update_active()
+            self.data_version = version
+        return self
+
+    def invalidate(self):
+        self.data_version = None
+
+    def _update_active(self):
+        self.active = frozenset(name for name, (is_active, _) in self.entries.items() if is_active)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def is_active(self, name):
+        return name in self.active
+
+    def patient_count(self, name):
+        entry = self.entries.get(name)
+        return entry[1] if entry else 0
+
+    def lists(self):
+        """(active names, all names), both in registration order."""
+        return [name for name, (is_active, _) in self.entries.items() if is_active], list(self.entries)
+
+    def add(self, name):
+        self.entries[name] = [True, 0]
+        self._update_active()
+
+    def deactivate(self, name):
+        self.entries[name][0] = False
+        self._update_active()
+
+    def count_patients(self, name, delta):
+        if name in self.entries:
+            self.entries[name][1] += delta
+
+
+class PatientRepository:
+    """Patient and specialist operations on one connection.
+
+    This is the layer the Tk GUI and the HTTP API share. Writes commit before
+    returning; rule violations raise ServiceError subclasses carrying the
+    message shown to the user, while sqlite3 errors propagate unchanged.
+    """
+
+    def __init__(self, conn, actor=None):
+        self.conn = conn
+        # Recorded in patient_audit with every patient write
+        self.actor = actor or audit_user()
+        # Connections from connect_database keep their registry between repositories
+        registry = getattr(conn, "specialist_registry", None)
+        self.registry = registry if registry is not None else SpecialistRegistry()
+
+    # --- Specialists ---
+
+    def specialists(self):
+        return self.registry.sync(self.conn)
+
+    def get_specialists(self):
+        return self.specialists().lists()
+
+    def active_specialists(self):
+        return self.specialists().active
+
+    def add_specialist(self, specialist_name):
+        """Register and activate a specialist; returns get_specialists() afterwards."""
+        specialist_name = (specialist_name or "").strip()
+        if not specialist_name:
+            raise PatientValidationError("ورودی ناقص", "لطفا نام پزشک را وارد کنید.")
+        registry = self.specialists()
+        if specialist_name in registry:
+            raise ConflictError("تکراری", "این پزشک قبلا ثبت شده است.")
+        try:
+            self.conn.execute("INSERT INTO specialists (specialist_name, is_active) VALUES (?, 1)", (specialist_name,))
+            self.conn.commit()
+        except sqlite3.IntegrityError:
+            # Another terminal registered the same name after our registry was read
+            self.conn.rollback()
+            registry.invalidate()
+            raise ConflictError("تکراری", "این پزشک قبلا ثبت شده است.")
+        registry.add(specialist_name)
+        return registry.lists()
+
+    def _check_deactivate(self, registry, specialist_name):
+        if not registry.is_active(specialist_name):
+            raise NotFoundError("خطا", "پزشک مورد نظر یافت نشد یا غیرفعال است.")
+        if registry.patient_count(specialist_name):
+            raise ConflictError("خطا", "نمی‌توان پزشک را حذف کرد زیرا در سوابق بیماران استفاده شده است.")
+
+    def deactivate_specialist(self, specialist_name):
+        """Hide a specialist from new entries; returns get_specialists() afterwards."""
+        # Specialists are never deleted, only hidden from new entries, and only while no patient refers to them
+        specialist_name = (specialist_name or "").strip()
+        if not specialist_name:
+            raise PatientValidationError("انتخاب کنید", "لطفا نام پزشک را در کادر وارد کنید.")
+        registry = self.specialists()
+        self._check_deactivate(registry, specialist_name)
+        # The same conditions again in the statement, against the stored count, in case another terminal just wrote
+        cursor = self.conn.execute("UPDATE specialists SET is_active=0 "
+                                   "WHERE specialist_name=? AND is_active=1 AND patient_count=0", (specialist_name,))
+        self.conn.commit()
+        if cursor.rowcount == 0:
+            registry.invalidate()
+            self._check_deactivate(self.specialists(), specialist_name)
+            raise ConflictError("خطا", "اطلاعات پزشک در پایانه دیگری تغییر کرد؛ دوباره تلاش کنید.")
+        registry.deactivate(specialist_name)
+        return registry.lists()
+
+    # --- Patients ---
+
+    def _insert(self, values):
+        cursor = self.conn.execute(INSERT_PATIENT_SQL, values)
+        if storage_mode(self.conn) == STORAGE_CLASSIC:
+            return cursor.lastrowid
+        # An INSTEAD OF trigger does not report its rowid; the open write transaction makes the newest id ours
+        return self.conn.execute("SELECT MAX(id) FROM patient_records").fetchone()[0]
+
+    def get_patient(self, patient_id):
+        row = self.conn.execute(f"SELECT {PATIENT_COLUMNS} FROM patients WHERE id=?", (patient_id,)).fetchone()
+        if row is None:
+            raise NotFoundError("خطا", ".بیمار مورد نظر در پایگاه داده یافت نشد")
+        return row
+
+    def add_patient(self, name, last_name, age, ward, code, specialist, submission_date=None, submission_time=None):
+        """Validate and insert one patient; returns the new id."""
+        record = validate_patient(name, last_name, age, ward, code, specialist, self.active_specialists())
+        try:
+            submission = normalize_submission(submission_date, submission_time)
+        except ValueError:
+            raise PatientValidationError("ورودی نامعتبر", ".تاریخ یا زمان ثبت نامعتبر است")
+        patient_id = self._insert(record + submission)
+        record_audit(self.conn, "I", [patient_id], self.actor)
+        self.conn.commit()
+        self.registry.count_patients(record[5], 1)
+        return patient_id
+
+    def update_patient(self, patient_id, name, last_name, age, ward, code, specialist):
+        current = self.get_patient(patient_id)
+        # A patient may keep a specialist that has since been deactivated, but not be moved to one
+        keeps_specialist = str(specialist).strip() == current[6]
+        record = validate_patient(name, last_name, age, ward, code, specialist,
+                                  None if keeps_specialist else self.active_specialists())
+        if record != current[1:7]:
+            record_audit(self.conn, "U", [patient_id], self.actor, with_image=True)
+        self.conn.execute("""
+            UPDATE patients
+            SET patient_name=?, last_name=?, age=?, ward=?, patient_code=?, specialist=?
+            WHERE id=?
+        """, record + (patient_id,))
+        self.conn.commit()
+        if not keeps_specialist:
+            self.registry.count_patients(current[6], -1)
+            self.registry.count_patients(record[5], 1)
+
+    def delete_patients(self, patient_ids):
+        """Soft-delete the given ids in one transaction; returns how many were deleted.
+
+        The rows leave patients, and their last image stays in patient_audit
+        for restore_patients. If any id is not in the main file (never
+        existed, already deleted or archived), nothing is deleted and
+        NotFoundError is raised.
+        """
+        patient_ids = list(dict.fromkeys(patient_ids))
+        record_audit(self.conn, "D", patient_ids, self.actor, with_image=True)
+        cursor = self.conn.executemany(f"DELETE FROM {patient_table(self.conn)} WHERE id=?",
+                                       [(patient_id,) for patient_id in patient_ids])
+        if cursor.rowcount < len(patient_ids):
+            self.conn.rollback()
+            missing = len(patient_ids) - cursor.rowcount
+            raise NotFoundError("خطا", f".{missing} بیمار از بیماران انتخاب‌شده در پایگاه داده یافت نشد یا بایگانی شده است")
+        self.conn.commit()
+        # The triggers know which specialists lost patients; re-read their counts on next use
+        self.registry.invalidate()
+        return cursor.rowcount
+
+    def restore_patients(self, patient_ids):
+        """Put deleted patients back under their old ids, as they were deleted; returns the ids restored.
+
+        Ids whose latest audit entry is not a deletion are skipped.
+        """
+        restored = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for patient_id in patient_ids:
+                entry = self.conn.execute(f"SELECT op, {PATIENT_AUDIT_COLUMNS} FROM patient_audit WHERE patient_id = ? "
+                                          f"ORDER BY seq DESC LIMIT 1", (patient_id,)).fetchone()
+                if entry is None or entry[0] != "D":
+                    continue
+                self.conn.execute(f"INSERT INTO patients ({PATIENT_COLUMNS}) VALUES ({', '.join('?' * 9)})",
+                                  (patient_id,) + entry[1:])
+                restored.append(patient_id)
+            record_audit(self.conn, "R", restored, self.actor)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.registry.invalidate()
+        return restored
+
+    def deleted_patients(self, limit=DELETED_LIST_LIMIT):
+        """The latest deleted patients not restored since: (id, ...patient columns, deleted_at, deleted_by)."""
+        return self.conn.execute(f'''
+            SELECT a.patient_id, {", ".join("a." + column for column in PATIENT_AUDIT_COLUMNS.split(", "))},
+                   a.changed_at, a.changed_by
+            FROM patient_audit a
+            WHERE a.op = 'D' AND NOT EXISTS (SELECT 1 FROM patient_audit b WHERE b.patient_id = a.patient_id AND b.seq > a.seq)
+            ORDER BY a.seq DESC LIMIT ?
+        ''', (limit,)).fetchall()
+
+    def patient_history(self, patient_id):
+        """Audit entries of one patient, oldest first: (seq, op, changed_at, changed_by, ...columns before the change)."""
+        return self.conn.execute(f"SELECT seq, op, changed_at, changed_by, {PATIENT_AUDIT_COLUMNS} FROM patient_audit "
+                                 f"WHERE patient_id = ? ORDER BY seq", (patient_id,)).fetchall()
+
+    def add_patients(self, records):
+        """Insert many patients in one transaction; returns (new ids, rejected).
+
+        Each record is (name, last_name, age, ward, code, specialist[, date, time]).
+        Invalid records are skipped and reported in `rejected` as (index, message).
+        """
+        active_specialists = self.active_specialists()
+        now = datetime.now()
+        ids, rejected = [], []
+        added = {}
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for index, record in enumerate(records):
+                record = tuple(record) + (None,) * (8 - len(record))
+                try:
+                    values = validate_patient(*record[:6], active_specialists=active_specialists)
+                    values += normalize_submission(record[6], record[7], now)
+                except PatientValidationError as e:
+                    rejected.append((index, str(e)))
+                    continue
+                except ValueError:
+                    rejected.append((index, ".تاریخ یا زمان ثبت نامعتبر است"))
+                    continue
+                ids.append(self._insert(values))
+                added[values[5]] = added.get(values[5], 0) + 1
+            record_audit(self.conn, "I", ids, self.actor)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        for specialist, count in added.items():
+            self.registry.count_patients(specialist, count)
+        return ids, rejected
+
+    def count_patients(self, source):
+        return source._count(self.conn.cursor())
+
+    def list_patients(self, source, cursor=None, limit=PAGE_SIZE):
+        """One page of `source`; returns (rows, next cursor or None).
+
+        Plain filters page by keyset, the cursor being the last id returned;
+        ranked searches page by offset into the ranked match set.
+        """
+        db_cursor = self.conn.cursor()
+        if source.rank_sql:
+            offset = cursor or 0
+            rows = source._fetch_ranked(db_cursor, offset, limit + 1)
+            next_cursor = offset + limit if len(rows) > limit else None
+        else:
+            rows = source._fetch(db_cursor, cursor, limit + 1)
+            next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    def import_file(self, file_path, progress=None, cancel_event=None):
+        try:
+            return import_patients(self.conn, file_path, progress, cancel_event, self.actor)
+        finally:
+            self.registry.invalidate()
+
+    def export(self, source, file_path, headers, progress=None, cancel_event=None):
+        return export_patients(self.conn, source, file_path, headers, progress, cancel_event)
+
+    def admission_stats(self, date_from=None, date_to=None, period=None):
+        return admission_stats(self.conn, date_from, date_to, period)
+
+    def archives(self):
+        """The yearly archive files: (year, file_name, patients, archived_before, archived_at), oldest first."""
+        return self.conn.execute("SELECT year, file_name, patients, archived_before, archived_at FROM patient_archives "
+                                 "ORDER BY year").fetchall()
+
+    def wards(self):
+        """Names of the wards patients are in, from the statistics summary."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT bucket FROM patient_stats WHERE dimension = 'ward' GROUP BY bucket HAVING SUM(admissions) > 0 "
+            "ORDER BY bucket")]
+
+    # --- Change feed ---
+
+    def latest_change_seq(self):
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+
+    def changes_since(self, last_seq, limit=CHANGE_BATCH_LIMIT):
+        """Summarise change_log entries after `last_seq`.
+
+        Returns (newest seq, changed patient ids, specialists changed); the ids
+        are None when there were more than `limit` changes or older entries were
+        pruned before being read, in which case callers should reload instead.
+        """
+        first_seq = self.conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+        rows = self.conn.execute("SELECT seq, table_name, row_id FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                                 (last_seq, limit + 1)).fetchall()
+        if not rows:
+            return last_seq, set(), False
+        if len(rows) > limit or (first_seq is not None and first_seq > last_seq + 1 and last_seq):
+            return self.latest_change_seq(), None, True
+        patient_ids = {row_id for _, table, row_id in rows if table == "patients"}
+        specialists_changed = any(table == "specialists" for _, table, _ in rows)
+        return rows[-1][0], patient_ids, specialists_changed
@@ -0,0 +1,108 @@
+"""Helpers shared by the tests: temporary databases and deterministic patients."""
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patient_service as service
+
+FIRST_NAMES = ["علی", "محمد", "حسین", "رضا", "فاطمه", "زهرا", "مریم", "سارا"]
+LAST_NAMES = ["محمدی", "حسینی", "احمدی", "رضایی", "کریمی", "موسوی"]
+WARDS = ["اورژانس", "داخلی", "جراحی", "اطفال", "قلب"]
+FIRST_DATE = date(2020, 1, 1)
+
+# The tables the app created before versioned migrations (the baseline "Patient Management System simple.py")
+BASELINE_SCHEMA = '''
+    CREATE TABLE patients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_name TEXT NOT NULL,
+        last_name TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        ward TEXT NOT NULL,
+        patient_code TEXT NOT NULL,
+        specialist TEXT NOT NULL,
+        submission_date TEXT NOT NULL,
+        submission_time TEXT NOT NULL
+    );
+    CREATE TABLE specialists (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        specialist_name TEXT NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 1
+    );
+'''
+
+
+def patient_rows(count, specialists, seed=0, first_date=FIRST_DATE, span_days=6 * 365):
+    """`count` patient tuples (without id) whose submission dates grow from `first_date` over `span_days`."""
+    rng = random.Random(seed)
+    for index in range(count):
+        day = first_date + timedelta(days=index * span_days // max(count, 1))
+        yield (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.randint(1, 99), rng.choice(WARDS),
+               f"P{index + 1:08d}", rng.choice(specialists), day.isoformat(),
+               f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:00")
+
+
+def insert_patients(conn, rows):
+    conn.executemany(f"INSERT INTO patients ({service.PATIENT_AUDIT_COLUMNS}) VALUES ({', '.join('?' * 8)})", rows)
+    conn.commit()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Gives each test a fresh directory; `open_database` returns a migrated connection closed after the test."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="pms-test-")
+        self.db_path = os.path.join(self.directory, "hospital_patients.db")
+        self.connections = []
+
+    def tearDown(self):
+        for conn in self.connections:
+            conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self, path=None):
+        conn = service.connect_database(path or self.db_path)
+        self.connections.append(conn)
+        return conn
+
+    def open_database(self, rows=0, storage=service.STORAGE_CLASSIC, seed=0):
+        conn = self.connect()
+        service.migrate_schema(conn, storage=storage)
+        if rows:
+            insert_patients(conn, patient_rows(rows, service.INITIAL_SPECIALISTS, seed))
+        return conn
+
+    def assertSummariesMatch(self, conn):
+        """specialists.patient_count and patient_stats agree with the patients table."""
+        counts = dict(conn.execute("SELECT specialist, COUNT(*) FROM patients GROUP BY 1"))
+        for name, patient_count in conn.execute("SELECT specialist_name, patient_count FROM specialists"):
+            self.assertEqual(patient_count, counts.get(name, 0), name)
+        expected = sorted(conn.execute('''
+            SELECT 'specialist', submission_date, specialist, COUNT(*) FROM patients GROUP BY 2, 3
+            UNION ALL SELECT 'ward', submission_date, ward, COUNT(*) FROM patients GROUP BY 2, 3
+            UNION ALL SELECT 'age', submission_date, age / 10 * 10, COUNT(*) FROM patients GROUP BY 2, 3
+        ''').fetchall())
+        actual = sorted(conn.execute("SELECT dimension, day, bucket, admissions FROM patient_stats "
+                                     "WHERE admissions > 0").fetchall())
+        self.assertEqual(actual, expected)
+
+
+def read_source(conn, source):
+    """Every row of a page source, opened and paged the way the grid does."""
+    source.total, loaded = source.open_job()(conn)
+    source.store_pages(loaded)
+    missing = source.missing_pages(0, source.total)
+    if missing:
+        source.store_pages(source.load_pages_job(missing)(conn))
+    return source.rows(0, source.total)
+
+
+def baseline_database(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    return conn
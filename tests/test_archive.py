@@ -0,0 +1,120 @@
+"""archive_patients and the views reading the yearly archive files next to the main one."""
+import os
+import threading
+import unittest
+from datetime import date
+from unittest import mock
+
+from support import DatabaseTestCase, read_source, service
+
+ROWS = 3000
+BEFORE = "2023-01-01"
+ARCHIVED_YEARS = [2020, 2021, 2022]
+
+
+class ArchiveTest(DatabaseTestCase):
+    storage = service.STORAGE_CLASSIC
+
+    def setUp(self):
+        super().setUp()
+        self.conn = self.open_database(ROWS, self.storage)
+
+    def source(self, **criteria):
+        return service.build_patient_source(storage=self.storage, archives=service.archived_years(self.conn),
+                                            **criteria)
+
+    def archive(self):
+        expected = self.conn.execute("SELECT COUNT(*) FROM patients WHERE submission_date < ?", (BEFORE,)).fetchone()[0]
+        self.assertEqual(service.archive_patients(self.conn, BEFORE, batch_size=400), expected)
+
+    def test_archive_moves_old_patients(self):
+        rows = self.conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients ORDER BY id").fetchall()
+        stats = service.admission_stats(self.conn)
+        self.archive()
+
+        self.assertEqual(service.archived_years(self.conn), ARCHIVED_YEARS)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM patients WHERE submission_date < ?",
+                                           (BEFORE,)).fetchone()[0], 0)
+        self.assertSummariesMatch(self.conn)
+        archived = []
+        for year in ARCHIVED_YEARS:
+            schema = service.archive_schema(year)
+            self.assertTrue(os.path.exists(os.path.join(self.directory, f"hospital_patients_archive_{year}.db")))
+            year_rows = self.conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM {schema}.patients ORDER BY id").fetchall()
+            self.assertTrue(all(row[7].startswith(str(year)) for row in year_rows))
+            self.assertEqual(self.conn.execute(f"SELECT SUM(admissions) FROM {schema}.patient_stats "
+                                               f"WHERE dimension = 'ward'").fetchone()[0], len(year_rows))
+            archived += year_rows
+        current = self.conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients ORDER BY id").fetchall()
+        self.assertEqual(sorted(archived + current), rows)
+        # The whole-period statistics add up the archives' own summaries
+        self.assertEqual(service.admission_stats(self.conn), stats)
+        # A second run finds nothing left to move
+        self.assertEqual(service.archive_patients(self.conn, BEFORE), 0)
+
+    def test_cancelled_run_is_completed_by_the_next(self):
+        cancel = threading.Event()
+
+        def cancel_in_2021(sql):
+            # Stop once the first year is through, as the next one's file is listed
+            if sql.startswith("INSERT INTO patient_archives") and "(2021," in sql:
+                cancel.set()
+        self.conn.set_trace_callback(cancel_in_2021)
+        with mock.patch.object(service, "ARCHIVE_AFTER_DAYS", (date.today() - date.fromisoformat(BEFORE)).days):
+            with self.assertRaises(service.TaskCancelled):
+                service.archive_old_records(self.conn, cancel)
+        self.conn.set_trace_callback(None)
+        self.assertEqual(service.archived_years(self.conn), [2020, 2021])
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM patients WHERE submission_date < '2021-01-01'")
+                         .fetchone()[0], 0)
+        self.assertGreater(self.conn.execute("SELECT COUNT(*) FROM patients WHERE submission_date < ?",
+                                             (BEFORE,)).fetchone()[0], 0)
+        self.assertSummariesMatch(self.conn)
+        self.archive()
+        self.assertSummariesMatch(self.conn)
+        self.assertEqual(service.archived_years(self.conn), ARCHIVED_YEARS)
+
+    def test_views_read_archived_years(self):
+        criteria = [{"search_term": "محمد"}, {"search_term": "P00000"}, {"search_term": "ر"},
+                    {"date_from": "2021-06-01", "date_to": "2023-03-31"},
+                    {"date_from": "2021-06-01", "date_to": "2023-03-31", "search_term": "حسین"},
+                    {"specialist": service.INITIAL_SPECIALISTS[0], "date_from": "2022-01-01"}]
+        before = [read_source(self.conn, self.source(**c)) for c in criteria]
+        snapshot = read_source(self.conn, service.AsOfSource("2100-01-01 00:00:00"))
+        self.archive()
+        for c, rows in zip(criteria, before):
+            source = self.source(**c)
+            self.assertIsInstance(source, service.PartitionedSource)
+            self.assertEqual(read_source(self.conn, source), rows, c)
+        self.assertEqual(read_source(self.conn, service.AsOfSource("2100-01-01 00:00:00", ARCHIVED_YEARS)), snapshot)
+        # Browsing without dates or a search stays on the main file
+        self.assertNotIsInstance(self.source(specialist=service.INITIAL_SPECIALISTS[0]), service.PartitionedSource)
+
+    def test_search_without_dates_reads_newest_years(self):
+        self.archive()
+        with mock.patch.object(service, "ARCHIVE_ATTACH_LIMIT", 2):
+            source = self.source(search_term="محمد")
+            self.assertEqual((source.years, source.skipped_years), ((2021, 2022), (2020,)))
+            rows = read_source(self.conn, source)
+        self.assertFalse([row for row in rows if row[7].startswith("2020")])
+        self.assertTrue([row for row in rows if row[7].startswith("2021")])
+
+    def test_archived_patients_are_read_only(self):
+        self.archive()
+        archived_id = self.conn.execute("SELECT MIN(id) FROM archive_2021.patients").fetchone()[0]
+        current_id = self.conn.execute("SELECT MAX(id) FROM patients").fetchone()[0]
+        source = self.source(date_from="2021-01-01")
+        with self.assertRaises(service.ConflictError):
+            source.check_writable(self.conn.cursor(), [archived_id, current_id])
+        repository = service.PatientRepository(self.conn, actor="test")
+        with self.assertRaises(service.NotFoundError):
+            repository.delete_patients([current_id, archived_id])
+        self.assertIsNotNone(repository.get_patient(current_id))
+
+
+class CompactArchiveTest(ArchiveTest):
+    storage = service.STORAGE_COMPACT
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""AsOfSource: the patient list at a past moment, rebuilt from patient_audit."""
+import unittest
+from unittest import mock
+
+from support import DatabaseTestCase, service
+
+ROWS = 500
+
+
+class AsOfTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = self.open_database(ROWS)
+        self.repository = service.PatientRepository(self.conn, actor="test")
+        # Audit entries are stamped to the second; every write below gets the time set here
+        self.now = "2024-01-01 09:00:00"
+        patcher = mock.patch.object(service, "audit_timestamp", lambda moment=None: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def snapshot(self):
+        return self.conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients ORDER BY id DESC").fetchall()
+
+    def as_of(self, moment, page_size=40):
+        source = service.AsOfSource(moment, page_size=page_size)
+        total, loaded = source.open_job()(self.conn)
+        source.total = total
+        source.store_pages(loaded)
+        # Walk the middle first, so some bounds are sought rather than carried over
+        for start in (page_size * 5, 0, total - 1):
+            missing = source.missing_pages(start, page_size)
+            if missing:
+                source.store_pages(source.load_pages_job(missing)(self.conn))
+        missing = source.missing_pages(0, total)
+        if missing:
+            source.store_pages(source.load_pages_job(missing)(self.conn))
+        return source, source.rows(0, total)
+
+    def write_history(self):
+        """Changes at 11:00 and 13:00; returns the lists as they were at 10:00 and 12:00."""
+        snapshots = [self.snapshot()]
+        ids = [row[0] for row in snapshots[0]]
+        specialist = service.INITIAL_SPECIALISTS[0]
+        self.now = "2024-01-01 11:00:00"
+        self.repository.add_patient("سارا", "کریمی", 40, "قلب", "NEW1", specialist)
+        self.repository.update_patient(ids[0], "مریم", "احمدی", 41, "قلب", "EDIT1", specialist)
+        self.repository.update_patient(ids[10], "مریم", "احمدی", 42, "قلب", "EDIT2", specialist)
+        self.repository.delete_patients([ids[3], ids[200], ids[-1]])
+        snapshots.append(self.snapshot())
+        self.now = "2024-01-01 13:00:00"
+        self.repository.update_patient(ids[0], "مریم", "احمدی", 43, "قلب", "EDIT3", specialist)
+        self.repository.update_patient(ids[20], "مریم", "احمدی", 44, "قلب", "EDIT4", specialist)
+        self.repository.delete_patients([ids[10], ids[30]])
+        self.repository.restore_patients([ids[3]])
+        self.repository.add_patients([("زهرا", "موسوی", 50, "داخلی", "NEW2", specialist)])
+        return snapshots
+
+    def test_as_of(self):
+        before, between = self.write_history()
+        for moment, expected in (("2024-01-01 10:00:00", before), ("2024-01-01 12:00:00", between),
+                                 ("2024-01-01 14:00:00", self.snapshot())):
+            source, rows = self.as_of(moment)
+            self.assertEqual(source.total, len(expected), moment)
+            self.assertEqual(rows, expected, moment)
+            exported = [row for batch in source.iter_batches(self.conn.cursor(), 64) for row in batch]
+            self.assertEqual(exported, expected, moment)
+
+    def test_compacted_history_is_refused(self):
+        _, between = self.write_history()
+        self.now = "2024-01-01 15:00:00"
+        self.assertGreater(service.compact_audit_log(self.conn, "2024-01-01 12:00:00"), 0)
+        with self.assertRaises(service.ConflictError):
+            self.as_of("2024-01-01 10:00:00")
+        self.assertEqual(self.as_of("2024-01-01 12:00:00")[1], between)
+
+
+if __name__ == "__main__":
+    unittest.main()
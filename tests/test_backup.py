@@ -0,0 +1,134 @@
+"""backup_database: online copies of the main, audit archive and yearly archive files."""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import unittest
+
+from support import DatabaseTestCase, insert_patients, patient_rows, read_source, service
+
+ROWS = 3000
+
+
+class BackupTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backup_dir = os.path.join(self.directory, "backups")
+
+    def backup(self, conn, **options):
+        options = dict(dict(step_pages=8, step_pause=0, keep=0), **options)
+        return service.backup_database(conn, self.backup_dir, **options)
+
+    def restore(self, backup_path):
+        """Decompress a backup into a directory of its own, checking the manifest; returns the restored main file."""
+        with open(os.path.join(backup_path, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        restored = os.path.join(self.directory, "restored")
+        os.makedirs(restored)
+        for entry in manifest["files"]:
+            opener = gzip.open if entry["compressed"] else open
+            with opener(os.path.join(backup_path, entry["name"]), "rb") as f:
+                data = f.read()
+            self.assertEqual(hashlib.sha256(data).hexdigest(), entry["sha256"], entry["name"])
+            with open(os.path.join(restored, entry["source"]), "wb") as f:
+                f.write(data)
+        return manifest, os.path.join(restored, os.path.basename(self.db_path))
+
+    def test_backup_and_restore(self):
+        conn = self.open_database(ROWS)
+        service.PatientRepository(conn, actor="test").delete_patients([5, 6])
+        service.compact_audit_log(conn, "2100-01-01 00:00:00")
+        service.archive_patients(conn, "2022-01-01")
+        progress = []
+        path = self.backup(conn, progress=progress.append)
+
+        self.assertEqual(service.list_backups(self.backup_dir, self.db_path), [os.path.basename(path)])
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        manifest, restored_path = self.restore(path)
+        self.assertEqual(sorted(entry["source"] for entry in manifest["files"]),
+                         ["hospital_patients.db", "hospital_patients_archive_2020.db",
+                          "hospital_patients_archive_2021.db", "hospital_patients_audit_archive.db"])
+        self.assertEqual((manifest["schema_version"], manifest["storage"], manifest["patients"]),
+                         (len(service.SCHEMA_MIGRATIONS), service.STORAGE_CLASSIC, ROWS - 2 -
+                          sum(row[0] for row in conn.execute("SELECT patients FROM patient_archives"))))
+
+        restored = self.connect(restored_path)
+        self.assertEqual(restored.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        years = service.archived_years(restored)
+        self.assertEqual(years, [2020, 2021])
+        for criteria in ({}, {"date_from": "2020-01-01"}, {"search_term": "محمد"}):
+            self.assertEqual(read_source(restored, service.build_patient_source(archives=years, **criteria)),
+                             read_source(conn, service.build_patient_source(archives=years, **criteria)), criteria)
+        self.assertEqual(restored.execute("SELECT COUNT(*) FROM audit_compactions").fetchone()[0], 1)
+
+    def test_writes_during_a_wal_backup(self):
+        conn = self.open_database(ROWS)
+        writer = self.connect()
+        repository = service.PatientRepository(writer, actor="test")
+        steps = []
+
+        def write(value):
+            # Other terminals keep committing while the copy is under way
+            steps.append(value)
+            repository.add_patient("علی", "رضایی", 30, "داخلی", f"W{len(steps)}", service.INITIAL_SPECIALISTS[0])
+        manifest, restored_path = self.restore(self.backup(conn, compress=False, progress=write))
+
+        # One snapshot, taken when the copy began, and never restarted
+        self.assertEqual(manifest["patients"], ROWS)
+        self.assertEqual([copied for copied, _ in steps], sorted(copied for copied, _ in steps))
+        restored = self.connect(restored_path)
+        self.assertEqual(restored.execute("SELECT COUNT(*) FROM patients").fetchone()[0], ROWS)
+        self.assertSummariesMatch(restored)
+
+    def test_legacy_journal_restarts_then_gives_up(self):
+        conn = service.connect_database(self.db_path, "legacy")
+        self.connections.append(conn)
+        service.migrate_schema(conn, storage=service.STORAGE_CLASSIC)
+        insert_patients(conn, patient_rows(ROWS, service.INITIAL_SPECIALISTS))
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        writer = service.connect_database(self.db_path, "legacy")
+        self.connections.append(writer)
+        repository = service.PatientRepository(writer, actor="test")
+        writes = []
+
+        def write_until(limit):
+            def write(value):
+                if len(writes) < limit:
+                    writes.append(value)
+                    repository.add_patient("علی", "رضایی", 30, "داخلی", f"L{len(writes)}",
+                                           service.INITIAL_SPECIALISTS[0])
+            return write
+
+        # Each write between steps starts the copy over, and the copy still finishes with every row
+        manifest, restored_path = self.restore(self.backup(conn, progress=write_until(service.BACKUP_MAX_RESTARTS)))
+        self.assertEqual(manifest["patients"], ROWS + service.BACKUP_MAX_RESTARTS)
+        shutil.rmtree(os.path.dirname(restored_path))
+
+        writes.clear()
+        with self.assertRaises(service.ConflictError):
+            self.backup(conn, progress=write_until(service.BACKUP_MAX_RESTARTS + 1))
+        self.assertEqual(len(service.list_backups(self.backup_dir, self.db_path)), 1)
+        self.assertFalse([name for name in os.listdir(self.backup_dir) if name.endswith(".part")])
+
+    def test_cancel_removes_partial_copy(self):
+        conn = self.open_database(ROWS)
+        cancel = threading.Event()
+        with self.assertRaises(service.TaskCancelled):
+            self.backup(conn, progress=lambda value: cancel.set(), cancel_event=cancel)
+        self.assertEqual(os.listdir(self.backup_dir), [])
+
+    def test_names_and_pruning(self):
+        conn = self.open_database(100)
+        paths = [self.backup(conn, keep=2, step_pages=-1) for _ in range(3)]
+        # Backups within the same second get -2, -3...; only the newest `keep` remain
+        self.assertEqual(len(set(paths)), 3)
+        self.assertEqual(service.list_backups(self.backup_dir, self.db_path),
+                         sorted(os.path.basename(path) for path in paths)[1:])
+        self.assertFalse(service.backup_due(self.backup_dir, self.db_path, interval_hours=1))
+        self.assertTrue(service.backup_due(self.backup_dir, self.db_path, interval_hours=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
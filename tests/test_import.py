@@ -0,0 +1,91 @@
+"""import_patients: bulk loads with the per-row triggers dropped and caught up in one statement each."""
+import csv
+import os
+import threading
+import unittest
+from unittest import mock
+
+from support import DatabaseTestCase, patient_rows, service
+
+EXISTING = 1000
+IMPORTED = 3000
+
+
+class ImportTest(DatabaseTestCase):
+    storage = service.STORAGE_CLASSIC
+
+    def setUp(self):
+        super().setUp()
+        self.conn = self.open_database(EXISTING, self.storage)
+        # Deleted newest patients leave sqlite_sequence above MAX(id)
+        service.PatientRepository(self.conn, actor="test").delete_patients(range(EXISTING - 4, EXISTING + 1))
+        self.triggers = self.trigger_names()
+        self.csv_path = os.path.join(self.directory, "patients.csv")
+        rows = [row[:4] + (f"IMP{index:06d}",) + row[5:]
+                for index, row in enumerate(patient_rows(IMPORTED, service.INITIAL_SPECIALISTS, seed=1))]
+        self.rejects = [("", "رضایی", 30, "داخلی", "BAD1", service.INITIAL_SPECIALISTS[0], "", ""),
+                        ("علی", "رضایی", 300, "داخلی", "BAD2", service.INITIAL_SPECIALISTS[0], "", ""),
+                        ("علی", "رضایی", 30, "داخلی", "BAD3", "دکتر ناشناس", "", ""),
+                        ("علی", "رضایی", 30, "داخلی", "BAD4", service.INITIAL_SPECIALISTS[0], "2024-13-01", "")]
+        with open(self.csv_path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow([title for _, title in service.IMPORT_FIELDS])
+            writer.writerows(rows[:1000] + self.rejects + rows[1000:])
+
+    def trigger_names(self):
+        return sorted(row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'"))
+
+    def test_import(self):
+        last_id = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?",
+                                    (service.patient_table(self.conn),)).fetchone()[0]
+        progress = []
+        imported, rejected, report_path = service.import_patients(self.conn, self.csv_path, progress.append,
+                                                                  actor="importer")
+        self.assertEqual((imported, rejected), (IMPORTED, len(self.rejects)))
+        self.assertEqual(self.trigger_names(), self.triggers)
+
+        new_ids = [row[0] for row in self.conn.execute("SELECT id FROM patients WHERE patient_code LIKE 'IMP%' "
+                                                       "ORDER BY id")]
+        self.assertEqual(new_ids, list(range(last_id + 1, last_id + IMPORTED + 1)))
+        self.assertSummariesMatch(self.conn)
+        # The caught-up search index, change log and audit cover exactly the new rows
+        where, params, _, _ = service.build_search_filter("IMP002999")
+        self.assertEqual(self.conn.execute(f"SELECT id FROM patients WHERE {where}", params).fetchall(),
+                         [(new_ids[-1],)])
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM patients_fts").fetchone()[0],
+                         self.conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0])
+        self.assertEqual([row[0] for row in self.conn.execute("SELECT row_id FROM change_log WHERE op = 'I' "
+                                                              "AND row_id > ? ORDER BY row_id", (last_id,))], new_ids)
+        self.assertEqual([row[0] for row in self.conn.execute("SELECT patient_id FROM patient_audit WHERE op = 'I' "
+                                                              "AND changed_by = 'importer' ORDER BY patient_id")],
+                         new_ids)
+
+        with open(report_path, newline="", encoding="utf-8-sig") as f:
+            report = list(csv.reader(f))
+        self.assertEqual([row[6] for row in report[1:]], ["BAD1", "BAD2", "BAD3", "BAD4"])
+        self.assertEqual(report[1][0], "1002")
+
+    def test_cancel_rolls_back(self):
+        before = self.conn.execute("SELECT COUNT(*), MAX(id) FROM patients").fetchone()
+        cancel = threading.Event()
+        with mock.patch.object(service, "IMPORT_BATCH_SIZE", 500):
+            with self.assertRaises(service.TaskCancelled):
+                service.import_patients(self.conn, self.csv_path, lambda counts: cancel.set(), cancel)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*), MAX(id) FROM patients").fetchone(), before)
+        self.assertEqual(self.trigger_names(), self.triggers)
+        self.assertSummariesMatch(self.conn)
+
+    def test_missing_columns(self):
+        with open(self.csv_path, "w", newline="", encoding="utf-8-sig") as f:
+            csv.writer(f).writerow(["patient_name", "last_name", "age"])
+        with self.assertRaises(ValueError):
+            service.import_patients(self.conn, self.csv_path)
+        self.assertEqual(self.trigger_names(), self.triggers)
+
+
+class CompactImportTest(ImportTest):
+    storage = service.STORAGE_COMPACT
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Upgrading a database created by the baseline app through every SCHEMA_MIGRATIONS step.
+
+PMS_TEST_ROWS sets the size of the seeded database (default 50k); the
+upgrade has been run this way on 1M rows.
+"""
+import os
+import unittest
+
+from support import DatabaseTestCase, baseline_database, patient_rows, service
+
+ROWS = int(os.environ.get("PMS_TEST_ROWS", "50000"))
+UNKNOWN_SPECIALISTS = ["دکتر بازنشسته", "نام قدیمی - دکتر نامعلوم"]
+DELETED_TOP_IDS = 25
+
+
+class MigrateBaselineTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        conn = baseline_database(self.db_path)
+        # Duplicate registrations: the oldest copy of a name inactive and a later one active, a name registered
+        # twice active, and one registered twice inactive
+        names = list(service.INITIAL_SPECIALISTS)
+        conn.executemany("INSERT INTO specialists (specialist_name, is_active) VALUES (?, 1)", [(n,) for n in names])
+        conn.executemany("INSERT INTO specialists (specialist_name, is_active) VALUES (?, ?)",
+                         [(names[0], 1), (names[1], 1), ("غیرفعال - دکتر تکراری", 0), ("غیرفعال - دکتر تکراری", 0)])
+        conn.execute("UPDATE specialists SET is_active = 0 WHERE id = 1")
+        conn.executemany(f"INSERT INTO patients ({service.PATIENT_AUDIT_COLUMNS}) VALUES ({', '.join('?' * 8)})",
+                         patient_rows(ROWS, names + UNKNOWN_SPECIALISTS))
+        # Deleted newest patients leave sqlite_sequence above MAX(id), and their ids must not be handed out again
+        conn.execute("DELETE FROM patients WHERE id > ?", (ROWS - DELETED_TOP_IDS,))
+        conn.execute("DELETE FROM patients WHERE id % 997 = 0")
+        conn.commit()
+        self.ids = [row[0] for row in conn.execute("SELECT id FROM patients ORDER BY id")]
+        self.rows = conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients ORDER BY id").fetchall()
+        self.sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'patients'").fetchone()[0]
+        conn.close()
+
+    def test_upgrade(self):
+        conn = self.connect()
+        service.migrate_schema(conn, storage=None)
+
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], len(service.SCHEMA_MIGRATIONS))
+        self.assertEqual(conn.execute("PRAGMA foreign_key_check").fetchall(), [])
+        self.assertEqual([row[0] for row in conn.execute("SELECT id FROM patients ORDER BY id")], self.ids)
+        self.assertEqual(conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients ORDER BY id").fetchall(),
+                         self.rows)
+        self.assertEqual(conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'patients'").fetchone()[0],
+                         self.sequence)
+
+        registry = dict(conn.execute("SELECT specialist_name, is_active FROM specialists"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM specialists").fetchone()[0], len(registry))
+        self.assertEqual(registry[service.INITIAL_SPECIALISTS[0]], 1)  # active if any copy was
+        self.assertEqual(registry[service.INITIAL_SPECIALISTS[1]], 1)
+        self.assertEqual(registry["غیرفعال - دکتر تکراری"], 0)
+        for name in UNKNOWN_SPECIALISTS:
+            self.assertEqual(registry[name], 0)
+        self.assertSummariesMatch(conn)
+
+        repository = service.PatientRepository(conn)
+        new_id = repository.add_patient("علی", "رضایی", 30, "داخلی", "NEW1", service.INITIAL_SPECIALISTS[2])
+        self.assertEqual(new_id, self.sequence + 1)
+        self.assertSummariesMatch(conn)
+
+    def test_upgrade_is_idempotent(self):
+        conn = self.connect()
+        service.migrate_schema(conn, storage=None)
+        schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+        service.migrate_schema(conn, storage=None)
+        self.assertEqual(conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall(), schema)
+
+    def test_upgrade_to_compact_storage(self):
+        conn = self.connect()
+        service.migrate_schema(conn, storage=service.STORAGE_COMPACT)
+        self.assertEqual(service.storage_mode(conn), service.STORAGE_COMPACT)
+        self.assertEqual(conn.execute("PRAGMA foreign_key_check").fetchall(), [])
+        self.assertEqual(conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients ORDER BY id").fetchall(),
+                         self.rows)
+        self.assertSummariesMatch(conn)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""PatientPageSource: keyset pages, seeks, the page cache and patching it after writes with apply_changes."""
+import unittest
+
+from support import DatabaseTestCase, service
+
+ROWS = 2000
+PAGE = 50
+
+
+class PagingTest(DatabaseTestCase):
+    storage = service.STORAGE_CLASSIC
+
+    def setUp(self):
+        super().setUp()
+        self.conn = self.open_database(ROWS, self.storage)
+        self.repository = service.PatientRepository(self.conn, actor="test")
+
+    def source(self, **criteria):
+        source = service.build_patient_source(storage=self.storage, **criteria)
+        source.page_size = PAGE
+        total, loaded = source.open_job()(self.conn)
+        source.total = total
+        source.store_pages(loaded)
+        return source
+
+    def load(self, source, start, count):
+        """Rows start..start+count of `source`, loading the pages that are missing like the grid does."""
+        missing = source.missing_pages(start, count)
+        if missing:
+            source.store_pages(source.load_pages_job(missing)(self.conn))
+        return source.rows(start, count)
+
+    def expected(self, where="", params=()):
+        return self.conn.execute(f"SELECT {service.PATIENT_COLUMNS} FROM patients"
+                                 f"{' WHERE ' + where if where else ''} ORDER BY id DESC", params).fetchall()
+
+    def test_pages_walk_and_seek(self):
+        source = self.source()
+        expected = self.expected()
+        self.assertEqual(source.total, len(expected))
+        # A jump far down seeks its bound, then the walk back up reuses the bounds found on the way
+        for start in (0, 1500, 1550, 700, 50, ROWS - 10):
+            self.assertEqual(self.load(source, start, 120), expected[start:start + 120], start)
+
+    def test_filtered_pages(self):
+        specialist = service.INITIAL_SPECIALISTS[0]
+        source = self.source(specialist=specialist, date_from="2021-01-01", date_to="2023-06-30")
+        expected = self.expected("specialist = ? AND submission_date BETWEEN ? AND ?",
+                                 (specialist, "2021-01-01", "2023-06-30"))
+        self.assertEqual(source.total, len(expected))
+        self.assertEqual(self.load(source, 0, len(expected)), expected)
+
+    def test_short_terms_match_prefixes(self):
+        for term in ("عل", "p0", "ی"):
+            source = self.source(search_term=term)
+            source.max_cached_pages = source.total
+            rows = self.load(source, 0, source.total)
+            expected = [row for row in self.expected()
+                        if any(value.lower().startswith(term.lower()) for value in (row[5], row[1], row[2]))]
+            self.assertEqual(sorted(rows), sorted(expected), term)
+            self.assertTrue(all(service.row_matches_term(row, term) for row in rows), term)
+        # A third character turns the prefix into a substring search, which may find more
+        self.assertTrue(service.term_narrows("ع", "عل"))
+        self.assertFalse(service.term_narrows("عل", "علی"))
+        self.assertTrue(service.term_narrows("علی", "علیر"))
+
+    def test_cache_is_bounded(self):
+        source = self.source()
+        source.max_cached_pages = 4
+        for start in range(0, ROWS, PAGE):
+            self.load(source, start, PAGE)
+        self.assertEqual(len(source.pages), 4)
+        self.assertEqual(self.load(source, 0, PAGE), self.expected()[:PAGE])
+
+    def mutate(self, source, write, ids=()):
+        # `write` returns the ids it inserts, if any
+        changed, matching, delta = source.mutation_job(write, ids)(self.conn)
+        self.assertTrue(source.apply_changes(changed, matching, source.total + delta))
+
+    def assertMatchesFresh(self, source, **criteria):
+        fresh = self.source(**criteria)
+        self.assertEqual(source.total, fresh.total)
+        self.assertEqual(self.load(source, 0, source.total), self.load(fresh, 0, fresh.total))
+
+    def test_apply_changes_patches_cached_top(self):
+        source = self.source()
+        for start in range(0, 3 * PAGE, PAGE):
+            self.load(source, start, PAGE)
+        top = self.expected()[:3]
+        self.mutate(source, lambda conn: [self.repository.add_patient("سارا", "کریمی", 40, "قلب", "NEW1",
+                                                                      service.INITIAL_SPECIALISTS[1])])
+        self.mutate(source, lambda conn: self.repository.update_patient(top[1][0], "مریم", "احمدی", 41, "قلب", "EDIT1",
+                                                                        top[1][6]), [top[1][0]])
+        self.mutate(source, lambda conn: self.repository.delete_patients([top[2][0]]) and None, [top[2][0]])
+        self.assertEqual(source.total, ROWS)
+        # The patched run is re-chunked; its last, now partial page is dropped rather than kept short
+        self.assertEqual(list(source.pages), [0, 1])
+        self.assertMatchesFresh(source)
+
+    def test_apply_changes_below_cache_keeps_pages_above(self):
+        source = self.source()
+        self.load(source, 0, PAGE)
+        self.load(source, 1000, PAGE)
+        victim = self.expected()[1020][0]
+        self.mutate(source, lambda conn: self.repository.delete_patients([victim]) and None, [victim])
+        # The top page lies above the change and stays; the page holding it is dropped
+        self.assertEqual(list(source.pages), [0])
+        self.assertMatchesFresh(source)
+
+    def test_apply_changes_leaving_filter(self):
+        specialist = service.INITIAL_SPECIALISTS[0]
+        source = self.source(specialist=specialist)
+        self.load(source, 0, source.total)
+        moved = source.rows(5, 1)[0]
+        self.mutate(source, lambda conn: self.repository.update_patient(
+            moved[0], *moved[1:6], service.INITIAL_SPECIALISTS[1]), [moved[0]])
+        self.assertNotIn(moved[0], [row[0] for row in source.rows(0, source.total)])
+        self.assertMatchesFresh(source, specialist=specialist)
+
+    def test_apply_changes_ranked(self):
+        source = self.source(search_term="P0000")
+        self.load(source, 0, PAGE)
+        self.mutate(source, lambda conn: [self.repository.add_patient("سارا", "کریمی", 40, "قلب", "P00000001",
+                                                                      service.INITIAL_SPECIALISTS[1])])
+        # Offsets may all have shifted, so nothing cached is kept
+        self.assertEqual(len(source.pages), 0)
+        self.assertMatchesFresh(source, search_term="P0000")
+
+
+class CompactPagingTest(PagingTest):
+    storage = service.STORAGE_COMPACT
+
+
+if __name__ == "__main__":
+    unittest.main()